@@ -0,0 +1,4 @@
+""" Performance benchmarks for Dagobah. Run modules from the repo root, e.g.
+
+    python -m benchmarks.bench_backends
+"""
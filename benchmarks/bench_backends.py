@@ -0,0 +1,122 @@
+""" Compare backend commit and run log query throughput.
+
+    python -m benchmarks.bench_backends [--iterations N] [--mongo-host HOST]
+
+The Mongo backend is skipped if no server can be reached.
+"""
+
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+from dagobah.backend.sqlite import SQLiteBackend
+from .common import throughput, report
+
+MONGO_DB = 'dagobah_benchmark'
+
+
+def make_job(backend, parent_id, num_tasks):
+    names = ['task_%d' % i for i in range(num_tasks)]
+    return {'job_id': backend.get_new_job_id(),
+            'name': 'benchmark_job',
+            'parent_id': parent_id,
+            'tasks': [{'command': 'true', 'name': name, 'started_at': None,
+                       'completed_at': None, 'success': None,
+                       'soft_timeout': 0, 'hard_timeout': 0,
+                       'hostname': None}
+                      for name in names],
+            'dependencies': dict([(name, []) for name in names]),
+            'status': 'waiting',
+            'cron_schedule': None,
+            'next_run': None,
+            'notes': None}
+
+
+def make_log(backend, job, num_tasks):
+    start = datetime.utcnow()
+    tasks = {}
+    for i in range(num_tasks):
+        tasks['task_%d' % i] = {'success': True,
+                                'return_code': 0,
+                                'stdout': 'x' * 200,
+                                'stderr': '',
+                                'start_time': start,
+                                'complete_time': start + timedelta(seconds=1)}
+    return {'job_id': job['job_id'],
+            'name': job['name'],
+            'parent_id': job['parent_id'],
+            'log_id': backend.get_new_log_id(),
+            'start_time': start,
+            'tasks': tasks}
+
+
+def bench_backend(backend, iterations, num_tasks):
+    parent_id = backend.get_new_dagobah_id()
+    job = make_job(backend, parent_id, num_tasks)
+
+    results = {}
+    results['commit_job_per_sec'] = throughput(
+        lambda i: backend.commit_job(job), iterations)
+
+    logs = [make_log(backend, job, num_tasks) for i in range(iterations)]
+    results['commit_log_per_sec'] = throughput(
+        lambda i: backend.commit_log(logs[i]), iterations)
+
+    def grouped(i):
+        with backend.transaction():
+            for j in range(10):
+                backend.commit_job(job)
+    results['grouped_commit_job_per_sec'] = throughput(
+        grouped, max(iterations / 10, 1)) * 10
+
+    results['get_latest_run_log_per_sec'] = throughput(
+        lambda i: backend.get_latest_run_log(job['job_id'],
+                                             'task_%d' % (i % num_tasks)),
+        iterations)
+    results['get_run_log_history_per_sec'] = throughput(
+        lambda i: backend.get_run_log_history(job['job_id'],
+                                              'task_%d' % (i % num_tasks)),
+        iterations)
+
+    backend.delete_dagobah(parent_id)
+    return results
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--iterations', type='int', default=1000)
+    parser.add_option('--tasks', type='int', default=20)
+    parser.add_option('--mongo-host', default='localhost')
+    parser.add_option('--mongo-port', type='int', default=27017)
+    options, args = parser.parse_args()
+
+    results = {}
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        backend = SQLiteBackend(os.path.join(tempdir, 'benchmark.db'))
+        results['sqlite'] = bench_backend(backend, options.iterations,
+                                          options.tasks)
+    finally:
+        shutil.rmtree(tempdir)
+
+    try:
+        from dagobah.backend.mongo import MongoBackend
+        backend = MongoBackend(options.mongo_host, options.mongo_port,
+                               MONGO_DB)
+    except Exception as e:
+        results['mongo'] = 'skipped: %s' % e
+    else:
+        try:
+            results['mongo'] = bench_backend(backend, options.iterations,
+                                             options.tasks)
+        finally:
+            backend.client.drop_database(MONGO_DB)
+
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
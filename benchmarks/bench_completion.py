@@ -0,0 +1,116 @@
+""" Measure how the cost of completing a Task scales with job size.
+
+    python -m benchmarks.bench_completion [--tasks N,N] [--width N] [--legacy]
+
+Each job is layered: every task depends on two tasks of the layer above.
+Runs don't start processes here; every task a run would start is
+completed at once, so this times only the run's bookkeeping. --legacy
+also times the previous bookkeeping, which scanned the graph for each
+downstream task's dependencies and the run log for unfinished tasks on
+every completion; it is quadratic, so keep task counts small.
+"""
+
+import time
+from optparse import OptionParser
+
+from dagobah.core.core import Dagobah, JobRun
+from dagobah.backend.base import BaseBackend
+from .common import report
+
+
+class BookkeepingRun(JobRun):
+    """ Queues the Tasks the run would start instead of starting them. """
+
+    def __init__(self, job):
+        super(BookkeepingRun, self).__init__(job)
+        self.ready = []
+
+    def _start_task(self, task_name):
+        self._put_task_in_run_log(task_name)
+        self.outstanding += 1
+        self.ready.append(task_name)
+
+
+class LegacyBookkeepingRun(BookkeepingRun):
+    """ Decides what to start and when the run is done the old way. """
+
+    def _complete_task(self, task_name, **kwargs):
+        self.run_log['tasks'][task_name] = kwargs
+        for node in self.snapshot.downstream[task_name]:
+            dependencies = self.job._dependencies(node, self.job.graph)
+            if all([self.run_log['tasks'].get(d, {}).get('success', False)
+                    for d in dependencies]):
+                self._put_task_in_run_log(node)
+                self.ready.append(node)
+        self._on_completion()
+
+    def _is_complete(self):
+        for log in self.run_log['tasks'].itervalues():
+            if 'success' not in log:
+                return False
+        return True
+
+
+class BookkeepingTask(object):
+    """ The parts of a Task a run copies. """
+
+    def __init__(self, name):
+        self.name = name
+        self.command = 'true'
+        self.soft_timeout = 0
+        self.hard_timeout = 0
+        self.hostname = None
+        self.cache = None
+
+
+def layered_job(num_tasks, width):
+    dagobah = Dagobah(BaseBackend())
+    dagobah.scheduler.stop()
+    dagobah.add_job('bench')
+    job = dagobah.get_job('bench')
+    names = ['task_%d' % i for i in range(num_tasks)]
+    job.graph = dict([(name, set()) for name in names])
+    for i in range(width, num_tasks):
+        layer_start = (i // width - 1) * width
+        for position in [i % width, (i + 1) % width]:
+            job.graph[names[layer_start + position]].add(names[i])
+    job.tasks = dict([(name, BookkeepingTask(name)) for name in names])
+    job._graph_changed()
+    return job
+
+
+def bench_run(job, run_class):
+    run = run_class(job)
+    job.runs.append(run)
+    start = time.time()
+    run.start()
+    completed = 0
+    while run.ready:
+        task_name = run.ready.pop()
+        run._complete_task(task_name, success=True)
+        completed += 1
+    elapsed = time.time() - start
+    assert completed == len(job.graph)
+    assert run.status == 'waiting'
+    return {'seconds': elapsed,
+            'us_per_completion': elapsed / completed * 1e6}
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--tasks', default='100,1000,10000,50000')
+    parser.add_option('--width', type='int', default=10)
+    parser.add_option('--legacy', action='store_true', default=False)
+    options, args = parser.parse_args()
+
+    results = {}
+    for num_tasks in [int(n) for n in options.tasks.split(',')]:
+        job = layered_job(num_tasks, options.width)
+        results['%d_tasks' % num_tasks] = {'counters': bench_run(job, BookkeepingRun)}
+        if options.legacy:
+            results['%d_tasks' % num_tasks]['legacy'] = bench_run(job, LegacyBookkeepingRun)
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
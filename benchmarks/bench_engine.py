@@ -0,0 +1,124 @@
+""" Measure the execution engine end to end on synthetic workloads.
+
+    python -m benchmarks.bench_engine [--workloads NAME:SIZE,...]
+        [--serializations N] [--save PATH] [--compare PATH]
+        [--tolerance F]
+
+Workloads are built from benchmarks/generators.py: chain, fan_out,
+diamonds, layered and many_small_jobs, each with a size. Every task runs
+"true", so a run's time is the engine's own overhead: starting
+processes, noticing they exited and committing the run log. For each
+workload this records how long importing its jobs takes, how long
+serializing the Dagobah takes, how long Job.start takes to return, the
+time for every run to finish per task and per level of the graph, and
+the backend writes made by each method while building and running.
+
+--save records the results as a JSON baseline. --compare reads one and
+exits with status 1 if any timing grew by more than --tolerance or any
+write count grew at all.
+"""
+
+import sys
+import json
+import time
+from optparse import OptionParser
+
+from dagobah.core.core import Dagobah
+from dagobah.backend.base import BaseBackend
+from .generators import WORKLOADS, depth
+from .common import timed, report, save_baseline, compare
+
+DEFAULT_WORKLOADS = 'chain:5,fan_out:50,diamonds:3,layered:30,many_small_jobs:20'
+
+
+class WriteCountingBackend(BaseBackend):
+    """ Counts the writes made through each backend method. """
+
+    def __init__(self):
+        super(WriteCountingBackend, self).__init__()
+        self.writes = {}
+
+    def _count(self, method):
+        self.writes[method] = self.writes.get(method, 0) + 1
+
+    def commit_dagobah(self, dagobah_json):
+        self._count('commit_dagobah')
+
+    def commit_job(self, job_json):
+        self._count('commit_job')
+
+    def commit_log(self, log_json):
+        self._count('commit_log')
+
+    def delete_job(self, job_name):
+        self._count('delete_job')
+
+    def take_writes(self):
+        writes, self.writes = self.writes, {}
+        return writes
+
+
+def bench_workload(specs, serializations):
+    backend = WriteCountingBackend()
+    dagobah = Dagobah(backend)
+    dagobah.scheduler.stop()
+    backend.take_writes()
+
+    documents = [json.dumps(spec) for spec in specs]
+    build_seconds = timed(lambda i: dagobah.add_job_from_json(documents[i]),
+                          len(documents))
+    build_writes = backend.take_writes()
+
+    serialize_seconds = timed(lambda i: dagobah._serialize(), serializations)
+
+    start_seconds = timed(lambda i: dagobah.jobs[i].start(), len(dagobah.jobs))
+    started = time.time()
+    while [job for job in dagobah.jobs if job.state.status == 'running']:
+        time.sleep(0.01)
+    run_seconds = time.time() - started + start_seconds
+    assert all([job.state.status == 'waiting' for job in dagobah.jobs])
+
+    num_tasks = sum([len(spec['tasks']) for spec in specs])
+    levels = max([depth(spec['dependencies']) for spec in specs])
+    return {'tasks': num_tasks,
+            'levels': levels,
+            'build_seconds': build_seconds,
+            'serialize_seconds': serialize_seconds / serializations,
+            'start_seconds': start_seconds / len(specs),
+            'run_seconds': run_seconds,
+            'run_seconds_per_task': run_seconds / num_tasks,
+            'run_seconds_per_level': run_seconds / levels,
+            'build_writes': build_writes,
+            'run_writes': backend.take_writes()}
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--workloads', default=DEFAULT_WORKLOADS)
+    parser.add_option('--serializations', type='int', default=100)
+    parser.add_option('--save', default=None)
+    parser.add_option('--compare', default=None)
+    parser.add_option('--tolerance', type='float', default=0.2)
+    options, args = parser.parse_args()
+
+    results = {}
+    for workload in options.workloads.split(','):
+        name, size = workload.split(':')
+        specs = WORKLOADS[name](int(size))
+        results[workload] = bench_workload(specs, options.serializations)
+    report(results)
+
+    if options.save:
+        save_baseline(results, options.save)
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, options.tolerance)
+        for key, old, new in regressions:
+            sys.stderr.write('REGRESSION %s: %s -> %s\n' % (key, old, new))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+""" Measure EventHandler.emit throughput with several handlers registered.
+
+    python -m benchmarks.bench_events [--events N] [--handlers N]
+"""
+
+from optparse import OptionParser
+
+from dagobah.core.components import EventHandler
+from .common import throughput, report
+
+TARGET_EVENTS_PER_SEC = 10000
+
+
+def no_params(calls):
+    calls.append(None)
+
+
+def with_params(calls, event_params):
+    calls.append(event_params)
+
+
+def with_kwargs(calls, **kwargs):
+    calls.append(kwargs)
+
+
+def bench_emit(num_events, num_handlers, workers):
+    handler = EventHandler(workers=workers, queue_size=num_events)
+    calls = []
+    methods = [no_params, with_params, with_kwargs]
+    for i in range(num_handlers):
+        handler.register('task_failed', methods[i % len(methods)], calls)
+
+    params = {'name': 'task', 'success': False}
+    rate = throughput(lambda i: handler.emit('task_failed', params),
+                      num_events)
+    handler.flush()
+    handler.stop()
+    assert len(calls) == num_events * num_handlers
+    return {'events_per_sec': rate,
+            'meets_target': rate >= TARGET_EVENTS_PER_SEC}
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--events', type='int', default=10000)
+    parser.add_option('--handlers', type='int', default=5)
+    options, args = parser.parse_args()
+
+    report({'inline': bench_emit(options.events, options.handlers, 0),
+            'queued': bench_emit(options.events, options.handlers, 2)})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+""" Measure the cost of preparing a Job's graph for a run.
+
+    python -m benchmarks.bench_plan [--tasks N,N] [--starts N] [--legacy]
+
+Each job is a chain of tasks loaded from a stored document. "compile" is
+the first get_plan after a graph change, "cached" the average cost of
+the get_plan made by each later start. --legacy also times the deepcopy
+and validate that every start used to make; its topological sort scans
+the graph for each node's dependencies, so keep task counts small.
+"""
+
+from copy import deepcopy
+from optparse import OptionParser
+
+from dagobah.core.core import Dagobah
+from .bench_startup import CountingBackend, make_rec
+from .common import timed, report
+
+
+def load_job(num_tasks):
+    rec = make_rec(1, num_tasks)
+    dagobah = Dagobah(CountingBackend(rec), dagobah_id=rec['dagobah_id'])
+    dagobah.scheduler.stop()
+    return dagobah.jobs[0]
+
+
+def bench_plan(job, starts):
+    job._graph_changed()
+    compile_seconds = timed(lambda i: job.get_plan())
+    cached_seconds = timed(lambda i: job.get_plan(), starts)
+    return {'compile_seconds': compile_seconds,
+            'cached_seconds_per_start': cached_seconds / starts}
+
+
+def bench_legacy(job):
+    def prepare(i):
+        snapshot = deepcopy(job.graph)
+        assert job.validate(snapshot)[0]
+    return {'seconds_per_start': timed(prepare)}
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--tasks', default='1000,10000')
+    parser.add_option('--starts', type='int', default=1000)
+    parser.add_option('--legacy', action='store_true', default=False)
+    options, args = parser.parse_args()
+
+    results = {}
+    for num_tasks in [int(n) for n in options.tasks.split(',')]:
+        job = load_job(num_tasks)
+        results['%d_tasks' % num_tasks] = {'plan': bench_plan(job, options.starts)}
+        if options.legacy:
+            results['%d_tasks' % num_tasks]['legacy'] = bench_legacy(job)
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+""" Measure how fast output of a remote Task is collected over SSH.
+
+    python -m benchmarks.bench_remote_output [--megabytes N] [--window S]
+
+A paramiko server on localhost stands in for the remote host: its exec
+requests write the given number of megabytes to the channel as fast as
+the channel accepts them. The collector drains the channel as data
+arrives. --window limits how long the legacy approach, which read 1024
+bytes from each stream per 2.5 second completion check, is given before
+its throughput is extrapolated; it would take hours to finish.
+"""
+
+import time
+import socket
+import threading
+from optparse import OptionParser
+
+import paramiko
+
+from dagobah.core.components import RemoteOutputCollector
+from .common import report
+
+CHUNK = 32768
+LEGACY_READ_SIZE = 1024
+LEGACY_INTERVAL = 2.5
+
+
+class StandInServer(paramiko.ServerInterface):
+    """ Accepts anyone and answers every exec with num_bytes of output. """
+
+    def __init__(self, num_bytes):
+        self.num_bytes = num_bytes
+        self.exec_event = threading.Event()
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        self.exec_event.set()
+        return True
+
+    def write(self, channel):
+        chunk = 'x' * CHUNK
+        sent = 0
+        try:
+            while sent < self.num_bytes:
+                channel.sendall(chunk[:self.num_bytes - sent])
+                sent += CHUNK
+            channel.send_exit_status(0)
+        finally:
+            channel.close()
+
+
+def start_server(num_bytes):
+    """ Serve one SSH connection on a free local port. Returns the port. """
+    host_key = paramiko.RSAKey.generate(1024)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+
+    def serve():
+        conn, addr = listener.accept()
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(host_key)
+        server = StandInServer(num_bytes)
+        transport.start_server(server=server)
+        channel = transport.accept()
+        # write once the exec request has been answered, not inside it
+        server.exec_event.wait()
+        time.sleep(0.1)
+        server.write(channel)
+        while transport.is_active():
+            time.sleep(0.1)
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return listener.getsockname()[1]
+
+
+def open_channel(num_bytes):
+    port = start_server(num_bytes)
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect('127.0.0.1', port=port, username='bench',
+                   password='bench', look_for_keys=False, allow_agent=False)
+    channel = client.get_transport().open_session()
+    channel.exec_command('output')
+    return client, channel
+
+
+def bench_collector(num_bytes):
+    collector = RemoteOutputCollector()
+    collector.start()
+    client, channel = open_channel(num_bytes)
+    start = time.time()
+    output = collector.add(channel)
+    while not output.complete:
+        time.sleep(0.01)
+    elapsed = time.time() - start
+    collector.stop()
+    client.close()
+
+    received = len(output.get_output()[0])
+    assert received == num_bytes, received
+    return {'seconds': elapsed, 'mb_per_second': received / elapsed / 2 ** 20}
+
+
+def bench_legacy(num_bytes, window):
+    client, channel = open_channel(num_bytes)
+    start = time.time()
+    received = 0
+    while time.time() - start < window and not channel.exit_status_ready():
+        if channel.recv_ready():
+            received += len(channel.recv(LEGACY_READ_SIZE))
+        if channel.recv_stderr_ready():
+            channel.recv_stderr(LEGACY_READ_SIZE)
+        time.sleep(min(LEGACY_INTERVAL, window))
+    elapsed = time.time() - start
+    client.close()
+    rate = received / elapsed
+    return {'mb_per_second': rate / 2 ** 20,
+            'estimated_seconds': num_bytes / rate if rate else None}
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--megabytes', type='int', default=64)
+    parser.add_option('--window', type='float', default=10)
+    options, args = parser.parse_args()
+
+    num_bytes = options.megabytes * 2 ** 20
+    report({'collector': bench_collector(num_bytes),
+            'legacy': bench_legacy(num_bytes, options.window)})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+""" Measure the cost of watching running Tasks for slowness.
+
+    python -m benchmarks.bench_slow_tasks [--tasks N,N] [--history N]
+
+Every task of a job with --history successful runs apiece starts at
+once; none of them have finished yet. This times tracking each start,
+the first check, which loads the job's thresholds and queues every
+deadline, and later checks where no deadline has passed, then those
+where every task is slow. Events go to an EventHandler with no hooks.
+"""
+
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+from dagobah.core.components import EventHandler, SlowTaskDetector
+from dagobah.backend.analytics import DurationSeries
+from .common import timed, report
+
+
+class HistoryBackend(object):
+    """ Serves history runs of one to two seconds for each task. """
+
+    def __init__(self, task_names, history):
+        self.task_series = {}
+        for name in task_names:
+            series = self.task_series[name] = DurationSeries()
+            for i in xrange(history):
+                series.append(i, 1 + i / float(history), True)
+
+    def get_duration_series(self, job_id, since):
+        return DurationSeries(), self.task_series
+
+
+class BenchDagobah(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+
+
+class BenchJob(object):
+
+    def __init__(self):
+        self.job_id = 'bench'
+        self.name = 'bench'
+
+
+class BenchTask(object):
+    """ The parts of a Task the detector looks at. """
+
+    def __init__(self, name, job, started_at, event_handler):
+        self.name = name
+        self.parent_job = job
+        self.started_at = started_at
+        self.completed_at = None
+        self.event_handler = event_handler
+
+    def _serialize(self):
+        return {'name': self.name}
+
+
+def bench(num_tasks, history, checks=100):
+    names = ['task_%d' % i for i in range(num_tasks)]
+    detector = SlowTaskDetector()
+    detector.parent = BenchDagobah(HistoryBackend(names, history))
+
+    job = BenchJob()
+    now = datetime.utcnow()
+    tasks = [BenchTask(name, job, now, EventHandler()) for name in names]
+
+    track_seconds = timed(lambda i: detector.track(tasks[i]), num_tasks)
+    first_check_seconds = timed(lambda i: detector.check(now))
+    idle_seconds = timed(lambda i: detector.check(now), checks)
+    later = now + timedelta(seconds=10)
+    due_seconds = timed(lambda i: detector.check(later))
+    assert not detector.deadlines
+
+    return {'us_per_track': track_seconds / num_tasks * 1e6,
+            'first_check_seconds': first_check_seconds,
+            'us_per_idle_check': idle_seconds / checks * 1e6,
+            'us_per_slow_task': due_seconds / num_tasks * 1e6}
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--tasks', default='100,1000,10000')
+    parser.add_option('--history', type='int', default=100)
+    options, args = parser.parse_args()
+
+    results = {}
+    for num_tasks in [int(n) for n in options.tasks.split(',')]:
+        results['%d_tasks' % num_tasks] = bench(num_tasks, options.history)
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+""" Measure how long a Dagobah takes to load its jobs from a backend.
+
+    python -m benchmarks.bench_startup [--jobs N,N] [--tasks N] [--legacy]
+
+A counting backend serves the stored document from memory, so this
+measures the cost of building Jobs and Tasks plus the writes made along
+the way. --legacy also times rebuilding each job through the public
+API, which commits on every step; this is slow for large job counts.
+"""
+
+import time
+from optparse import OptionParser
+
+from dagobah.core.core import Dagobah
+from dagobah.backend.base import BaseBackend
+from .common import report
+
+
+class CountingBackend(BaseBackend):
+    """ Serves one stored Dagobah document and counts writes. """
+
+    def __init__(self, rec):
+        super(CountingBackend, self).__init__()
+        self.rec = rec
+        self.writes = 0
+
+    def get_dagobah_json(self, dagobah_id):
+        return self.rec
+
+    def commit_dagobah(self, dagobah_json):
+        self.writes += 1
+
+    def commit_job(self, job_json):
+        self.writes += 1
+
+    def delete_dagobah(self, dagobah_id):
+        self.writes += 1
+
+
+def make_rec(num_jobs, num_tasks):
+    """ Returns a stored Dagobah whose jobs are chains of tasks. """
+    jobs = []
+    for i in range(num_jobs):
+        names = ['task_%d' % t for t in range(num_tasks)]
+        dependencies = dict([(name, []) for name in names])
+        for upstream, downstream in zip(names, names[1:]):
+            dependencies[upstream].append(downstream)
+        jobs.append({'job_id': 'job_%d' % i,
+                     'name': 'job_%d' % i,
+                     'parent_id': 'benchmark',
+                     'tasks': [{'command': 'true', 'name': name,
+                                'soft_timeout': 0, 'hard_timeout': 0,
+                                'hostname': None}
+                               for name in names],
+                     'dependencies': dependencies,
+                     'status': 'waiting',
+                     'cron_schedule': '*/5 * * * *' if i % 2 else None,
+                     'next_run': None,
+                     'notes': None})
+    return {'dagobah_id': 'benchmark', 'created_jobs': num_jobs, 'jobs': jobs}
+
+
+def bench_load(rec):
+    backend = CountingBackend(rec)
+    start = time.time()
+    dagobah = Dagobah(backend, dagobah_id=rec['dagobah_id'])
+    elapsed = time.time() - start
+    dagobah.scheduler.stop()
+    assert len(dagobah.jobs) == len(rec['jobs'])
+    return {'seconds': elapsed, 'writes': backend.writes}
+
+
+def bench_legacy(rec):
+    backend = CountingBackend(rec)
+    start = time.time()
+    dagobah = Dagobah(backend)
+    dagobah.scheduler.stop()
+    for job_json in rec['jobs']:
+        dagobah._add_job_from_spec(job_json)
+    dagobah.commit(cascade=True)
+    return {'seconds': time.time() - start, 'writes': backend.writes}
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--jobs', default='1000,10000')
+    parser.add_option('--tasks', type='int', default=5)
+    parser.add_option('--legacy', action='store_true', default=False)
+    options, args = parser.parse_args()
+
+    results = {}
+    for num_jobs in [int(n) for n in options.jobs.split(',')]:
+        rec = make_rec(num_jobs, options.tasks)
+        results['%d_jobs' % num_jobs] = {'load': bench_load(rec)}
+        if options.legacy:
+            results['%d_jobs' % num_jobs]['legacy'] = bench_legacy(rec)
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
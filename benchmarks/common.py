@@ -0,0 +1,66 @@
+""" Helpers shared by the benchmark modules. """
+
+import sys
+import json
+import time
+
+
+def timed(fn, iterations=1):
+    """ Call fn iterations times and return the elapsed wall time. """
+    start = time.time()
+    for i in xrange(iterations):
+        fn(i)
+    return time.time() - start
+
+
+def throughput(fn, iterations):
+    """ Returns operations per second of calling fn iterations times. """
+    elapsed = timed(fn, iterations)
+    return iterations / elapsed if elapsed else float('inf')
+
+
+def report(results, stream=sys.stdout):
+    """ Print benchmark results as sorted, indented JSON. """
+    stream.write(json.dumps(results, indent=2, sort_keys=True))
+    stream.write('\n')
+
+
+def flatten(results, prefix=''):
+    """ Returns {dotted.key: value} for every number in nested results. """
+    flat = {}
+    for key, value in results.iteritems():
+        name = prefix + key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def save_baseline(results, path):
+    """ Record results as a JSON baseline for later comparison. """
+    with open(path, 'w') as f:
+        report(results, f)
+
+
+def compare(results, baseline, tolerance=0.2, min_seconds=0.001):
+    """ Returns (key, baseline, current) for every regressed metric.
+
+    Every metric is taken to be better lower. Timings regress when they
+    grow by more than tolerance, and by at least min_seconds so that
+    noise on tiny timings is ignored; counts regress on any increase.
+    Metrics missing from either side are skipped.
+    """
+    current = flatten(results)
+    regressions = []
+    for key, old in sorted(flatten(baseline).items()):
+        new = current.get(key, None)
+        if new is None:
+            continue
+        if isinstance(old, float) or isinstance(new, float):
+            regressed = new > old * (1 + tolerance) and new - old >= min_seconds
+        else:
+            regressed = new > old
+        if regressed:
+            regressions.append((key, old, new))
+    return regressions
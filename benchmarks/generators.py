@@ -0,0 +1,85 @@
+""" Synthetic job graphs for the benchmarks.
+
+Each generator returns a dependencies dict mapping every task name to
+the names of the tasks that depend on it, as stored in a job spec.
+"""
+
+import random
+
+
+def _names(num_tasks):
+    return ['task_%d' % i for i in range(num_tasks)]
+
+
+def chain(num_tasks):
+    """ Each task depends on the one before it. """
+    names = _names(num_tasks)
+    dependencies = dict([(name, []) for name in names])
+    for upstream, downstream in zip(names, names[1:]):
+        dependencies[upstream].append(downstream)
+    return dependencies
+
+
+def fan_out(num_tasks):
+    """ One task that every other task depends on. """
+    names = _names(num_tasks)
+    dependencies = dict([(name, []) for name in names])
+    dependencies[names[0]] = names[1:]
+    return dependencies
+
+
+def diamonds(num_diamonds, width=2):
+    """ Diamonds stacked end to end: a task fans out to width tasks,
+    which all feed the next diamond's first task. """
+    names = _names(num_diamonds * (width + 1) + 1)
+    dependencies = dict([(name, []) for name in names])
+    for d in range(num_diamonds):
+        top = d * (width + 1)
+        bottom = top + width + 1
+        for middle in range(top + 1, bottom):
+            dependencies[names[top]].append(names[middle])
+            dependencies[names[middle]].append(names[bottom])
+    return dependencies
+
+
+def layered(num_tasks, width, edge_probability=0.3, seed=0):
+    """ Layers of width tasks; each task depends on a random set of
+    tasks in the layer above, and on at least one of them. """
+    rng = random.Random(seed)
+    names = _names(num_tasks)
+    dependencies = dict([(name, []) for name in names])
+    for i in range(width, num_tasks):
+        layer_start = (i // width - 1) * width
+        above = names[layer_start:layer_start + width]
+        parents = [name for name in above if rng.random() < edge_probability]
+        for parent in parents or [rng.choice(above)]:
+            dependencies[parent].append(names[i])
+    return dependencies
+
+
+def depth(dependencies):
+    """ Returns the number of tasks on the longest path through the graph. """
+    levels = dict([(name, 1) for name in dependencies])
+    # task_N only ever depends on lower numbers, so visit in that order
+    for name in sorted(dependencies, key=lambda n: int(n.split('_')[1])):
+        for downstream in dependencies[name]:
+            levels[downstream] = max(levels[downstream], levels[name] + 1)
+    return max(levels.values()) if levels else 0
+
+
+def job_spec(name, dependencies, command='true'):
+    """ Returns an importable job spec with one command for every task. """
+    return {'name': name,
+            'tasks': [{'command': command, 'name': task_name}
+                      for task_name in sorted(dependencies)],
+            'dependencies': dependencies}
+
+
+WORKLOADS = {
+    'chain': lambda size: [job_spec('chain', chain(size))],
+    'fan_out': lambda size: [job_spec('fan_out', fan_out(size))],
+    'diamonds': lambda size: [job_spec('diamonds', diamonds(size))],
+    'layered': lambda size: [job_spec('layered', layered(size, 10))],
+    'many_small_jobs': lambda size: [job_spec('small_%d' % i, chain(3))
+                                     for i in range(size)],
+}
@@ -0,0 +1,120 @@
+""" Duration and success statistics over a window of stored runs. """
+
+import calendar
+from array import array
+from datetime import datetime
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def to_epoch(dt):
+    """ Returns seconds since the epoch of a naive UTC datetime. """
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
+def percentile(ordered, q):
+    """ Returns the q-th percentile of sorted values, interpolating
+    between the closest ranks, or None if there are none. """
+    if not ordered:
+        return None
+    rank = (len(ordered) - 1) * q / 100.0
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+class DurationSeries(object):
+    """ Start times, durations and outcomes of finished runs.
+
+    Backends fill these from their stored run logs; each column is a
+    typed array, so long histories stay small and are summarized
+    without building a dict per run.
+    """
+
+    def __init__(self):
+        self.starts = array('d')
+        self.durations = array('d')
+        self.successes = array('b')
+
+
+    def __repr__(self):
+        return '<DurationSeries (runs: %d)>' % len(self.durations)
+
+
+    def __len__(self):
+        return len(self.durations)
+
+
+    def append(self, start, duration, success):
+        """ Add a run that started at start, in seconds since the epoch. """
+        self.starts.append(start)
+        self.durations.append(duration)
+        self.successes.append(1 if success else 0)
+
+
+    def stats(self, indexes=None):
+        """ Returns duration percentiles and the success rate of the runs,
+        or of those at indexes if given. """
+        if indexes is None:
+            durations, successes = self.durations, self.successes
+        else:
+            durations = [self.durations[i] for i in indexes]
+            successes = [self.successes[i] for i in indexes]
+
+        runs = len(durations)
+        ordered = sorted(durations)
+        result = {'runs': runs,
+                  'failures': runs - sum(successes),
+                  'success_rate': sum(successes) / float(runs) if runs else None,
+                  'min_duration': ordered[0] if runs else None,
+                  'max_duration': ordered[-1] if runs else None,
+                  'mean_duration': sum(ordered) / runs if runs else None}
+        for q in PERCENTILES:
+            result['p%d' % q] = percentile(ordered, q)
+        return result
+
+
+    def trend(self, since, until, buckets):
+        """ Returns stats for each of buckets equal slices of since to until. """
+        width = (until - since) / float(buckets)
+        members = [[] for i in range(buckets)]
+        for i, start in enumerate(self.starts):
+            if since <= start < until:
+                members[min(int((start - since) / width), buckets - 1)].append(i)
+
+        result = []
+        for b, indexes in enumerate(members):
+            stats = self.stats(indexes)
+            stats['start'] = datetime.utcfromtimestamp(since + b * width)
+            result.append(stats)
+        return result
+
+
+def _change(trend):
+    """ Returns how much the latest bucket's median moved against the
+    median of the buckets before it, e.g. 0.25 for 25% slower. """
+    filled = [stats for stats in trend if stats['runs']]
+    if len(filled) < 2:
+        return None
+    earlier = sorted([stats['p50'] for stats in filled[:-1]])
+    baseline = percentile(earlier, 50)
+    if not baseline:
+        return None
+    return filled[-1]['p50'] / baseline - 1
+
+
+def analyze(job_series, task_series, since, until, buckets):
+    """ Returns stats and a trend for a job's runs and for each of its tasks. """
+    since, until = to_epoch(since), to_epoch(until)
+
+    def describe(series):
+        result = series.stats()
+        result['trend'] = series.trend(since, until, buckets)
+        result['p50_change'] = _change(result['trend'])
+        return result
+
+    return {'since': datetime.utcfromtimestamp(since),
+            'until': datetime.utcfromtimestamp(until),
+            'job': describe(job_series),
+            'tasks': dict([(name, describe(series))
+                           for name, series in task_series.iteritems()])}
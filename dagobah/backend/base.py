@@ -1,12 +1,24 @@
 """ Base Backend class inherited by specific implementations. """
 
 import os
+import time
+import socket
 import binascii
 import json
 import logging
+import threading
+from datetime import datetime, timedelta
+from contextlib import contextmanager
 
 from semantic_version import Version
 
+from .analytics import DurationSeries
+
+logger = logging.getLogger('dagobah')
+
+GLOBAL_LOCK = 'global'
+LOCK_POLL_INTERVAL = 0.05
+
 class BaseBackend(object):
     """ Base class for prototypes and compound functions.
 
@@ -21,8 +33,26 @@ class BaseBackend(object):
     # Keys: pypi_name, module_name, version_key, spec_version
     required_packages = []
 
+    # if True, locks are also held as leases in the backend so that
+    # they exclude other processes sharing it; clustered nodes set this
+    distributed_locks = False
+    lock_ttl = 30
+
     def __init__(self):
         self.verify_required_packages()
+        self.retention_policy = None
+
+        # leases and node heartbeats only live as long as this instance
+        self.leases = {}
+        self.nodes = {}
+        self.lease_lock = threading.Lock()
+
+        self.locks = {}
+        self.lock_metrics = {}
+        self.held_leases = set()
+        self.held_leases_lock = threading.Lock()
+        self.lock_owner = '%s:%d:%s' % (socket.gethostname(), os.getpid(),
+                                        binascii.hexlify(os.urandom(4)))
 
 
     def __repr__(self):
@@ -79,6 +109,12 @@ class BaseBackend(object):
         return
 
 
+    def get_jobs_json(self, dagobah_id):
+        """ Returns the stored Jobs of a Dagobah, or None if this backend
+        doesn't store them on their own. """
+        return None
+
+
     def decode_import_json(self, json_doc, transformers=None):
         """ Decode a JSON string based on a list of transformers.
 
@@ -156,9 +192,193 @@ class BaseBackend(object):
         return {}
 
 
-    def acquire_lock(self):
-        return
+    def get_run_log_history(self, job_id, task_name, limit=10):
+        return []
 
 
-    def release_lock(self):
-        return
+    def get_run_log(self, job_id, task_name, log_id):
+        return {}
+
+
+    def get_job_run_log(self, job_id, log_id=None):
+        """ Returns a job's whole run log, or its latest if log_id is None. """
+        return {}
+
+
+    def get_cached_run(self, job_id, task_name, cache_key):
+        """ Returns the Task's log from its latest successful run with
+        this cache key, or None if there is none. """
+        return None
+
+
+    @contextmanager
+    def transaction(self):
+        """ Group the writes made within this block, where supported. """
+        yield
+
+
+    def set_retention_policy(self, policy):
+        """ Set the RetentionPolicy enforced by compact_run_logs. """
+        self.retention_policy = policy
+
+
+    def compact_run_logs(self):
+        """ Summarize and remove expired run logs.
+
+        Returns the number of run logs removed.
+        """
+        return 0
+
+
+    def get_run_log_summary(self, job_id):
+        return {}
+
+
+    def get_duration_series(self, job_id, since):
+        """ Returns DurationSeries of a job's finished runs that started
+        after since, and of each of its tasks as {task name: series}. """
+        return DurationSeries(), {}
+
+
+    def commit_scheduler_state(self, dagobah_id, state):
+        pass
+
+
+    def get_scheduler_state(self, dagobah_id):
+        return None
+
+
+    def acquire_lease(self, name, owner, ttl):
+        """ Take or renew the named lease for ttl seconds.
+
+        Returns Boolean of whether owner now holds the lease. A lease
+        held by another owner can only be taken once it has expired.
+        """
+        now = datetime.utcnow()
+        with self.lease_lock:
+            current = self.leases.get(name, None)
+            if current and current[0] != owner and current[1] > now:
+                return False
+            self.leases[name] = (owner, now + timedelta(seconds=ttl))
+            return True
+
+
+    def release_lease(self, name, owner):
+        """ Give up the named lease if owner holds it. """
+        with self.lease_lock:
+            if self.leases.get(name, (None,))[0] == owner:
+                del self.leases[name]
+
+
+    def heartbeat(self, node_id, ttl):
+        """ Record that this node is alive for the next ttl seconds. """
+        with self.lease_lock:
+            self.nodes[node_id] = datetime.utcnow() + timedelta(seconds=ttl)
+
+
+    def unregister_node(self, node_id):
+        with self.lease_lock:
+            self.nodes.pop(node_id, None)
+
+
+    def get_live_nodes(self):
+        """ Returns the IDs of nodes whose heartbeat hasn't expired. """
+        now = datetime.utcnow()
+        with self.lease_lock:
+            return sorted([node_id for node_id, expires_at
+                           in self.nodes.iteritems() if expires_at > now])
+
+
+    def _get_lock(self, key):
+        with self.lease_lock:
+            if key not in self.locks:
+                self.locks[key] = threading.Lock()
+                self.lock_metrics[key] = {'acquisitions': 0,
+                                          'contended': 0,
+                                          'total_wait': 0.0,
+                                          'max_wait': 0.0}
+            return self.locks[key], self.lock_metrics[key]
+
+
+    def acquire_lock(self, key=None):
+        """ Block until the caller holds the lock for key.
+
+        Locks are keyed so that, e.g., work on different jobs never
+        contends. Without a key, the global lock is used. Locks are not
+        reentrant. With distributed_locks, the lock is also taken as a
+        lease in the backend, which expires after lock_ttl seconds unless
+        renew_locks is called while it's held.
+        """
+        key = str(key if key is not None else GLOBAL_LOCK)
+        lock, metrics = self._get_lock(key)
+
+        started = time.time()
+        contended = not lock.acquire(False)
+        if contended:
+            lock.acquire()
+
+        if self.distributed_locks:
+            while not self.acquire_lease('lock:' + key, self.lock_owner,
+                                         self.lock_ttl):
+                contended = True
+                time.sleep(LOCK_POLL_INTERVAL)
+            with self.held_leases_lock:
+                self.held_leases.add(key)
+
+        waited = time.time() - started
+        with self.lease_lock:
+            metrics['acquisitions'] += 1
+            metrics['total_wait'] += waited
+            if contended:
+                metrics['contended'] += 1
+            if waited > metrics['max_wait']:
+                metrics['max_wait'] = waited
+
+
+    def release_lock(self, key=None):
+        key = str(key if key is not None else GLOBAL_LOCK)
+        lock, metrics = self._get_lock(key)
+        if self.distributed_locks:
+            with self.held_leases_lock:
+                self.held_leases.discard(key)
+                self.release_lease('lock:' + key, self.lock_owner)
+        lock.release()
+
+
+    def renew_locks(self):
+        """ Renew the lease of every distributed lock this process holds.
+
+        Returns the keys whose lease had expired and been taken by
+        another owner, which no longer exclude it.
+        """
+        lost = []
+        with self.held_leases_lock:
+            for key in sorted(self.held_leases):
+                if not self.acquire_lease('lock:' + key, self.lock_owner,
+                                          self.lock_ttl):
+                    logger.error('Lost the backend lock for {0} to another '
+                                 'owner while holding it'.format(key))
+                    lost.append(key)
+        return lost
+
+
+    @contextmanager
+    def lock(self, key=None):
+        """ Hold the lock for key for the duration of this block. """
+        self.acquire_lock(key)
+        try:
+            yield
+        finally:
+            self.release_lock(key)
+
+
+    def get_lock_metrics(self):
+        """ Returns contention stats for each lock key. """
+        results = {}
+        with self.lease_lock:
+            for key, metrics in self.lock_metrics.iteritems():
+                results[key] = dict(metrics)
+                results[key]['avg_wait'] = (metrics['total_wait'] /
+                                            metrics['acquisitions']
+                                            if metrics['acquisitions'] else 0.0)
+        return results
@@ -0,0 +1,71 @@
+""" Backend wrapper that reports the latency of every call. """
+
+import time
+import functools
+
+# lock waits and helpers that never touch storage aren't backend latency
+UNTIMED_METHODS = ['lock', 'acquire_lock', 'release_lock', 'renew_locks',
+                   'transaction', 'get_lock_metrics', 'verify_required_packages',
+                   'decode_import_json']
+
+
+class InstrumentedBackend(object):
+    """ Wraps a Backend, timing its public methods.
+
+    Call latencies go to DagobahMetrics if given. Given a Tracer, calls
+    made within a traced step of a run are recorded as spans of it.
+    Everything else, including attribute assignment, is passed through
+    to the wrapped Backend, so this can stand in for it anywhere.
+    """
+
+    def __init__(self, backend, metrics=None, tracer=None):
+        self.__dict__['backend'] = backend
+        self.__dict__['metrics'] = metrics
+        self.__dict__['tracer'] = tracer
+        self.__dict__['methods'] = {}
+
+
+    def __repr__(self):
+        return '<InstrumentedBackend %r>' % self.backend
+
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if (name.startswith('_') or name in UNTIMED_METHODS or
+            not callable(attr)):
+            return attr
+        method = self.methods.get(name, None)
+        if method is None:
+            method = self.methods[name] = self._timed(name)
+        return method
+
+
+    def __setattr__(self, name, value):
+        setattr(self.backend, name, value)
+
+
+    def _timed(self, name):
+        metrics = self.metrics
+        tracer = self.tracer
+        method = getattr(self.backend, name)
+
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            span = None
+            if tracer and tracer.current():
+                span = tracer.start_span('backend.' + name)
+            start = time.time()
+            try:
+                return method(*args, **kwargs)
+            except Exception as e:
+                if metrics:
+                    metrics.backend_errors.inc(1, name)
+                if span:
+                    span.set(error=type(e).__name__)
+                raise
+            finally:
+                if metrics:
+                    metrics.backend_latency.observe(time.time() - start, name)
+                if span:
+                    span.finish()
+        return timed
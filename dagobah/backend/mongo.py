@@ -1,10 +1,11 @@
 """ Mongo Backend class built on top of base Backend """
 
-from datetime import datetime
+from datetime import datetime, timedelta
 import re
 import json
 
 import pymongo
+from pymongo.errors import OperationFailure
 try:
     from pymongo import MongoClient
 except ImportError:
@@ -17,10 +18,14 @@ except ImportError:
 
 from dateutil import parser
 from ..backend.base import BaseBackend
+from ..backend.retention import summarize_run_logs
+from ..backend.analytics import DurationSeries, to_epoch
 
 TRUNCATE_LOG_SIZES_CHAR = {'stdout': 500000,
                            'stderr': 500000}
 
+COMPACTION_BATCH_SIZE = 500
+
 
 class MongoBackend(BaseBackend):
     """ Mongo Backend implementation """
@@ -29,8 +34,13 @@ class MongoBackend(BaseBackend):
                           'version_key': 'version',
                           'version': '2.5'}]
 
+
     def __init__(self, host, port, db, dagobah_collection='dagobah',
-                 job_collection='dagobah_job', log_collection='dagobah_log'):
+                 job_collection='dagobah_job', log_collection='dagobah_log',
+                 summary_collection='dagobah_log_summary',
+                 scheduler_collection='dagobah_scheduler',
+                 lease_collection='dagobah_lease',
+                 node_collection='dagobah_node'):
         super(MongoBackend, self).__init__()
 
         self.host = host
@@ -47,8 +57,18 @@ class MongoBackend(BaseBackend):
         self.dagobah_coll = self.db[dagobah_collection]
         self.job_coll = self.db[job_collection]
         self.log_coll = self.db[log_collection]
+        self.summary_coll = self.db[summary_collection]
+        self.scheduler_coll = self.db[scheduler_collection]
+        self.lease_coll = self.db[lease_collection]
+        self.node_coll = self.db[node_collection]
 
         self.log_coll.ensure_index("save_date")
+        self.log_coll.ensure_index([('job_id', pymongo.ASCENDING),
+                                    ('save_date', pymongo.DESCENDING)])
+
+        # documents without an expire_at field are never expired by Mongo
+        self.log_coll.ensure_index("expire_at", expireAfterSeconds=0)
+        self.node_coll.ensure_index("expires_at")
 
     def __repr__(self):
         return '<MongoBackend (host: %s, port: %s)>' % (self.host, self.port)
@@ -80,6 +100,10 @@ class MongoBackend(BaseBackend):
     def get_dagobah_json(self, dagobah_id):
         return self.dagobah_coll.find_one({'_id': dagobah_id})
 
+    def get_jobs_json(self, dagobah_id):
+        cur = self.job_coll.find({'parent_id': dagobah_id})
+        return list(cur.sort([('_id', pymongo.ASCENDING)]))
+
     def decode_import_json(self, json_doc):
         def is_object_id(o):
             return (re.match(re.compile('^[0-9a-fA-f]{24}$'), o) is not None)
@@ -99,11 +123,11 @@ class MongoBackend(BaseBackend):
         Related run logs are deleted as well.
         """
 
-        rec = self.dagobah_coll.find_one({'_id': dagobah_id})
-        for job in rec.get('jobs', []):
-            if 'job_id' in job:
-                self.delete_job(job['job_id'])
+        for job in self.job_coll.find({'parent_id': dagobah_id},
+                                      fields=['_id']):
+            self.delete_job(job['_id'])
         self.log_coll.remove({'parent_id': dagobah_id})
+        self.scheduler_coll.remove({'_id': dagobah_id})
         self.dagobah_coll.remove({'_id': dagobah_id})
 
     def commit_job(self, job_json):
@@ -113,6 +137,7 @@ class MongoBackend(BaseBackend):
 
     def delete_job(self, job_id):
         self.job_coll.remove({'_id': job_id})
+        self.scheduler_coll.remove({'_id': job_id})
 
     def commit_log(self, log_json):
         """ Commits a run log to the Mongo backend.
@@ -125,6 +150,11 @@ class MongoBackend(BaseBackend):
         log_json['_id'] = log_json['log_id']
         append = {'save_date': datetime.utcnow()}
 
+        if self.retention_policy:
+            ttl = self.retention_policy.ttl(log_json)
+            if ttl is not None:
+                append['expire_at'] = append['save_date'] + ttl
+
         for task_name, values in log_json.get('tasks', {}).items():
             for key, size in TRUNCATE_LOG_SIZES_CHAR.iteritems():
                 if isinstance(values.get(key, None), str):
@@ -154,3 +184,187 @@ class MongoBackend(BaseBackend):
              'tasks.%s' % task_name: {'$exists': True},
              'log_id': ObjectId(log_id)}
         return self.log_coll.find_one(q)['tasks'][task_name]
+
+    def get_job_run_log(self, job_id, log_id=None):
+        q = {'job_id': ObjectId(job_id)}
+        if log_id is not None:
+            q['log_id'] = ObjectId(log_id)
+        cur = self.log_coll.find(q).sort([('save_date', pymongo.DESCENDING)])
+        for rec in cur.limit(1):
+            return rec
+        return {}
+
+    def get_cached_run(self, job_id, task_name, cache_key):
+        q = {'job_id': ObjectId(job_id),
+             'tasks.%s.cache_key' % task_name: cache_key,
+             'tasks.%s.success' % task_name: True}
+        cur = self.log_coll.find(q).sort([('save_date',
+                                           pymongo.DESCENDING)]).limit(1)
+        for rec in cur:
+            return rec['tasks'][task_name]
+        return None
+
+    def compact_run_logs(self):
+        """ Roll expired run logs into per-job summaries and remove them.
+
+        For each job, the keep_runs most recent run logs are skipped
+        using the (job_id, save_date) index, and only run logs older
+        than the policy's smallest horizon are fetched as candidates.
+        """
+
+        policy = self.retention_policy
+        if not policy or not policy.is_enabled():
+            return 0
+
+        now = datetime.utcnow()
+        removed = 0
+
+        for job_id in self.log_coll.distinct('job_id'):
+            q = {'job_id': job_id}
+
+            if policy.keep_runs:
+                cur = self.log_coll.find(q, fields=['save_date'])\
+                    .sort([('save_date', pymongo.DESCENDING)])\
+                    .skip(policy.keep_runs - 1).limit(1)
+                boundary = [rec['save_date'] for rec in cur]
+                if not boundary:
+                    continue
+                q['save_date'] = {'$lt': boundary[0]}
+
+            min_horizon = policy.min_horizon()
+            if min_horizon is not None:
+                cutoff = now - min_horizon
+                if 'save_date' in q:
+                    cutoff = min(cutoff, q['save_date']['$lt'])
+                q['save_date'] = {'$lt': cutoff}
+
+            expired = []
+            cur = self.log_coll.find(q).sort([('save_date', pymongo.DESCENDING)])
+            for rec in cur:
+                # everything matched is already past the keep_runs boundary
+                if policy.is_expired(rec, policy.keep_runs or 0, now):
+                    expired.append(rec)
+                if len(expired) >= COMPACTION_BATCH_SIZE:
+                    removed += self._compact_batch(job_id, expired)
+                    expired = []
+            if expired:
+                removed += self._compact_batch(job_id, expired)
+
+        return removed
+
+    def _compact_batch(self, job_id, logs):
+        summary = self.summary_coll.find_one({'_id': job_id})
+        summary = summarize_run_logs(job_id, logs, summary)
+        summary['_id'] = job_id
+        summary['save_date'] = datetime.utcnow()
+        self.summary_coll.save(summary)
+        self.log_coll.remove({'_id': {'$in': [log['_id'] for log in logs]}})
+        return len(logs)
+
+    def get_run_log_summary(self, job_id):
+        return self.summary_coll.find_one({'_id': ObjectId(job_id)}) or {}
+
+    def _aggregate(self, pipeline, batch_size=None):
+        """ Runs an aggregation pipeline on the run logs.
+
+        The command is sent with a cursor, which MongoDB 3.6 and later
+        require but older drivers such as pymongo 2.x don't ask for, and
+        the remaining batches are fetched with getMore.
+        """
+        cursor = {'batchSize': batch_size} if batch_size else {}
+        reply = self.db.command('aggregate', self.log_coll.name,
+                                pipeline=pipeline, cursor=cursor)['cursor']
+        results = list(reply['firstBatch'])
+        while reply['id']:
+            more = {'batchSize': batch_size} if batch_size else {}
+            reply = self.db.command('getMore', long(reply['id']),
+                                    collection=self.log_coll.name,
+                                    **more)['cursor']
+            results.extend(reply['nextBatch'])
+        return results
+
+    def get_duration_series(self, job_id, since):
+        """ Task rows are unwound and timed by aggregation pipelines,
+        so only start times, durations and outcomes leave the server.
+        Needs MongoDB 3.6 or later for $objectToArray and $expr.
+        """
+        task_rows = [{'$match': {'job_id': ObjectId(job_id),
+                                 'save_date': {'$gte': since}}},
+                     {'$project': {'task': {'$objectToArray': '$tasks'}}},
+                     {'$unwind': '$task'},
+                     {'$match': {'task.v.start_time': {'$gte': since}}}]
+        done = {'$eq': [{'$type': '$task.v.complete_time'}, 'date']}
+
+        job_series = DurationSeries()
+        for rec in self._aggregate(task_rows + [
+                {'$group': {'_id': '$_id',
+                            'start': {'$min': '$task.v.start_time'},
+                            'complete': {'$max': '$task.v.complete_time'},
+                            'success': {'$min': '$task.v.success'},
+                            'pending': {'$sum': {'$cond': [done, 0, 1]}}}},
+                {'$match': {'pending': 0}},
+                {'$project': {'start': 1, 'success': 1,
+                              'duration': {'$subtract': ['$complete', '$start']}}},
+                {'$sort': {'start': 1}}]):
+            job_series.append(to_epoch(rec['start']), rec['duration'] / 1000.0,
+                              rec['success'])
+
+        task_series = {}
+        for rec in self._aggregate(task_rows + [
+                {'$match': {'$expr': done}},
+                {'$project': {'_id': 0,
+                              'name': '$task.k',
+                              'start': '$task.v.start_time',
+                              'success': '$task.v.success',
+                              'duration': {'$subtract': ['$task.v.complete_time',
+                                                         '$task.v.start_time']}}},
+                {'$sort': {'start': 1}}]):
+            if rec['name'] not in task_series:
+                task_series[rec['name']] = DurationSeries()
+            task_series[rec['name']].append(to_epoch(rec['start']),
+                                             rec['duration'] / 1000.0,
+                                             rec['success'])
+
+        return job_series, task_series
+
+    def commit_scheduler_state(self, dagobah_id, state):
+        state = dict(state.items() + [('_id', dagobah_id)])
+        self.scheduler_coll.save(state)
+
+    def get_scheduler_state(self, dagobah_id):
+        return self.scheduler_coll.find_one({'_id': dagobah_id})
+
+    def acquire_lease(self, name, owner, ttl):
+        """ Take or renew a lease through a single findAndModify.
+
+        The upsert only matches a lease this owner already holds or one
+        that has expired. If another owner holds a live lease, the upsert
+        collides with its _id and the lease is not taken.
+        """
+        now = datetime.utcnow()
+        try:
+            self.lease_coll.find_and_modify({'_id': name,
+                                             '$or': [{'owner': owner},
+                                                     {'expires_at': {'$lt': now}}]},
+                                            {'$set': {'owner': owner,
+                                                      'expires_at': now + timedelta(seconds=ttl)}},
+                                            upsert=True, new=True)
+        except OperationFailure as e:
+            if e.code in [11000, 11001] or 'duplicate key' in str(e):
+                return False
+            raise
+        return True
+
+    def release_lease(self, name, owner):
+        self.lease_coll.remove({'_id': name, 'owner': owner})
+
+    def heartbeat(self, node_id, ttl):
+        self.node_coll.save({'_id': node_id,
+                             'expires_at': datetime.utcnow() + timedelta(seconds=ttl)})
+
+    def unregister_node(self, node_id):
+        self.node_coll.remove({'_id': node_id})
+
+    def get_live_nodes(self):
+        return sorted([rec['_id'] for rec in
+                       self.node_coll.find({'expires_at': {'$gt': datetime.utcnow()}})])
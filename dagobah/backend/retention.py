@@ -0,0 +1,246 @@
+""" Run log retention policies and the background compactor. """
+
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+
+logger = logging.getLogger('dagobah')
+
+
+class RetentionPolicy(object):
+    """ Describes which run logs a backend should keep around.
+
+    A run log is kept if it is one of the keep_runs most recent runs
+    of its job, or if it is younger than keep_days (keep_failed_days
+    for runs in which any task failed). A horizon of None means that
+    class of run logs never ages out. Expired run logs are rolled up
+    into per-job summaries by the compactor before they are removed.
+    """
+
+    def __init__(self, keep_runs=None, keep_days=None, keep_failed_days=None,
+                 compact_interval=3600):
+        for name, value in [('keep_runs', keep_runs),
+                            ('keep_days', keep_days),
+                            ('keep_failed_days', keep_failed_days),
+                            ('compact_interval', compact_interval)]:
+            if value is not None and (not isinstance(value, (int, float))
+                                      or value < 0):
+                raise ValueError('%s must be a non-negative number' % name)
+
+        self.keep_runs = keep_runs
+        self.keep_days = keep_days
+        self.keep_failed_days = keep_failed_days
+        self.compact_interval = compact_interval
+
+
+    def __repr__(self):
+        return ('<RetentionPolicy (runs: %s, days: %s, failed days: %s)>'
+                % (self.keep_runs, self.keep_days, self.keep_failed_days))
+
+
+    def is_enabled(self):
+        return (self.keep_runs is not None or
+                self.keep_days is not None or
+                self.keep_failed_days is not None)
+
+
+    def horizon(self, log_json):
+        """ Returns the age after which this run log may expire, or None. """
+        if run_failed(log_json) and self.keep_failed_days is not None:
+            return timedelta(days=self.keep_failed_days)
+        if self.keep_days is not None:
+            return timedelta(days=self.keep_days)
+        return None
+
+
+    def min_horizon(self):
+        """ Returns the smallest age at which any run log may expire.
+
+        Returns None if some run logs can expire at any age, which is
+        the case when only keep_runs governs part of the history.
+        """
+        days = [d for d in [self.keep_days, self.keep_failed_days]
+                if d is not None]
+        if self.keep_days is None and self.keep_runs is not None:
+            return None
+        if not days:
+            return None
+        return timedelta(days=min(days))
+
+
+    def ttl(self, log_json):
+        """ Returns the lifetime to enforce through a TTL index, or None.
+
+        Count-based retention can't be expressed as a TTL, so this only
+        applies to purely age-based policies. The compactor gets a grace
+        period of two compaction intervals to summarize the run log first.
+        """
+        if self.keep_runs is not None:
+            return None
+        horizon = self.horizon(log_json)
+        if horizon is None:
+            return None
+        return horizon + timedelta(seconds=2 * (self.compact_interval or 0))
+
+
+    def is_expired(self, log_json, rank, now=None):
+        """ Returns Boolean of whether this run log should be compacted.
+
+        rank is the position of the run log in its job's history,
+        with 0 being the most recent run.
+        """
+        if self.keep_runs is not None and rank < self.keep_runs:
+            return False
+
+        horizon = self.horizon(log_json)
+        if horizon is None:
+            return self.keep_runs is not None
+
+        now = now or datetime.utcnow()
+        save_date = log_json.get('save_date', None)
+        if not isinstance(save_date, datetime):
+            return False
+        return save_date < now - horizon
+
+
+def run_failed(log_json):
+    """ Returns Boolean of whether any task in this run log failed. """
+    for task_log in log_json.get('tasks', {}).itervalues():
+        if task_log.get('success', True) == False:
+            return True
+    return False
+
+
+def _duration(start, end):
+    if not isinstance(start, datetime) or not isinstance(end, datetime):
+        return None
+    delta = end - start
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+def _merge_duration(stats, duration):
+    if duration is None:
+        return
+    stats['total_duration'] += duration
+    stats['timed_runs'] += 1
+    if stats['min_duration'] is None or duration < stats['min_duration']:
+        stats['min_duration'] = duration
+    if stats['max_duration'] is None or duration > stats['max_duration']:
+        stats['max_duration'] = duration
+
+
+def _new_stats():
+    return {'runs': 0,
+            'failures': 0,
+            'success_rate': None,
+            'timed_runs': 0,
+            'total_duration': 0.0,
+            'min_duration': None,
+            'max_duration': None}
+
+
+def _finish_stats(stats):
+    if stats['runs']:
+        stats['success_rate'] = (stats['runs'] - stats['failures']) / float(stats['runs'])
+
+
+def summarize_run_logs(job_id, logs, summary=None):
+    """ Roll run logs up into a compact per-job summary.
+
+    If an existing summary is given, the run logs are merged into it.
+    Tasks are kept as a list since task names may not be valid keys
+    in every backend. Return codes are keyed by their string value.
+    """
+
+    if not summary:
+        summary = _new_stats()
+        summary.update({'job_id': job_id,
+                        'first_run': None,
+                        'last_run': None,
+                        'tasks': []})
+
+    tasks = dict([(task['name'], task) for task in summary['tasks']])
+
+    for log in logs:
+        summary['runs'] += 1
+        if run_failed(log):
+            summary['failures'] += 1
+
+        start = log.get('start_time', None)
+        if isinstance(start, datetime):
+            if summary['first_run'] is None or start < summary['first_run']:
+                summary['first_run'] = start
+            if summary['last_run'] is None or start > summary['last_run']:
+                summary['last_run'] = start
+
+        completions = [t.get('complete_time', None)
+                       for t in log.get('tasks', {}).itervalues()]
+        completions = [c for c in completions if isinstance(c, datetime)]
+        if completions:
+            _merge_duration(summary, _duration(start, max(completions)))
+
+        for task_name, task_log in log.get('tasks', {}).iteritems():
+            if task_name not in tasks:
+                tasks[task_name] = _new_stats()
+                tasks[task_name].update({'name': task_name,
+                                         'return_codes': {}})
+                summary['tasks'].append(tasks[task_name])
+            stats = tasks[task_name]
+
+            stats['runs'] += 1
+            if task_log.get('success', None) == False:
+                stats['failures'] += 1
+            _merge_duration(stats, _duration(task_log.get('start_time', None),
+                                             task_log.get('complete_time', None)))
+            if 'return_code' in task_log:
+                code = str(task_log['return_code'])
+                stats['return_codes'][code] = stats['return_codes'].get(code, 0) + 1
+
+    _finish_stats(summary)
+    for stats in summary['tasks']:
+        _finish_stats(stats)
+    return summary
+
+
+class LogCompactor(threading.Thread):
+    """ Background thread that periodically enforces a RetentionPolicy.
+
+    If is_active is given, passes are skipped while it returns False,
+    e.g. on nodes that aren't the cluster leader.
+    """
+
+    def __init__(self, backend, interval=None, is_active=None):
+        super(LogCompactor, self).__init__()
+        self.backend = backend
+        self.interval = (interval
+                         if interval is not None
+                         else backend.retention_policy.compact_interval)
+        self.is_active = is_active
+        self.daemon = True
+        self._stop_event = threading.Event()
+
+
+    def __repr__(self):
+        return '<LogCompactor for %s>' % self.backend
+
+
+    def stop(self):
+        """ Stop the compaction loop after the current pass. """
+        self._stop_event.set()
+
+
+    def run(self):
+        while not self._stop_event.is_set():
+            if self.is_active and not self.is_active():
+                self._stop_event.wait(self.interval)
+                continue
+            started = time.time()
+            try:
+                removed = self.backend.compact_run_logs()
+                if removed:
+                    logger.info('Compacted {0} run logs in {1:.2f}s'.format(removed,
+                                                                            time.time() - started))
+            except Exception:
+                logger.exception('Error compacting run logs')
+            self._stop_event.wait(self.interval)
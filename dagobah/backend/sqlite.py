@@ -0,0 +1,427 @@
+""" SQLite Backend class built on top of base Backend """
+
+import os
+import json
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+
+from ..backend.base import BaseBackend
+from ..backend.retention import summarize_run_logs
+from ..backend.analytics import DurationSeries
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+SCHEMA = ["""CREATE TABLE IF NOT EXISTS dagobah (
+                 id TEXT PRIMARY KEY,
+                 save_date TEXT NOT NULL,
+                 doc TEXT NOT NULL)""",
+          """CREATE TABLE IF NOT EXISTS dagobah_job (
+                 id TEXT PRIMARY KEY,
+                 parent_id TEXT,
+                 save_date TEXT NOT NULL,
+                 doc TEXT NOT NULL)""",
+          """CREATE INDEX IF NOT EXISTS dagobah_job_parent
+                 ON dagobah_job (parent_id)""",
+          """CREATE TABLE IF NOT EXISTS dagobah_log (
+                 id TEXT PRIMARY KEY,
+                 job_id TEXT,
+                 parent_id TEXT,
+                 save_date TEXT NOT NULL,
+                 doc TEXT NOT NULL)""",
+          """CREATE INDEX IF NOT EXISTS dagobah_log_job
+                 ON dagobah_log (job_id, save_date)""",
+          """CREATE INDEX IF NOT EXISTS dagobah_log_parent
+                 ON dagobah_log (parent_id)""",
+          """CREATE TABLE IF NOT EXISTS dagobah_log_task (
+                 log_id TEXT NOT NULL,
+                 job_id TEXT,
+                 task_name TEXT NOT NULL,
+                 save_date TEXT NOT NULL,
+                 success INTEGER,
+                 return_code INTEGER,
+                 start_time TEXT,
+                 complete_time TEXT,
+                 cache_key TEXT,
+                 PRIMARY KEY (log_id, task_name))""",
+          """CREATE INDEX IF NOT EXISTS dagobah_log_task_lookup
+                 ON dagobah_log_task (job_id, task_name, save_date)""",
+          """CREATE INDEX IF NOT EXISTS dagobah_log_task_cache
+                 ON dagobah_log_task (job_id, task_name, cache_key)""",
+          """CREATE TABLE IF NOT EXISTS dagobah_log_summary (
+                 job_id TEXT PRIMARY KEY,
+                 save_date TEXT NOT NULL,
+                 doc TEXT NOT NULL)""",
+          """CREATE TABLE IF NOT EXISTS dagobah_scheduler (
+                 dagobah_id TEXT PRIMARY KEY,
+                 save_date TEXT NOT NULL,
+                 doc TEXT NOT NULL)""",
+          """CREATE TABLE IF NOT EXISTS dagobah_lease (
+                 name TEXT PRIMARY KEY,
+                 owner TEXT NOT NULL,
+                 expires_at TEXT NOT NULL)""",
+          """CREATE TABLE IF NOT EXISTS dagobah_node (
+                 id TEXT PRIMARY KEY,
+                 expires_at TEXT NOT NULL)"""]
+
+
+def _format_date(dt):
+    return dt.strftime(DATE_FORMAT) if isinstance(dt, datetime) else None
+
+
+class _DocumentEncoder(json.JSONEncoder):
+    """ Encodes datetimes so they can be restored on the way out. """
+    def default(self, o):
+        if isinstance(o, datetime):
+            return {'$date': _format_date(o)}
+        if isinstance(o, set):
+            return list(o)
+        return json.JSONEncoder.default(self, o)
+
+
+def _decode_hook(dct):
+    if len(dct) == 1 and '$date' in dct:
+        return datetime.strptime(dct['$date'], DATE_FORMAT)
+    return dct
+
+
+class SQLiteBackend(BaseBackend):
+    """ SQLite Backend implementation
+
+    Documents are stored as JSON alongside the indexed columns needed
+    to query them. The database runs in WAL mode so reads from the web
+    interface don't block commits from running jobs, and all statements
+    are parameterized so sqlite3 can reuse their compiled forms.
+    Writes made within transaction() are grouped into a single commit.
+    """
+
+
+    def __init__(self, filepath):
+        super(SQLiteBackend, self).__init__()
+
+        self.filepath = filepath
+        if filepath != ':memory:':
+            self.filepath = os.path.abspath(os.path.expanduser(filepath))
+
+        self.conn_lock = threading.RLock()
+        self.transaction_depth = 0
+
+        self.conn = sqlite3.connect(self.filepath,
+                                    check_same_thread=False,
+                                    cached_statements=200)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA foreign_keys=OFF')
+        with self.transaction():
+            self._migrate()
+            for statement in SCHEMA:
+                self.conn.execute(statement)
+
+    def _migrate(self):
+        """ Add columns that files created by older versions lack. """
+        columns = [row[1] for row in
+                   self.conn.execute('PRAGMA table_info(dagobah_log_task)')]
+        if columns and 'cache_key' not in columns:
+            self.conn.execute('ALTER TABLE dagobah_log_task '
+                              'ADD COLUMN cache_key TEXT')
+
+    def __repr__(self):
+        return '<SQLiteBackend (path: %s)>' % self.filepath
+
+    @contextmanager
+    def transaction(self):
+        """ Group every write made inside this block into one commit. """
+        with self.conn_lock:
+            self.transaction_depth += 1
+            try:
+                yield self.conn
+            except:
+                self.transaction_depth -= 1
+                if self.transaction_depth == 0:
+                    self.conn.rollback()
+                raise
+            self.transaction_depth -= 1
+            if self.transaction_depth == 0:
+                self.conn.commit()
+
+    def _query(self, sql, params=()):
+        with self.conn_lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def _dumps(self, doc):
+        return json.dumps(doc, cls=_DocumentEncoder)
+
+    def _loads(self, doc):
+        return json.loads(doc, object_hook=_decode_hook)
+
+    def get_known_dagobah_ids(self):
+        return [row[0] for row in self._query('SELECT id FROM dagobah')]
+
+    def get_dagobah_json(self, dagobah_id):
+        rows = self._query('SELECT doc FROM dagobah WHERE id = ?',
+                           (str(dagobah_id),))
+        return self._loads(rows[0][0]) if rows else None
+
+    def get_jobs_json(self, dagobah_id):
+        rows = self._query('SELECT doc FROM dagobah_job WHERE parent_id = ? '
+                           'ORDER BY rowid', (str(dagobah_id),))
+        return [self._loads(row[0]) for row in rows]
+
+    def commit_dagobah(self, dagobah_json):
+        with self.transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO dagobah (id, save_date, doc) '
+                         'VALUES (?, ?, ?)',
+                         (str(dagobah_json['dagobah_id']),
+                          _format_date(datetime.utcnow()),
+                          self._dumps(dagobah_json)))
+
+    def delete_dagobah(self, dagobah_id):
+        """ Deletes the Dagobah and all child Jobs from the database.
+
+        Related run logs are deleted as well.
+        """
+
+        dagobah_id = str(dagobah_id)
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM dagobah_log_task WHERE log_id IN '
+                         '(SELECT id FROM dagobah_log WHERE parent_id = ?)',
+                         (dagobah_id,))
+            conn.execute('DELETE FROM dagobah_log WHERE parent_id = ?',
+                         (dagobah_id,))
+            conn.execute('DELETE FROM dagobah_scheduler WHERE dagobah_id IN '
+                         '(SELECT id FROM dagobah_job WHERE parent_id = ?)',
+                         (dagobah_id,))
+            conn.execute('DELETE FROM dagobah_job WHERE parent_id = ?',
+                         (dagobah_id,))
+            conn.execute('DELETE FROM dagobah_scheduler WHERE dagobah_id = ?',
+                         (dagobah_id,))
+            conn.execute('DELETE FROM dagobah WHERE id = ?', (dagobah_id,))
+
+    def commit_job(self, job_json):
+        with self.transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO dagobah_job '
+                         '(id, parent_id, save_date, doc) VALUES (?, ?, ?, ?)',
+                         (str(job_json['job_id']),
+                          str(job_json.get('parent_id', None)),
+                          _format_date(datetime.utcnow()),
+                          self._dumps(job_json)))
+
+    def delete_job(self, job_id):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM dagobah_job WHERE id = ?', (str(job_id),))
+            conn.execute('DELETE FROM dagobah_scheduler WHERE dagobah_id = ?',
+                         (str(job_id),))
+
+    def commit_log(self, log_json):
+        """ Commits a run log along with one indexed row per task. """
+
+        log_id = str(log_json['log_id'])
+        job_id = str(log_json.get('job_id', None))
+        save_date = _format_date(datetime.utcnow())
+
+        task_rows = []
+        for task_name, values in log_json.get('tasks', {}).iteritems():
+            success = values.get('success', None)
+            task_rows.append((log_id, job_id, task_name, save_date,
+                              None if success is None else int(success),
+                              values.get('return_code', None),
+                              _format_date(values.get('start_time', None)),
+                              _format_date(values.get('complete_time', None)),
+                              values.get('cache_key', None)))
+
+        with self.transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO dagobah_log '
+                         '(id, job_id, parent_id, save_date, doc) '
+                         'VALUES (?, ?, ?, ?, ?)',
+                         (log_id, job_id, str(log_json.get('parent_id', None)),
+                          save_date, self._dumps(log_json)))
+            conn.execute('DELETE FROM dagobah_log_task WHERE log_id = ?',
+                         (log_id,))
+            conn.executemany('INSERT INTO dagobah_log_task '
+                             '(log_id, job_id, task_name, save_date, success, '
+                             'return_code, start_time, complete_time, '
+                             'cache_key) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', task_rows)
+
+    def _log_from_row(self, row):
+        log = self._loads(row[0])
+        log['save_date'] = datetime.strptime(row[1], DATE_FORMAT)
+        return log
+
+    def get_latest_run_log(self, job_id, task_name):
+        history = self.get_run_log_history(job_id, task_name, limit=1)
+        return history[0] if history else {}
+
+    def get_run_log_history(self, job_id, task_name, limit=10):
+        rows = self._query('SELECT l.doc, l.save_date FROM dagobah_log_task t '
+                           'JOIN dagobah_log l ON l.id = t.log_id '
+                           'WHERE t.job_id = ? AND t.task_name = ? '
+                           'ORDER BY t.save_date DESC LIMIT ?',
+                           (str(job_id), task_name, limit))
+        return [self._log_from_row(row) for row in rows]
+
+    def get_run_log(self, job_id, task_name, log_id):
+        rows = self._query('SELECT doc FROM dagobah_log '
+                           'WHERE id = ? AND job_id = ?',
+                           (str(log_id), str(job_id)))
+        if not rows:
+            return None
+        return self._loads(rows[0][0])['tasks'][task_name]
+
+    def get_job_run_log(self, job_id, log_id=None):
+        if log_id is None:
+            rows = self._query('SELECT doc, save_date FROM dagobah_log '
+                               'WHERE job_id = ? ORDER BY save_date DESC '
+                               'LIMIT 1', (str(job_id),))
+        else:
+            rows = self._query('SELECT doc, save_date FROM dagobah_log '
+                               'WHERE id = ? AND job_id = ?',
+                               (str(log_id), str(job_id)))
+        return self._log_from_row(rows[0]) if rows else {}
+
+    def get_cached_run(self, job_id, task_name, cache_key):
+        rows = self._query('SELECT l.doc FROM dagobah_log_task t '
+                           'JOIN dagobah_log l ON l.id = t.log_id '
+                           'WHERE t.job_id = ? AND t.task_name = ? '
+                           'AND t.cache_key = ? AND t.success = 1 '
+                           'ORDER BY t.save_date DESC LIMIT 1',
+                           (str(job_id), task_name, cache_key))
+        if not rows:
+            return None
+        return self._loads(rows[0][0])['tasks'][task_name]
+
+    def compact_run_logs(self):
+        """ Roll expired run logs into per-job summaries and remove them. """
+
+        policy = self.retention_policy
+        if not policy or not policy.is_enabled():
+            return 0
+
+        now = datetime.utcnow()
+        removed = 0
+
+        for (job_id,) in self._query('SELECT DISTINCT job_id FROM dagobah_log'):
+            cutoff = None
+            if policy.keep_runs:
+                rows = self._query('SELECT save_date FROM dagobah_log '
+                                   'WHERE job_id = ? ORDER BY save_date DESC '
+                                   'LIMIT 1 OFFSET ?',
+                                   (job_id, policy.keep_runs - 1))
+                if not rows:
+                    continue
+                cutoff = rows[0][0]
+
+            min_horizon = policy.min_horizon()
+            if min_horizon is not None:
+                age_cutoff = _format_date(now - min_horizon)
+                cutoff = min(cutoff, age_cutoff) if cutoff else age_cutoff
+
+            if cutoff is None:
+                cutoff = _format_date(now)
+
+            rows = self._query('SELECT doc, save_date FROM dagobah_log '
+                               'WHERE job_id = ? AND save_date < ? '
+                               'ORDER BY save_date DESC',
+                               (job_id, cutoff))
+            expired = [log for log in [self._log_from_row(row) for row in rows]
+                       if policy.is_expired(log, policy.keep_runs or 0, now)]
+            if not expired:
+                continue
+
+            summary = self.get_run_log_summary(job_id)
+            summary = summarize_run_logs(job_id, expired, summary)
+            log_ids = [(str(log['log_id']),) for log in expired]
+
+            with self.transaction() as conn:
+                conn.execute('INSERT OR REPLACE INTO dagobah_log_summary '
+                             '(job_id, save_date, doc) VALUES (?, ?, ?)',
+                             (job_id, _format_date(now), self._dumps(summary)))
+                conn.executemany('DELETE FROM dagobah_log_task '
+                                 'WHERE log_id = ?', log_ids)
+                conn.executemany('DELETE FROM dagobah_log WHERE id = ?',
+                                 log_ids)
+            removed += len(expired)
+
+        return removed
+
+    def get_run_log_summary(self, job_id):
+        rows = self._query('SELECT doc FROM dagobah_log_summary '
+                           'WHERE job_id = ?', (str(job_id),))
+        return self._loads(rows[0][0]) if rows else {}
+
+    def get_duration_series(self, job_id, since):
+        """ Durations are computed from the indexed task rows, so no
+        run log documents are read. """
+        params = (str(job_id), _format_date(since))
+        job_series, task_series = DurationSeries(), {}
+
+        # a run is finished once every task in it has a complete_time
+        for start, duration, success in self._query(
+                'SELECT (julianday(MIN(start_time)) - 2440587.5) * 86400.0, '
+                '(julianday(MAX(complete_time)) - julianday(MIN(start_time))) * 86400.0, '
+                'MIN(success) FROM dagobah_log_task '
+                'WHERE job_id = ? AND start_time >= ? GROUP BY log_id '
+                'HAVING COUNT(complete_time) = COUNT(*) '
+                'ORDER BY MIN(start_time)', params):
+            job_series.append(start, duration, success)
+
+        for task_name, start, duration, success in self._query(
+                'SELECT task_name, (julianday(start_time) - 2440587.5) * 86400.0, '
+                '(julianday(complete_time) - julianday(start_time)) * 86400.0, '
+                'success FROM dagobah_log_task '
+                'WHERE job_id = ? AND start_time >= ? '
+                'AND complete_time IS NOT NULL ORDER BY start_time', params):
+            if task_name not in task_series:
+                task_series[task_name] = DurationSeries()
+            task_series[task_name].append(start, duration, success)
+
+        return job_series, task_series
+
+    def commit_scheduler_state(self, dagobah_id, state):
+        with self.transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO dagobah_scheduler '
+                         '(dagobah_id, save_date, doc) VALUES (?, ?, ?)',
+                         (str(dagobah_id), _format_date(datetime.utcnow()),
+                          self._dumps(state)))
+
+    def get_scheduler_state(self, dagobah_id):
+        rows = self._query('SELECT doc FROM dagobah_scheduler '
+                           'WHERE dagobah_id = ?', (str(dagobah_id),))
+        return self._loads(rows[0][0]) if rows else None
+
+    def acquire_lease(self, name, owner, ttl):
+        """ Take or renew a lease, unless another owner holds it. """
+        now = datetime.utcnow()
+        expires_at = _format_date(now + timedelta(seconds=ttl))
+        with self.transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO dagobah_lease '
+                         '(name, owner, expires_at) VALUES (?, ?, ?)',
+                         (name, owner, expires_at))
+            cursor = conn.execute('UPDATE dagobah_lease '
+                                  'SET owner = ?, expires_at = ? WHERE name = ? '
+                                  'AND (owner = ? OR expires_at < ?)',
+                                  (owner, expires_at, name, owner,
+                                   _format_date(now)))
+            return cursor.rowcount > 0
+
+    def release_lease(self, name, owner):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM dagobah_lease WHERE name = ? AND owner = ?',
+                         (name, owner))
+
+    def heartbeat(self, node_id, ttl):
+        with self.transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO dagobah_node (id, expires_at) '
+                         'VALUES (?, ?)',
+                         (node_id, _format_date(datetime.utcnow() +
+                                                timedelta(seconds=ttl))))
+
+    def unregister_node(self, node_id):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM dagobah_node WHERE id = ?', (node_id,))
+
+    def get_live_nodes(self):
+        rows = self._query('SELECT id FROM dagobah_node WHERE expires_at > ? '
+                           'ORDER BY id', (_format_date(datetime.utcnow()),))
+        return [row[0] for row in rows]
@@ -1,3 +1,8 @@
 from dag import DAG, DAGValidationError
-from .components import JobState, Scheduler, EventHandler
+from .components import (JobState, Scheduler, EventHandler, RunLogWriter,
+                         SlowTaskDetector)
 from .core import Dagobah, Task, Job, DagobahError
+from .cluster import ClusterMembership, HashRing
+from .workers import WorkerRegistry, UnknownWorkerError
+from .metrics import DagobahMetrics
+from .tracing import Tracer, RingExporter, JSONLinesExporter
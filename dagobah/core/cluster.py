@@ -0,0 +1,148 @@
+""" Membership, leader election and job sharding for clustered daemons. """
+
+import os
+import bisect
+import socket
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger('dagobah')
+
+LEADER_LEASE = 'leader'
+
+
+class HashRing(object):
+    """ Consistent hash ring mapping keys onto a set of nodes.
+
+    Each node is placed on the ring at several points so keys spread
+    evenly, and adding or removing a node only moves the keys that
+    node gains or loses.
+    """
+
+    def __init__(self, nodes=None, replicas=100):
+        self.replicas = replicas
+        self.nodes = sorted(nodes or [])
+
+        points = []
+        for node in self.nodes:
+            for i in range(self.replicas):
+                points.append((self._hash('%s:%d' % (node, i)), node))
+        points.sort()
+        self.hashes = [point[0] for point in points]
+        self.owners = [point[1] for point in points]
+
+
+    def __repr__(self):
+        return '<HashRing (nodes: %s)>' % ', '.join(self.nodes)
+
+
+    def _hash(self, key):
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+
+    def get_node(self, key):
+        """ Returns the node that owns this key, or None if there are none. """
+        if not self.hashes:
+            return None
+        idx = bisect.bisect(self.hashes, self._hash(key)) % len(self.hashes)
+        return self.owners[idx]
+
+
+def default_node_id():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class ClusterMembership(threading.Thread):
+    """ Keeps this node registered in a cluster of daemons.
+
+    Every heartbeat_interval seconds the node renews its heartbeat in
+    the backend, rebuilds the hash ring from the nodes that are still
+    alive and tries to take or renew the leader lease. A node that stops
+    heartbeating drops out of the ring once its heartbeat is lease_ttl
+    seconds old, and its jobs move to the remaining nodes. Only the
+    leader runs cluster-wide maintenance such as log compaction.
+
+    Backend locks are held as leases of lease_ttl seconds once the node
+    joins, and each heartbeat renews those it still holds.
+    """
+
+    def __init__(self, backend, node_id=None, heartbeat_interval=5,
+                 lease_ttl=15):
+        super(ClusterMembership, self).__init__()
+        if lease_ttl <= heartbeat_interval:
+            raise ValueError('lease_ttl must be longer than heartbeat_interval')
+
+        self.backend = backend
+        self.node_id = node_id or default_node_id()
+        self.heartbeat_interval = heartbeat_interval
+        self.lease_ttl = lease_ttl
+        self.daemon = True
+
+        self.ring = HashRing()
+        self.is_leader = False
+        self._stop_event = threading.Event()
+
+
+    def __repr__(self):
+        return '<ClusterMembership for node %s>' % self.node_id
+
+
+    def start(self):
+        """ Join the cluster before the heartbeat loop starts. """
+        self.backend.lock_ttl = self.lease_ttl
+        self.backend.distributed_locks = True
+        self.beat()
+        super(ClusterMembership, self).start()
+
+
+    def stop(self, leave=True):
+        """ Stop heartbeating.
+
+        If leave is True, the node's heartbeat and leader lease are
+        removed so other nodes take over its jobs right away. Otherwise
+        they take over once the lease expires.
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+        if leave:
+            self.backend.release_lease(LEADER_LEASE, self.node_id)
+            self.backend.unregister_node(self.node_id)
+        self.is_leader = False
+
+
+    def run(self):
+        while True:
+            self._stop_event.wait(self.heartbeat_interval)
+            if self._stop_event.is_set():
+                break
+            try:
+                self.beat()
+            except Exception:
+                logger.exception('Error sending cluster heartbeat')
+
+
+    def beat(self):
+        """ Renew this node's heartbeat, locks, ring and leadership. """
+        self.backend.heartbeat(self.node_id, self.lease_ttl)
+        self.backend.renew_locks()
+
+        live_nodes = self.backend.get_live_nodes()
+        if self.node_id not in live_nodes:
+            live_nodes.append(self.node_id)
+        if sorted(live_nodes) != self.ring.nodes:
+            logger.info('Cluster membership changed: {0}'.format(', '.join(sorted(live_nodes))))
+            self.ring = HashRing(live_nodes)
+
+        is_leader = self.backend.acquire_lease(LEADER_LEASE, self.node_id,
+                                               self.lease_ttl)
+        if is_leader != self.is_leader:
+            logger.info('Node {0} {1} cluster leadership'.format(self.node_id,
+                                                                  'took' if is_leader else 'lost'))
+        self.is_leader = is_leader
+
+
+    def owns(self, job):
+        """ Returns Boolean of whether this node should run the Job. """
+        return self.ring.get_node(str(job.job_id)) == self.node_id
@@ -2,11 +2,24 @@
 
 import inspect
 import logging
-from datetime import datetime
-from collections import defaultdict
+import heapq
+import bisect
+from datetime import datetime, timedelta
+from collections import defaultdict, deque
 import time
 import threading
 import json
+import Queue
+import select
+import socket
+
+from croniter import croniter
+
+from .metrics import seconds_since
+from .tracing import NullTracer
+from ..backend import analytics
+
+logger = logging.getLogger('dagobah')
 
 
 class EventHandler(object):
@@ -14,29 +27,171 @@ class EventHandler(object):
 
     The Dagobah instance emits events, which can then trigger
     handlers that are registered in this class.
+
+    With workers > 0, emit only queues the event and handlers run on a
+    pool of worker threads, one pool per event with its own bounded
+    queue. When a queue is full, the "block" overflow policy waits for
+    room while "drop" discards the event. Given a Tracer, each emit and
+    each queued dispatch is recorded as a span.
+
+    Without include_run_logs, task_failed and job_failed events carry
+    the run's log_id instead of serialized run logs, for handlers that
+    load the logs themselves.
     """
 
-    def __init__(self):
+    def __init__(self, workers=0, queue_size=100, overflow='block',
+                 tracer=None, include_run_logs=True):
+        if overflow not in ['block', 'drop']:
+            raise ValueError('unknown overflow policy %s' % overflow)
+
         self.handlers = defaultdict(list)
+        self.tracer = tracer or NullTracer()
+        self.include_run_logs = include_run_logs
+
+        self.workers = workers
+        self.queue_size = queue_size
+        self.overflow = overflow
+
+        self.queues = {}
+        self.threads = []
+        self.queues_lock = threading.Lock()
+
+        # emitters and workers update these concurrently
+        self.metrics_lock = threading.Lock()
+        self.metrics = defaultdict(lambda: {'emitted': 0,
+                                            'dispatched': 0,
+                                            'dropped': 0,
+                                            'max_queue_depth': 0,
+                                            'total_latency': 0.0,
+                                            'max_latency': 0.0})
 
 
     def emit(self, event, event_params={}):
-        try:
-            methods = self.handlers.get(event, [])
-            for method, args, kwargs in methods:
-                argspec = inspect.getargspec(method)
-                if ('event_params' in argspec.args or argspec.keywords is not None):
-                    kwargs = dict(kwargs.items() +
-                                  {'event_params': event_params}.items())
-                method.__call__(*args, **kwargs)
-        except Exception:
-            logging.exception('Exception emitting event %s' % event)
+        with self.tracer.start_span('event.emit', event=event) as span:
+            self._emit(event, event_params, span)
+
+
+    def _emit(self, event, event_params, span):
+        with self.metrics_lock:
+            metrics = self.metrics[event]
+            metrics['emitted'] += 1
+
+        if not self.workers:
+            self._dispatch(event, event_params, time.time())
+            return
+
+        queue = self._get_queue(event)
+        item = (time.time(), event_params, span)
+        if self.overflow == 'drop':
+            try:
+                queue.put_nowait(item)
+            except Queue.Full:
+                with self.metrics_lock:
+                    metrics['dropped'] += 1
+                span.set(dropped=True)
+                logger.warn('Event queue for %s is full, dropping event' % event)
+                return
+        else:
+            queue.put(item)
+
+        depth = queue.qsize()
+        with self.metrics_lock:
+            metrics['max_queue_depth'] = max(metrics['max_queue_depth'], depth)
+
+
+    def _dispatch(self, event, event_params, emitted_at):
+        """ Call every handler registered for this event. """
+        for method, args, kwargs, pass_params in self.handlers.get(event, []):
+            try:
+                if pass_params:
+                    method(*args, event_params=event_params, **kwargs)
+                else:
+                    method(*args, **kwargs)
+            except Exception:
+                logging.exception('Exception emitting event %s' % event)
+
+        latency = time.time() - emitted_at
+        with self.metrics_lock:
+            metrics = self.metrics[event]
+            metrics['dispatched'] += 1
+            metrics['total_latency'] += latency
+            metrics['max_latency'] = max(metrics['max_latency'], latency)
+
+
+    def _get_queue(self, event):
+        """ Returns the queue for this event, starting its workers if needed. """
+        with self.queues_lock:
+            if event not in self.queues:
+                self.queues[event] = Queue.Queue(self.queue_size)
+                for i in range(self.workers):
+                    worker = threading.Thread(target=self._work,
+                                              args=(event, self.queues[event]))
+                    worker.daemon = True
+                    worker.start()
+                    self.threads.append(worker)
+            return self.queues[event]
+
+
+    def _work(self, event, queue):
+        while True:
+            emitted_at, event_params, span = queue.get()
+            try:
+                if emitted_at is None:
+                    break
+                # handled apart from the span that emitted it, so give it its own
+                with self.tracer.start_span('event.dispatch', parent=span,
+                                            event=event):
+                    self._dispatch(event, event_params, emitted_at)
+            finally:
+                queue.task_done()
+
+
+    def flush(self):
+        """ Block until every queued event has been handled. """
+        for queue in self.queues.values():
+            queue.join()
+
+
+    def stop(self):
+        """ Handle every queued event, then stop the worker threads. """
+        with self.queues_lock:
+            for queue in self.queues.values():
+                for i in range(self.workers):
+                    queue.put((None, None, None))
+            self.queues = {}
+        for worker in self.threads:
+            worker.join()
+        self.threads = []
+
+
+    def get_metrics(self):
+        """ Returns dispatch latency and queue depth statistics per event. """
+        result = {}
+        with self.metrics_lock:
+            snapshot = [(event, dict(metrics)) for event, metrics
+                        in self.metrics.items()]
+        for event, metrics in snapshot:
+            result[event] = metrics
+            queue = self.queues.get(event, None)
+            result[event]['queue_depth'] = queue.qsize() if queue else 0
+            result[event]['avg_latency'] = (metrics['total_latency'] /
+                                            metrics['dispatched']
+                                            if metrics['dispatched'] else None)
+        return result
 
 
     def register(self, event, method, *args, **kwargs):
+        """ Register a handler to be called with args and kwargs on event.
+
+        The handler's signature is inspected once here to decide whether
+        it should also receive event_params.
+        """
         if 'event_params' in kwargs:
             raise ValueError('event_params is a reserved key')
-        self.handlers[event].append((method, args, kwargs))
+        argspec = inspect.getargspec(method)
+        pass_params = ('event_params' in argspec.args or
+                       argspec.keywords is not None)
+        self.handlers[event].append((method, args, kwargs, pass_params))
 
 
     def deregister(self, event, method):
@@ -76,24 +231,135 @@ class JobState(object):
             setattr(self, perm, True if self.status in states else False)
 
 
+class ExecutionPlan(object):
+    """ A compiled, read-only form of a Job's graph.
+
+    Holds the nodes in topological order, the in-degree of each node and
+    its downstream and upstream neighbours, so a run can look any of them
+    up without copying or scanning the graph. Plans are not modified once
+    built; a changed graph is compiled into a new plan. Raises ValueError
+    if the graph has a cycle.
+    """
+
+    def __init__(self, graph, version=None):
+        self.version = version
+
+        upstream = dict([(node, []) for node in graph])
+        for node, edges in graph.iteritems():
+            for edge in edges:
+                upstream[edge].append(node)
+
+        self.downstream = dict([(node, tuple(edges))
+                                for node, edges in graph.iteritems()])
+        self.upstream = dict([(node, tuple(nodes))
+                              for node, nodes in upstream.iteritems()])
+        self.in_degree = dict([(node, len(nodes))
+                               for node, nodes in upstream.iteritems()])
+
+        # Kahn's algorithm
+        remaining = dict(self.in_degree)
+        ready = deque([node for node in graph if remaining[node] == 0])
+        order = []
+        while ready:
+            node = ready.popleft()
+            order.append(node)
+            for edge in self.downstream[node]:
+                remaining[edge] -= 1
+                if remaining[edge] == 0:
+                    ready.append(edge)
+
+        if len(order) != len(graph):
+            raise ValueError('graph is not acyclic')
+        self.order = tuple(order)
+        self.roots = tuple([node for node in order
+                            if self.in_degree[node] == 0])
+
+
+    def __repr__(self):
+        return '<ExecutionPlan (nodes: %d)>' % len(self.order)
+
+
+    def __len__(self):
+        return len(self.order)
+
+
+    def __contains__(self, node):
+        return node in self.downstream
+
+
+    def __iter__(self):
+        return iter(self.order)
+
+
+    def keys(self):
+        return list(self.order)
+
+
+    def subset(self, nodes):
+        """ Returns the plan of the subgraph spanned by nodes. """
+        nodes = set([node for node in nodes if node in self.downstream])
+        return ExecutionPlan(dict([(node, [edge for edge in self.downstream[node]
+                                           if edge in nodes])
+                                   for node in nodes]))
+
+
 class Scheduler(threading.Thread):
-    """ Monitoring thread to kick off Jobs at their scheduled times. """
+    """ Monitoring thread to kick off Jobs at their scheduled times.
+
+    The scheduler checkpoints its last check time and each job's next
+    run to the backend, every checkpoint_interval seconds and whenever
+    a job fires, so a restarted daemon can pick up where it left off.
+    Fires that were due while the scheduler wasn't running are handled
+    according to the catch-up policy: "skip" drops them, "once" runs the
+    job a single time for all of them and "all" runs it once per fire.
+    Fires for a Job that is already at its max_active_runs are handed to
+    the Job, which queues or drops them according to its queue policy.
+
+    If the parent Dagobah is part of a cluster, only the Jobs this node
+    owns are started; the others are advanced past their fires. Each
+    Job's checkpoint is then kept on its own and written by its owner.
+    The Jobs are reloaded from the backend whenever membership changes
+    and every heartbeat_interval seconds, and the checkpoints of Jobs
+    the node takes over are restored.
+    """
+
+    catchup_policies = ['skip', 'once', 'all']
 
-    def __init__(self, parent_dagobah):
+    def __init__(self, parent_dagobah, catchup_policy='skip',
+                 checkpoint_interval=60):
         super(Scheduler, self).__init__()
         self.parent = parent_dagobah
         self.stopped = False
 
+        self.set_catchup_policy(catchup_policy)
+        self.checkpoint_interval = checkpoint_interval
+
         self.last_check = datetime.utcnow()
+        self.last_checkpoint = self.last_check
+
+        # cluster state: the ring the Jobs were last reloaded for, the
+        # Jobs owned then and the last next run checkpointed for each
+        self.ring = None
+        self.last_reload = None
+        self.owned = set()
+        self.checkpointed = {}
 
 
     def __repr__(self):
         return '<Scheduler for %s>' % self.parent
 
 
+    def set_catchup_policy(self, catchup_policy):
+        """ Set how fires missed while the scheduler was down are handled. """
+        if catchup_policy not in self.catchup_policies:
+            raise ValueError('unknown catch-up policy %s' % catchup_policy)
+        self.catchup_policy = catchup_policy
+
+
     def stop(self):
         """ Stop the monitoring loop without killing the thread. """
         self.stopped = True
+        self.checkpoint()
 
 
     def restart(self):
@@ -104,20 +370,554 @@ class Scheduler(threading.Thread):
 
     def run(self):
         """ Continually monitors Jobs of the parent Dagobah. """
-        while not self.stopped:
-            now = datetime.utcnow()
-            for job in self.parent.jobs:
-                if not job.next_run:
-                    continue
-                if job.next_run >= self.last_check and job.next_run <= now:
-                    if job.state.allow_start:
-                        job.start()
-                    else:
-                        job.next_run = job.cron_iter.get_next(datetime)
-            self.last_checked = now
+        while True:
+            if not self.stopped:
+                try:
+                    self.check(datetime.utcnow())
+                except Exception:
+                    logger.exception('Error checking job schedules')
             time.sleep(1)
 
 
+    def check(self, now):
+        """ Start every Job whose next run falls before now. """
+
+        if self.parent.cluster:
+            self._sync_cluster(now)
+
+        fired = False
+        for job in list(self.parent.jobs):
+            if not job.next_run or job.next_run > now:
+                continue
+
+            # another node in the cluster runs this job
+            if self.parent.cluster and not self.parent.cluster.owns(job):
+                self._skip_to(job, now)
+                continue
+
+            missed = job.next_run < self.last_check
+            if missed and self.catchup_policy == 'all' and not job.state.allow_start:
+                continue
+
+            fired = True
+            if missed and self.catchup_policy == 'skip':
+                logger.info('Skipping missed runs of job {0}'.format(job.name))
+                self._skip_to(job, now)
+                continue
+
+            if job.state.allow_start:
+                due = job.next_run
+                try:
+                    with self.parent.tracer.start_span('scheduler.fire',
+                                                       job=job.name,
+                                                       due=str(due),
+                                                       missed=missed):
+                        job.start()
+                except Exception:
+                    logger.exception('Error starting job {0}'.format(job.name))
+                    self._skip_to(job, now)
+                    continue
+                if self.parent.metrics:
+                    self.parent.metrics.fire_lag.observe(seconds_since(due))
+                if missed and self.catchup_policy == 'once':
+                    self._skip_to(job, now)
+                continue
+
+            # the job is at its limit of active runs; advance it first so
+            # a queued run that starts right away doesn't advance it again
+            if missed:
+                self._skip_to(job, now)
+            else:
+                job.next_run = job.cron_iter.get_next(datetime)
+            try:
+                job.queue_run()
+            except Exception:
+                logger.exception('Error queueing run of job {0}'.format(job.name))
+
+        self.last_check = now
+        if fired or self._checkpoint_due(now):
+            self.checkpoint(now)
+
+
+    def _sync_cluster(self, now):
+        """ Reload the Jobs if membership changed or a reload is due,
+        and restore the checkpoints of those this node took over. """
+        cluster = self.parent.cluster
+        ring = cluster.ring
+        if ring is self.ring and not self._reload_due(now):
+            return
+        self.ring = ring
+        self.last_reload = now
+
+        try:
+            self.parent.reload_jobs()
+        except Exception:
+            logger.exception('Error reloading jobs from the backend')
+
+        owned = [job for job in list(self.parent.jobs) if cluster.owns(job)]
+        taken = [job for job in owned if job.job_id not in self.owned]
+        self.owned = set([job.job_id for job in owned])
+        for job in taken:
+            self.checkpointed.pop(job.job_id, None)
+            try:
+                state = self.parent.backend.get_scheduler_state(job.job_id)
+            except Exception:
+                logger.exception('Error loading checkpoint of job {0}'.format(job.name))
+                continue
+            self._restore_jobs((state or {}).get('jobs', []))
+
+
+    def _reload_due(self, now):
+        if self.last_reload is None:
+            return True
+        elapsed = now - self.last_reload
+        return (elapsed.days * 86400 + elapsed.seconds >=
+                self.parent.cluster.heartbeat_interval)
+
+
+    def _skip_to(self, job, now):
+        """ Move a Job's next run to its first fire after now. """
+        job.cron_iter = croniter(job.cron_schedule, now)
+        job.next_run = job.cron_iter.get_next(datetime)
+
+
+    def _checkpoint_due(self, now):
+        if self.last_checkpoint is None:
+            return True
+        elapsed = now - self.last_checkpoint
+        return elapsed.days * 86400 + elapsed.seconds >= self.checkpoint_interval
+
+
+    def checkpoint(self, now=None):
+        """ Commit the scheduler's state to the backend. """
+
+        now = now or datetime.utcnow()
+        if self.parent.cluster:
+            self._checkpoint_jobs(now)
+            return
+
+        state = {'last_check': self.last_check,
+                 'save_date': now,
+                 'jobs': [{'job_id': job.job_id,
+                           'cron_schedule': job.cron_schedule,
+                           'next_run': job.next_run}
+                          for job in list(self.parent.jobs)]}
+        try:
+            self.parent.backend.commit_scheduler_state(self.parent.dagobah_id,
+                                                       state)
+        except Exception:
+            logger.exception('Error checkpointing scheduler state')
+            return
+        self.last_checkpoint = now
+
+
+    def _checkpoint_jobs(self, now):
+        """ Commit the next run of each Job this node owns, under the
+        Job's own ID, if it changed since it was last committed. """
+        for job in list(self.parent.jobs):
+            if not self.parent.cluster.owns(job):
+                continue
+            record = {'job_id': job.job_id,
+                      'cron_schedule': job.cron_schedule,
+                      'next_run': job.next_run}
+            if self.checkpointed.get(job.job_id, None) == record:
+                continue
+            try:
+                self.parent.backend.commit_scheduler_state(job.job_id,
+                                                           {'last_check': self.last_check,
+                                                            'save_date': now,
+                                                            'jobs': [record]})
+            except Exception:
+                logger.exception('Error checkpointing job {0}'.format(job.name))
+                continue
+            self.checkpointed[job.job_id] = record
+        self.last_checkpoint = now
+
+
+    def restore(self, state=None):
+        """ Restore each Job's next run from a scheduler checkpoint.
+
+        Records for Jobs whose schedule has since changed are ignored,
+        and later records for a Job take precedence over earlier ones.
+        Restored runs that are already due are treated as missed on the
+        next check.
+        """
+
+        if state is None:
+            state = self.parent.backend.get_scheduler_state(self.parent.dagobah_id)
+        if not state:
+            return
+
+        self._restore_jobs(state.get('jobs', []))
+        self.last_check = datetime.utcnow()
+
+
+    def _restore_jobs(self, records):
+        """ Restore the next runs of the Jobs in checkpoint records. """
+        jobs = dict([(str(job.job_id), job) for job in self.parent.jobs])
+        for rec in records:
+            job = jobs.get(str(rec.get('job_id')), None)
+            if (not job or not job.cron_schedule or not rec.get('next_run') or
+                rec.get('cron_schedule') != job.cron_schedule):
+                continue
+            job.cron_iter = croniter(job.cron_schedule, rec['next_run'])
+            job.next_run = rec['next_run']
+            logger.debug('Restored job {0} next run of {1}'.format(job.name, job.next_run))
+
+
+class RunLogWriter(threading.Thread):
+    """ Commits run logs to the backend off the task completion path.
+
+    Run logs are copied when queued, so later changes to a live run log
+    don't leak into a pending commit. A single writer thread commits in
+    queue order, which keeps commits ordered within each job, and skips
+    any copy that has been superseded by a newer one of the same run log.
+    The queue is bounded: when it is full, callers block until the
+    writer catches up.
+    """
+
+    def __init__(self, backend, max_size=1000):
+        super(RunLogWriter, self).__init__()
+        self.backend = backend
+        self.daemon = True
+        self.queue = Queue.Queue(max_size)
+
+        self.sequence = 0
+        self.latest = {}
+        self.pending = defaultdict(int)
+        self.pending_cond = threading.Condition()
+
+
+    def __repr__(self):
+        return '<RunLogWriter for %s>' % self.backend
+
+
+    def commit(self, run_log):
+        """ Queue a copy of this run log to be committed. """
+        snapshot = dict(run_log)
+        snapshot['tasks'] = dict([(name, dict(log)) for name, log
+                                  in run_log.get('tasks', {}).iteritems()])
+
+        with self.pending_cond:
+            self.sequence += 1
+            self.latest[snapshot.get('log_id')] = self.sequence
+            self.pending[snapshot.get('job_id')] += 1
+            sequence = self.sequence
+
+        self.queue.put((sequence, snapshot))
+
+
+    def flush(self, job_id=None):
+        """ Block until queued run logs have been committed.
+
+        If job_id is given, only waits on run logs of that job.
+        """
+        with self.pending_cond:
+            while ((self.pending.get(job_id) if job_id is not None
+                    else self.pending) and self.is_alive()):
+                self.pending_cond.wait(1)
+
+
+    def stop(self):
+        """ Commit everything still queued, then stop the writer. """
+        if self.is_alive():
+            self.queue.put((None, None))
+            self.join()
+
+
+    def run(self):
+        while True:
+            sequence, run_log = self.queue.get()
+            if run_log is None:
+                break
+
+            log_id, job_id = run_log.get('log_id'), run_log.get('job_id')
+            try:
+                if self.latest.get(log_id) == sequence:
+                    self.backend.commit_log(run_log)
+            except Exception:
+                logger.exception('Error committing run log %s' % log_id)
+            finally:
+                with self.pending_cond:
+                    if self.latest.get(log_id) == sequence:
+                        del self.latest[log_id]
+                    self.pending[job_id] -= 1
+                    if not self.pending[job_id]:
+                        del self.pending[job_id]
+                    self.pending_cond.notify_all()
+
+
+class SlowTaskDetector(threading.Thread):
+    """ Emits a task_slow event for Tasks running longer than usual.
+
+    Each Task's threshold is the given percentile of its last window
+    successful durations, loaded from the backend once per Job and then
+    updated as Tasks finish. Tasks with fewer than min_runs successful
+    durations have no threshold. A started Task costs one heap push of
+    its deadline, and each check only pops the deadlines that have
+    passed, so the number of running Tasks doesn't slow checks down.
+    """
+
+    def __init__(self, percentile=95, min_runs=5, window=100,
+                 history_days=30, interval=1):
+        super(SlowTaskDetector, self).__init__()
+        if not 0 < percentile <= 100:
+            raise ValueError('percentile must be above 0 and at most 100')
+        self.daemon = True
+        self.percentile = percentile
+        self.min_runs = min_runs
+        self.window = window
+        self.history_days = history_days
+        self.interval = interval
+        self.parent = None
+        self.stopped = False
+
+        self.lock = threading.Lock()
+        self.started = []
+        self.finished = []
+
+        self.loaded = set()
+        self.recent = {}
+        self.ordered = {}
+        self.thresholds = {}
+        self.deadlines = []
+        self.sequence = 0
+
+
+    def __repr__(self):
+        return '<SlowTaskDetector for %s>' % self.parent
+
+
+    def watch(self, dagobah):
+        """ Watch the Tasks of this Dagobah's runs. """
+        self.parent = dagobah
+        self.start()
+
+
+    def stop(self):
+        self.stopped = True
+
+
+    def track(self, task):
+        """ Called when a Task starts running. """
+        with self.lock:
+            self.started.append((task, task.started_at))
+
+
+    def record(self, task, duration, success):
+        """ Called when a Task finishes, with how long it ran. """
+        with self.lock:
+            self.finished.append((task.parent_job.job_id, task.name,
+                                  duration, success))
+
+
+    def get_threshold(self, job_id, task_name):
+        """ Returns the seconds a Task may run before it is slow, or None. """
+        return self.thresholds.get((job_id, task_name), None)
+
+
+    def run(self):
+        while not self.stopped:
+            try:
+                self.check(datetime.utcnow())
+            except Exception:
+                logger.exception('Error checking for slow tasks')
+            time.sleep(self.interval)
+
+
+    def check(self, now):
+        """ Emit task_slow for each Task that passed its threshold by now. """
+        with self.lock:
+            started, self.started = self.started, []
+            finished, self.finished = self.finished, []
+
+        for job_id, task_name, duration, success in finished:
+            if success and job_id in self.loaded:
+                self._add_duration((job_id, task_name), duration)
+
+        for task, started_at in started:
+            job_id = task.parent_job.job_id
+            if job_id not in self.loaded:
+                self._load(job_id)
+            threshold = self.get_threshold(job_id, task.name)
+            if threshold is not None:
+                self.sequence += 1
+                heapq.heappush(self.deadlines,
+                               (started_at + timedelta(seconds=threshold),
+                                self.sequence, task, started_at, threshold))
+
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, sequence, task, started_at, threshold = \
+                heapq.heappop(self.deadlines)
+            # the Task finished, or is running again since
+            if task.completed_at is not None or task.started_at != started_at:
+                continue
+            self._emit(task, seconds_since(started_at), threshold)
+
+
+    def _load(self, job_id):
+        """ Fill the thresholds of a Job's Tasks from its run history. """
+        since = datetime.utcnow() - timedelta(days=self.history_days)
+        try:
+            job_series, task_series = self.parent.backend.get_duration_series(
+                job_id, since)
+        except Exception:
+            logger.exception('Error loading task durations of job %s' % job_id)
+            task_series = {}
+        self.loaded.add(job_id)
+
+        for task_name, series in task_series.iteritems():
+            runs = sorted([(series.starts[i], series.durations[i])
+                           for i in range(len(series)) if series.successes[i]])
+            durations = [duration for start, duration in runs[-self.window:]]
+            key = (job_id, task_name)
+            self.recent[key] = deque(durations)
+            self.ordered[key] = sorted(durations)
+            self._update_threshold(key)
+
+
+    def _add_duration(self, key, duration):
+        """ Slide a Task's window on by one duration and update its threshold. """
+        recent = self.recent.setdefault(key, deque())
+        ordered = self.ordered.setdefault(key, [])
+        recent.append(duration)
+        bisect.insort(ordered, duration)
+        if len(recent) > self.window:
+            del ordered[bisect.bisect_left(ordered, recent.popleft())]
+        self._update_threshold(key)
+
+
+    def _update_threshold(self, key):
+        ordered = self.ordered[key]
+        if len(ordered) >= self.min_runs:
+            self.thresholds[key] = analytics.percentile(ordered, self.percentile)
+        else:
+            self.thresholds[key] = None
+
+
+    def _emit(self, task, elapsed, threshold):
+        logger.warning('Task {0} of job {1} has run for {2:.1f}s, past its '
+                       'p{3} of {4:.1f}s'.format(task.name, task.parent_job.name,
+                                                 elapsed, self.percentile,
+                                                 threshold))
+        if not task.event_handler:
+            return
+        event_params = task._serialize()
+        event_params.update({'job_id': task.parent_job.job_id,
+                             'job_name': task.parent_job.name,
+                             'elapsed': elapsed,
+                             'threshold': threshold,
+                             'percentile': self.percentile})
+        task.event_handler.emit('task_slow', event_params)
+
+
+class RemoteOutput(object):
+    """ Output and exit status collected from one remote Task's channel. """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.stdout = []
+        self.stderr = []
+        self.exit_status = None
+        self.completed_at = None
+        self.complete = False
+
+
+    def get_output(self):
+        """ Returns (stdout, stderr) collected so far. """
+        return ''.join(self.stdout), ''.join(self.stderr)
+
+
+class RemoteOutputCollector(threading.Thread):
+    """ Drains the SSH channels of running remote Tasks.
+
+    One thread selects on every registered channel and reads whatever is
+    buffered, read_size bytes at a time, as soon as it arrives. Keeping
+    the channels empty stops a chatty Task from filling the SSH window
+    and stalling until its next completion check.
+    """
+
+    def __init__(self, read_size=32768, timeout=0.5):
+        super(RemoteOutputCollector, self).__init__()
+        self.read_size = read_size
+        self.timeout = timeout
+        self.daemon = True
+
+        self.outputs = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+
+
+    def __repr__(self):
+        return '<RemoteOutputCollector (channels: %d)>' % len(self.outputs)
+
+
+    def add(self, channel):
+        """ Start collecting a channel. Returns its RemoteOutput. """
+        output = RemoteOutput(channel)
+        with self.lock:
+            self.outputs.append(output)
+        self.wakeup.set()
+        return output
+
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+        if self.is_alive():
+            self.join()
+
+
+    def run(self):
+        while not self.stopped:
+            with self.lock:
+                outputs = list(self.outputs)
+            if not outputs:
+                self.wakeup.wait(self.timeout)
+                self.wakeup.clear()
+                continue
+
+            try:
+                select.select([output.channel for output in outputs],
+                              [], [], self.timeout)
+            except (select.error, socket.error, ValueError):
+                # a channel closed under us; draining below will notice
+                pass
+
+            for output in outputs:
+                try:
+                    self._drain(output)
+                except Exception:
+                    logger.exception('Error reading remote task output')
+                    output.complete = True
+                if output.complete:
+                    with self.lock:
+                        self.outputs.remove(output)
+
+
+    def _drain(self, output):
+        """ Read everything buffered on a channel, and its exit status
+        once the remote command has finished and all output is in. """
+        channel = output.channel
+        while channel.recv_ready():
+            data = channel.recv(self.read_size)
+            if not data:
+                break
+            output.stdout.append(data)
+        while channel.recv_stderr_ready():
+            data = channel.recv_stderr(self.read_size)
+            if not data:
+                break
+            output.stderr.append(data)
+
+        if (channel.exit_status_ready() and not channel.recv_ready() and
+            not channel.recv_stderr_ready()):
+            output.exit_status = channel.recv_exit_status()
+            output.completed_at = time.time()
+            output.complete = True
+
+
 class StrictJSONEncoder(json.JSONEncoder):
     def default(self, o):
         try:
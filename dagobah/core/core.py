@@ -1,28 +1,59 @@
 """ Core classes for tasks and jobs (groups of tasks) """
 
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 import time
 import threading
 import subprocess
 import json
+import hashlib
 import paramiko
 import logging
 
 from croniter import croniter
-from copy import deepcopy
 
 from dag import DAG
-from .components import Scheduler, JobState, StrictJSONEncoder
+from .metrics import seconds_since
+from .tracing import NullTracer
+from .resources import reap, wrap_command, split_resources
+from .components import (Scheduler, JobState, ExecutionPlan,
+                         StrictJSONEncoder, RemoteOutputCollector)
 from ..backend.base import BaseBackend
+from ..backend.analytics import analyze
+from .timeline import build_timeline
 
 logger = logging.getLogger('dagobah')
 
+CACHE_CHECKS = ['mtime', 'hash']
+QUEUE_POLICIES = ['skip', 'queue', 'latest']
+
+# seconds a Job's analytics are reused, so runs finished elsewhere show up
+ANALYTICS_TTL = 60
+ANALYTICS_CACHE_SIZE = 16
+ANALYTICS_MAX_DAYS = 3660
+ANALYTICS_MAX_BUCKETS = 1000
+
 class DagobahError(Exception):
     logger.warn('DagobahError being constructed, something must have gone wrong')
     pass
 
 
+def _job_definition(job_json):
+    """ Returns the parts of a Job's serialization its user defined. """
+    tasks = dict([(task['name'], (task['command'],
+                                  task.get('soft_timeout', 0),
+                                  task.get('hard_timeout', 0),
+                                  task.get('hostname', None),
+                                  task.get('cache', None)))
+                  for task in job_json.get('tasks', [])])
+    dependencies = dict([(name, sorted(to_nodes)) for name, to_nodes
+                         in job_json.get('dependencies', {}).iteritems()])
+    return (job_json['name'], tasks, dependencies,
+            job_json.get('cron_schedule', None), job_json.get('notes', None),
+            job_json.get('max_active_runs', 1),
+            job_json.get('queue_policy', 'skip'))
+
+
 class Dagobah(object):
     """ Top-level controller for all Dagobah usage.
 
@@ -32,33 +63,83 @@ class Dagobah(object):
     """
 
     def __init__(self, backend=BaseBackend(), event_handler=None,
-                 ssh_config=None):
-        """ Construct a new Dagobah instance with a specified Backend. """
+                 ssh_config=None, log_writer=None, dagobah_id=None,
+                 scheduler_options=None, cluster=None, workers=None,
+                 metrics=None, tracer=None, slow_tasks=None):
+        """ Construct a new Dagobah instance with a specified Backend.
+
+        If a RunLogWriter is given, run logs are committed through it
+        in the background instead of on the task completion path.
+        If a dagobah_id is given, the instance is loaded from the
+        backend without writing anything to it. scheduler_options are
+        passed on to the Scheduler, e.g. its catchup_policy. If a
+        ClusterMembership is given, this instance only schedules the Jobs
+        its node owns. If a WorkerRegistry is given, remote Tasks run on
+        registered worker agents where possible instead of over SSH.
+        If DagobahMetrics are given, the scheduler, runs and Tasks
+        report to them. If a Tracer is given, each run is traced from
+        its scheduling to the events it emits. If a SlowTaskDetector is
+        given, it emits task_slow for Tasks running longer than usual.
+        """
         logger.debug('Starting Dagobah instance constructor')
         self.backend = backend
         self.event_handler = event_handler
-        self.dagobah_id = self.backend.get_new_dagobah_id()
+        self.log_writer = log_writer
+        self.cluster = cluster
+        self.workers = workers
+        self.metrics = metrics
+        self.tracer = tracer or NullTracer()
+        self.slow_tasks = slow_tasks
         self.jobs = []
+        self.jobs_lock = threading.RLock()
         self.created_jobs = 0
-        self.scheduler = Scheduler(self)
+        self.scheduler = Scheduler(self, **(scheduler_options or {}))
         self.scheduler.daemon = True
         self.ssh_config = ssh_config
+        self.output_collector = None
+        self.output_collector_lock = threading.Lock()
+        self.hydrate_state = threading.local()
 
-        self.scheduler.start()
+        if dagobah_id is None:
+            self.dagobah_id = self.backend.get_new_dagobah_id()
+            self.commit()
+        else:
+            self.dagobah_id = dagobah_id
+            self.from_backend(dagobah_id)
 
-        self.commit()
+        if self.metrics:
+            self.metrics.watch(self)
+        if self.slow_tasks:
+            self.slow_tasks.watch(self)
+        self.scheduler.start()
 
 
     def __repr__(self):
         return '<Dagobah with Backend %s>' % self.backend
 
 
+    @property
+    def hydrating(self):
+        """ Whether this thread is building Jobs from the backend, which
+        mustn't be written back to it. """
+        return getattr(self.hydrate_state, 'active', False)
+
+
+    @hydrating.setter
+    def hydrating(self, value):
+        self.hydrate_state.active = value
+
+
     def set_backend(self, backend):
         """ Manually set backend after construction. """
 
         self.backend = backend
         self.dagobah_id = self.backend.get_new_dagobah_id()
 
+        if self.log_writer:
+            self.log_writer.flush()
+            self.log_writer.backend = backend
+
         for job in self.jobs:
             job.backend = backend
             for task in job.tasks.values():
@@ -74,21 +155,142 @@ class Dagobah(object):
         if not rec:
             raise DagobahError('dagobah with id %s does not exist '
                                'in backend' % dagobah_id)
+        # this instance was committed under an ID of its own
+        if self.dagobah_id != rec['dagobah_id']:
+            self.backend.delete_dagobah(self.dagobah_id)
+
+        # Jobs are stored on their own; older documents embed them
+        jobs = self.backend.get_jobs_json(dagobah_id)
+        if jobs:
+            rec = dict(rec, jobs=jobs)
         self._construct_from_json(rec)
 
+        # next runs in the scheduler checkpoint take precedence over
+        # those stored with each job
+        state = self.backend.get_scheduler_state(dagobah_id) or {}
+        self.scheduler.restore({'jobs': rec.get('jobs', []) +
+                                        state.get('jobs', [])})
+
 
     def _construct_from_json(self, rec):
-        """ Construct this Dagobah instance from a JSON document. """
+        """ Construct this Dagobah instance from a JSON document.
 
-        self.delete()
+        Jobs and Tasks are built in memory straight from the document,
+        so nothing is written back to the backend.
+        """
 
-        for required_key in ['dagobah_id', 'created_jobs']:
-            setattr(self, required_key, rec[required_key])
+        self.jobs = []
+        self.hydrating = True
+        try:
+            for required_key in ['dagobah_id', 'created_jobs']:
+                setattr(self, required_key, rec[required_key])
 
-        for job_json in rec.get('jobs', []):
-            self._add_job_from_spec(job_json)
+            for job_json in rec.get('jobs', []):
+                self.jobs.append(self._load_job_from_spec(job_json))
+        finally:
+            self.hydrating = False
 
-        self.commit(cascade=True)
+
+    def reload_jobs(self):
+        """ Bring this instance's Jobs in line with those in the backend.
+
+        Jobs added by other instances sharing the backend are loaded,
+        those they deleted are dropped and those they changed are
+        rebuilt. Running Jobs are left as they are until a later reload.
+        Returns the Jobs that were loaded or rebuilt.
+        """
+        stored = self.backend.get_jobs_json(self.dagobah_id)
+        if stored is None:
+            return []
+
+        loaded = []
+        with self.jobs_lock:
+            stored = dict([(str(job_json['job_id']), job_json)
+                           for job_json in stored])
+            jobs = []
+            self.hydrating = True
+            try:
+                for job in self.jobs:
+                    job_json = stored.pop(str(job.job_id), None)
+                    if not job.state.allow_change_graph:
+                        jobs.append(job)
+                    elif job_json is None:
+                        logger.info('Dropping job {0}, deleted elsewhere'.format(job.name))
+                    elif (_job_definition(job_json) ==
+                          _job_definition(job._serialize())):
+                        jobs.append(job)
+                    else:
+                        reloaded = self._reload_job(job_json, job)
+                        jobs.append(reloaded)
+                        if reloaded is not job:
+                            loaded.append(reloaded)
+                for job_json in stored.itervalues():
+                    reloaded = self._reload_job(job_json)
+                    if reloaded:
+                        jobs.append(reloaded)
+                        loaded.append(reloaded)
+            finally:
+                self.hydrating = False
+            self.jobs = jobs
+
+        for job in loaded:
+            logger.info('Loaded job {0} from the backend'.format(job.name))
+        return loaded
+
+
+    def _reload_job(self, job_json, previous=None):
+        """ Build a stored Job, keeping the next run of the Job it
+        replaces if its schedule hasn't changed. An invalid stored Job
+        leaves the one it would replace in place. """
+        try:
+            job = self._load_job_from_spec(job_json)
+        except DagobahError:
+            logger.exception('Error loading job {0}'.format(job_json.get('name')))
+            return previous
+        if (previous and previous.next_run and
+            previous.cron_schedule == job.cron_schedule):
+            job.cron_iter = previous.cron_iter
+            job.next_run = previous.next_run
+        return job
+
+
+    def _load_job_from_spec(self, job_json):
+        """ Build a stored Job and its Tasks without committing them. """
+
+        job = Job(self, self.backend, job_json['job_id'], str(job_json['name']))
+
+        for task in job_json.get('tasks', []):
+            name = str(task['name'])
+            job.tasks[name] = Task(job,
+                                   str(task['command']),
+                                   name,
+                                   soft_timeout=task.get('soft_timeout', 0),
+                                   hard_timeout=task.get('hard_timeout', 0),
+                                   hostname=task.get('hostname', None),
+                                   cache=task.get('cache', None))
+
+        # stored graphs were validated as they were built, so validate
+        # once here instead of on every edge
+        job.graph = dict([(name, set()) for name in job.tasks])
+        for from_node, to_nodes in job_json.get('dependencies', {}).iteritems():
+            if from_node not in job.graph or [n for n in to_nodes
+                                              if n not in job.graph]:
+                raise DagobahError('job %s has dependencies on unknown tasks'
+                                   % job.name)
+            job.graph[from_node].update(to_nodes)
+        job._graph_changed()
+        try:
+            job.get_plan()
+        except DagobahError as e:
+            raise DagobahError('job %s has an invalid graph: %s'
+                               % (job.name, e))
+
+        if job_json.get('cron_schedule', None):
+            job.schedule(job_json['cron_schedule'])
+        job.notes = job_json.get('notes', None)
+        job.set_max_active_runs(job_json.get('max_active_runs', 1))
+        job.set_queue_policy(job_json.get('queue_policy', 'skip'))
+        return job
 
 
     def add_job_from_json(self, job_json, destructive=False):
@@ -102,7 +304,7 @@ class Dagobah(object):
                 pass
         self._add_job_from_spec(rec, use_job_id=False)
 
-        self.commit(cascade=True)
+        self.commit()
 
 
     def _add_job_from_spec(self, job_json, use_job_id=True):
@@ -122,7 +324,8 @@ class Dagobah(object):
                                  str(task['name']),
                                  soft_timeout=task.get('soft_timeout', 0),
                                  hard_timeout=task.get('hard_timeout', 0),
-                                 hostname=task.get('hostname', None))
+                                 hostname=task.get('hostname', None),
+                                 cache=task.get('cache', None))
 
         dependencies = job_json.get('dependencies', {})
         for from_node, to_nodes in dependencies.iteritems():
@@ -132,17 +335,26 @@ class Dagobah(object):
         if job_json.get('notes', None):
             job.update_job_notes(job_json['notes'])
 
+        job.set_max_active_runs(job_json.get('max_active_runs', 1))
+        job.set_queue_policy(job_json.get('queue_policy', 'skip'))
+
 
 
     def commit(self, cascade=False):
         """ Commit this Dagobah instance to the backend.
 
-        If cascade is True, all child Jobs are commited as well.
+        Jobs are stored on their own, so that instances sharing the
+        backend don't overwrite each other's. If cascade is True, all
+        child Jobs are commited as well.
         """
+        if self.hydrating:
+            return
         logger.debug('Committing Dagobah instance with cascade={0}'.format(cascade))
-        self.backend.commit_dagobah(self._serialize())
-        if cascade:
-            [job.commit() for job in self.jobs]
+        with self.backend.transaction():
+            self.backend.commit_dagobah({'dagobah_id': self.dagobah_id,
+                                         'created_jobs': self.created_jobs})
+            if cascade:
+                [job.commit() for job in self.jobs]
 
 
     def delete(self):
@@ -163,13 +375,13 @@ class Dagobah(object):
             job_id = self.backend.get_new_job_id()
             self.created_jobs += 1
 
-        self.jobs.append(Job(self,
-                             self.backend,
-                             job_id,
-                             job_name))
+        with self.jobs_lock:
+            self.jobs.append(Job(self,
+                                 self.backend,
+                                 job_id,
+                                 job_name))
 
-        job = self.get_job(job_name)
-        job.commit()
+        self.commit()
 
     def load_ssh_conf(self):
         try:
@@ -202,6 +414,16 @@ class Dagobah(object):
                  for item in sublist if not '*' in item ]
         return hosts
 
+    def get_output_collector(self):
+        """ Returns the RemoteOutputCollector for remote Tasks, starting
+        it the first time one is needed. """
+        with self.output_collector_lock:
+            if not self.output_collector:
+                self.output_collector = RemoteOutputCollector()
+                self.output_collector.start()
+            return self.output_collector
+
+
     def get_host(self, hostname):
         """ Returns a Host dict with config options, or None if none exists"""
         if hostname in self.get_hosts():
@@ -221,12 +443,12 @@ class Dagobah(object):
     def delete_job(self, job_name):
         """ Delete a job by name, or error out if no such job exists. """
         logger.debug('Deleting job {0}'.format(job_name))
-        for idx, job in enumerate(self.jobs):
-            if job.name == job_name:
-                self.backend.delete_job(job.job_id)
-                del self.jobs[idx]
-                self.commit()
-                return
+        with self.jobs_lock:
+            for idx, job in enumerate(self.jobs):
+                if job.name == job_name:
+                    self.backend.delete_job(job.job_id)
+                    del self.jobs[idx]
+                    return
         raise DagobahError('no job with name %s exists' % job_name)
 
 
@@ -280,6 +502,12 @@ class Job(DAG):
     the current serialization of the job with run logs.
     job_failed: On failed completion of the job. Returns
     the current serialization of the job with run logs.
+
+    Each start creates a JobRun. Up to max_active_runs runs may be
+    active at once; scheduled fires that arrive while the Job is at that
+    limit are handled by its queue policy: "skip" drops them, "queue"
+    starts one run per fire as runs finish and "latest" starts a single
+    run for all of them.
     """
 
     def __init__(self, parent, backend, job_id, name):
@@ -295,26 +523,45 @@ class Job(DAG):
 
         # tasks themselves aren't hashable, so we need a secondary lookup
         self.tasks = {}
+        self.graph_version = 0
+        self.plan = None
 
         self.next_run = None
         self.cron_schedule = None
         self.cron_iter = None
-        self.run_log = None
-        self.completion_lock = threading.Lock()
         self.notes = None
 
-        self.snapshot = None
+        self.max_active_runs = 1
+        self.queue_policy = 'skip'
+        self.runs = []
+        self.last_run = None
+        self.queued_runs = 0
+        self.run_lock = threading.RLock()
+        self.analytics_cache = {}
 
-        self._set_status('waiting')
+        self._update_status()
 
         self.commit()
 
 
     def commit(self):
         """ Store metadata on this Job to the backend. """
+        if self.parent.hydrating:
+            return
         logger.debug('Committing job {0}'.format(self.name))
         self.backend.commit_job(self._serialize())
-        self.parent.commit()
+
+
+    @property
+    def run_log(self):
+        """ The run log of the Job's most recent run. """
+        return self.last_run.run_log if self.last_run else None
+
+
+    @property
+    def snapshot(self):
+        """ The ExecutionPlan of the Job's most recent run, while active. """
+        return self.last_run.snapshot if self.last_run else None
 
 
     def add_task(self, command, name=None, **kwargs):
@@ -397,79 +644,189 @@ class Job(DAG):
         self.commit()
 
 
-    def start(self):
-        """ Begins the job by kicking off all tasks with no dependencies. """
+    def set_max_active_runs(self, max_active_runs):
+        """ Set how many runs of this Job may be active at once. """
+        logger.debug('Job {0} setting max active runs'.format(self.name))
+        if (not isinstance(max_active_runs, (int, long)) or
+            isinstance(max_active_runs, bool) or max_active_runs < 1):
+            raise ValueError('max_active_runs must be a positive integer')
+        with self.run_lock:
+            self.max_active_runs = max_active_runs
+            self._update_status()
+        self.commit()
+        self._start_queued_run()
+
+
+    def set_queue_policy(self, queue_policy):
+        """ Set what happens to scheduled fires over max_active_runs. """
+        logger.debug('Job {0} setting queue policy'.format(self.name))
+        if queue_policy not in QUEUE_POLICIES:
+            raise ValueError('queue policy must be one of %s'
+                             % ', '.join(QUEUE_POLICIES))
+        with self.run_lock:
+            self.queue_policy = queue_policy
+            if queue_policy == 'skip':
+                self.queued_runs = 0
+            elif queue_policy == 'latest':
+                self.queued_runs = min(self.queued_runs, 1)
+        self.commit()
+
+
+    def start(self, task_names=None):
+        """ Begins the job by kicking off all tasks with no dependencies.
+
+        If task_names is given, only those Tasks run, ordered by the
+        dependencies between them. See start_from and start_subset.
+        """
 
         logger.info('Job {0} starting job run'.format(self.name))
-        if not self.state.allow_start:
-            raise DagobahError('job cannot be started in its current state; ' +
-                               'it is probably already running')
+        with self.parent.tracer.start_span('job.start', job=self.name):
+            with self.run_lock:
+                if not self.state.allow_start:
+                    raise DagobahError('job cannot be started in its current state; ' +
+                                       'it is probably already running')
 
-        self.initialize_snapshot()
+                run = JobRun(self, task_names)
 
-        # don't increment if the job was run manually
-        if self.cron_iter and datetime.utcnow() > self.next_run:
-            self.next_run = self.cron_iter.get_next(datetime)
+                # don't increment if the job was run manually
+                if self.cron_iter and datetime.utcnow() > self.next_run:
+                    self.next_run = self.cron_iter.get_next(datetime)
 
-        self.run_log = {'job_id': self.job_id,
-                        'name': self.name,
-                        'parent_id': self.parent.dagobah_id,
-                        'log_id': self.backend.get_new_log_id(),
-                        'start_time': datetime.utcnow(),
-                        'tasks': {}}
-        self._set_status('running')
+                self.runs.append(run)
+                self.last_run = run
+                self._update_status()
 
-        logger.debug('Job {0} resetting all tasks prior to start'.format(self.name))
-        for task in self.tasks.itervalues():
-            task.reset()
+            run.start()
+        return run
 
-        logger.debug('Job {0} seeding run logs'.format(self.name))
-        for task_name in self.ind_nodes(self.snapshot):
-            self._put_task_in_run_log(task_name)
-            self.tasks[task_name].start()
 
-        self._commit_run_log()
+    def start_from(self, task_name):
+        """ Run a Task and every Task downstream of it. Returns the run. """
+        return self.start(self.downstream_closure([task_name]))
+
+
+    def start_subset(self, task_names):
+        """ Run the given Tasks and every Task upstream of them. Returns
+        the run. """
+        return self.start(self.upstream_closure(task_names))
+
+
+    def downstream_closure(self, task_names):
+        """ Returns the set of these Tasks and everything downstream. """
+        self._check_task_names(task_names)
+        return self._closure(task_names, self.get_plan().downstream)
+
+
+    def upstream_closure(self, task_names):
+        """ Returns the set of these Tasks and everything they depend on. """
+        self._check_task_names(task_names)
+        return self._closure(task_names, self.get_plan().upstream)
+
+
+    def _check_task_names(self, task_names):
+        if not task_names:
+            raise DagobahError('no tasks given')
+        missing = [name for name in task_names if name not in self.tasks]
+        if missing:
+            raise DagobahError('tasks not found: %s' % ', '.join(missing))
+
+
+    def _closure(self, task_names, edges):
+        """ Returns every node reachable from task_names along edges. """
+        seen = set(task_names)
+        stack = list(task_names)
+        while stack:
+            for node in edges[stack.pop()]:
+                if node not in seen:
+                    seen.add(node)
+                    stack.append(node)
+        return seen
 
 
     def retry(self):
         """ Restarts failed tasks of a job. """
 
         logger.info('Job {0} retrying all failed tasks'.format(self.name))
-        self.initialize_snapshot()
+        with self.run_lock:
+            run = self.last_run
+            if run is None:
+                raise DagobahError('job has not been run')
+            if run in self.runs:
+                raise DagobahError('job run is still active')
+            if not self.state.allow_start:
+                raise DagobahError('job cannot be retried in its current ' +
+                                   'state; it is running too many times')
 
-        failed_task_names = []
-        for task_name, log in self.run_log['tasks'].items():
-            if log.get('success', True) == False:
-                failed_task_names.append(task_name)
+            failed_task_names = run.prepare_retry()
+            self.runs.append(run)
+            self._update_status()
 
-        if len(failed_task_names) == 0:
-            raise DagobahError('no failed tasks to retry')
+        run.start(failed_task_names)
 
-        self._set_status('running')
-        self.run_log['last_retry_time'] = datetime.utcnow()
 
-        logger.debug('Job {0} seeding run logs'.format(self.name))
-        for task_name in failed_task_names:
-            self._put_task_in_run_log(task_name)
-            self.tasks[task_name].start()
+    def queue_run(self):
+        """ Handle a scheduled fire according to the queue policy.
 
-        self._commit_run_log()
+        Starts the Job if it is below max_active_runs, and otherwise
+        drops the fire or keeps it until a run finishes.
+        """
+        with self.run_lock:
+            if self.state.allow_start:
+                self.start()
+                return
+            if self.queue_policy == 'skip':
+                logger.info('Job {0} at max active runs, skipping run'.format(self.name))
+            elif self.queue_policy == 'latest':
+                logger.info('Job {0} at max active runs, queueing latest run'.format(self.name))
+                self.queued_runs = 1
+            else:
+                logger.info('Job {0} at max active runs, queueing run'.format(self.name))
+                self.queued_runs += 1
+
+
+    def _start_queued_run(self):
+        """ Start a queued run if the Job has room for one. """
+        with self.run_lock:
+            if not self.queued_runs or not self.state.allow_start:
+                return
+            self.queued_runs -= 1
+            try:
+                self.start()
+            except Exception:
+                logger.exception('Error starting queued run of job {0}'.format(self.name))
+
+
+    def _run_finished(self, run):
+        """ Called by a JobRun once all its Tasks have completed. """
+        with self.run_lock:
+            if run in self.runs:
+                self.runs.remove(run)
+            self._update_status()
+        self.analytics_cache = {}
+
+
+    def get_active_task(self, task_name):
+        """ Returns the Task running task_name in the latest active run,
+        or the Job's own Task if no active run includes it. """
+        with self.run_lock:
+            for run in reversed(self.runs):
+                if task_name in run.tasks:
+                    return run.tasks[task_name]
+        return self.tasks.get(task_name, None)
 
 
     def terminate_all(self):
         """ Terminate all currently running tasks. """
         logger.info('Job {0} terminating all currently running tasks'.format(self.name))
-        for task in self.tasks.itervalues():
-            if task.started_at and not task.completed_at:
-                task.terminate()
+        for run in list(self.runs):
+            run.terminate_all()
 
 
     def kill_all(self):
         """ Kill all currently running jobs. """
         logger.info('Job {0} killing all currently running tasks'.format(self.name))
-        for task in self.tasks.itervalues():
-            if task.started_at and not task.completed_at:
-                task.kill()
+        for run in list(self.runs):
+            run.kill_all()
 
 
     def edit(self, **kwargs):
@@ -492,7 +849,7 @@ class Job(DAG):
             if key in kwargs and isinstance(kwargs[key], str):
                 setattr(self, key, kwargs[key])
 
-        self.parent.commit(cascade=True)
+        self.commit()
 
 
     def update_job_notes(self, notes):
@@ -502,7 +859,7 @@ class Job(DAG):
 
         setattr(self, 'notes', notes)
 
-        self.parent.commit(cascade=True)
+        self.commit()
 
 
     def edit_task(self, task_name, **kwargs):
@@ -539,109 +896,73 @@ class Job(DAG):
         if 'hostname' in kwargs:
             task.set_hostname(kwargs['hostname'])
 
+        if 'cache' in kwargs:
+            task.set_cache(kwargs['cache'])
+
         if 'name' in kwargs and isinstance(kwargs['name'], str):
             self.rename_edges(task_name, kwargs['name'])
             self.tasks[kwargs['name']] = task
             del self.tasks[task_name]
 
-        self.parent.commit(cascade=True)
-
-
-    def _complete_task(self, task_name, **kwargs):
-        """ Marks this task as completed. Kwargs are stored in the run log. """
-
-        logger.debug('Job {0} marking task {1} as completed'.format(self.name, task_name))
-        self.run_log['tasks'][task_name] = kwargs
-
-        for node in self.downstream(task_name, self.snapshot):
-            self._start_if_ready(node)
-
-        try:
-            self.backend.acquire_lock()
-            self._commit_run_log()
-        except:
-            logger.exception("Error in handling events.")
-        finally:
-            self.backend.release_lock()
-
-        if kwargs.get('success', None) == False:
-            task = self.tasks[task_name]
-            try:
-                self.backend.acquire_lock()
-                if self.event_handler:
-                    self.event_handler.emit('task_failed',
-                                            task._serialize(include_run_logs=True))
-            except:
-                logger.exception("Error in handling events.")
-            finally:
-                self.backend.release_lock()
-
-        self._on_completion()
-
-
-    def _put_task_in_run_log(self, task_name):
-        """ Initializes the run log task entry for this task. """
-        logger.debug('Job {0} initializing run log entry for task {1}'.format(self.name, task_name))
-        data = {'start_time': datetime.utcnow(),
-                'command': self.tasks[task_name].command}
-        self.run_log['tasks'][task_name] = data
-
+        self.commit()
 
-    def _is_complete(self):
-        """ Returns Boolean of whether the Job has completed. """
-        for log in self.run_log['tasks'].itervalues():
-            if 'success' not in log:  # job has not returned yet
-                return False
-        return True
 
-    def _on_completion(self):
-        """ Checks to see if the Job has completed, and cleans up if it has. """
+    def get_run_log_summary(self):
+        """ Returns the compacted summary of this Job's expired run logs. """
+        return self.backend.get_run_log_summary(self.job_id)
 
-        logger.debug('Job {0} running _on_completion check'.format(self.name))
-        if self.state.status != 'running' or (not self._is_complete()):
-            return
 
-        for job, results in self.run_log['tasks'].iteritems():
-            if results.get('success', False) == False:
-                self._set_status('failed')
-                try:
-                    self.backend.acquire_lock()
-                    if self.event_handler:
-                        self.event_handler.emit('job_failed',
-                                                self._serialize(include_run_logs=True))
-                except:
-                    logger.exception("Error in handling events.")
-                finally:
-                    self.backend.release_lock()
-                break
+    def get_analytics(self, days=7, buckets=7):
+        """ Returns duration percentiles, success rates and trends of this
+        Job's runs and of each Task over the last days, in buckets slices.
 
-        if self.state.status != 'failed':
-            self._set_status('waiting')
-            self.run_log = {}
-            try:
-                self.backend.acquire_lock()
-                if self.event_handler:
-                    self.event_handler.emit('job_complete',
-                                            self._serialize(include_run_logs=True))
-            except:
-                logger.exception("Error in handling events.")
-            finally:
-                self.backend.release_lock()
+        Results are cached until a run of this Job finishes here, or for
+        ANALYTICS_TTL seconds at most.
+        """
+        if (not isinstance(days, (int, long, float)) or
+            not 0 < days <= ANALYTICS_MAX_DAYS):
+            raise ValueError('days must be above 0 and at most %d'
+                             % ANALYTICS_MAX_DAYS)
+        if (not isinstance(buckets, (int, long)) or
+            not 1 <= buckets <= ANALYTICS_MAX_BUCKETS):
+            raise ValueError('buckets must be an integer from 1 to %d'
+                             % ANALYTICS_MAX_BUCKETS)
+
+        key = (days, buckets)
+        cached = self.analytics_cache.get(key, None)
+        if cached and time.time() - cached[0] < ANALYTICS_TTL:
+            return cached[1]
+
+        until = datetime.utcnow()
+        since = until - timedelta(days=days)
+        job_series, task_series = self.backend.get_duration_series(self.job_id,
+                                                                   since)
+        result = analyze(job_series, task_series, since, until, buckets)
+
+        if len(self.analytics_cache) >= ANALYTICS_CACHE_SIZE:
+            self.analytics_cache = {}
+        self.analytics_cache[key] = (time.time(), result)
+        return result
 
-        self.destroy_snapshot()
 
+    def get_timeline(self, log_id=None):
+        """ Returns the timeline of a run of this Job, with its critical path
+        and idle gaps, or None if there is no such run.
 
-    def _start_if_ready(self, task_name):
-        """ Start this task if all its dependencies finished successfully. """
-        logger.debug('Job {0} running _start_if_ready for task {1}'.format(self.name, task_name))
-        task = self.tasks[task_name]
-        dependencies = self._dependencies(task_name, self.snapshot)
-        for dependency in dependencies:
-            if self.run_log['tasks'].get(dependency, {}).get('success', False) == True:
-                continue
-            return
-        self._put_task_in_run_log(task_name)
-        task.start()
+        Without a log_id this is the latest run, which may still be going.
+        """
+        run_log = None
+        if log_id is None and self.last_run:
+            # emptied once the run succeeds, else its Tasks may still write to it
+            run_log = self.last_run.run_log
+        if run_log:
+            run_log = dict(run_log)
+            run_log['tasks'] = dict(run_log['tasks'])
+        else:
+            run_log = self.backend.get_job_run_log(self.job_id, log_id)
+        if not run_log:
+            return None
+        return build_timeline(run_log, self.get_plan().upstream)
 
 
     def _set_status(self, status):
@@ -652,10 +973,20 @@ class Job(DAG):
             raise DagobahError('could not set status %s' % status)
 
 
-    def _commit_run_log(self):
-        """" Commit the current run log to the backend. """
-        logger.debug('Committing run log for job {0}'.format(self.name))
-        self.backend.commit_log(self.run_log)
+    def _update_status(self):
+        """ Derive the Job's status from its runs.
+
+        The Job is running while any run is active, and otherwise has the
+        status its latest run ended with. It can be started while it has
+        fewer than max_active_runs active runs.
+        """
+        if self.runs:
+            self._set_status('running')
+        elif self.last_run:
+            self._set_status(self.last_run.status)
+        else:
+            self._set_status('waiting')
+        self.state.allow_start = len(self.runs) < self.max_active_runs
 
 
     def _serialize(self, include_run_logs=False, strict_json=False):
@@ -663,14 +994,11 @@ class Job(DAG):
 
         # return tasks in sorted order if graph is in a valid state
         try:
-            topo_sorted = self.topological_sort()
-            t = [self.tasks[task]._serialize(include_run_logs=include_run_logs,
-                                             strict_json=strict_json)
-                 for task in topo_sorted]
+            task_names = self.get_plan().order
         except:
-            t = [task._serialize(include_run_logs=include_run_logs,
-                                 strict_json=strict_json)
-                 for task in self.tasks.itervalues()]
+            task_names = self.tasks.keys()
+        t = [self._serialize_task(task_name, include_run_logs)
+             for task_name in task_names]
 
         dependencies = {}
         for k, v in self.graph.iteritems():
@@ -684,31 +1012,354 @@ class Job(DAG):
                   'status': self.state.status,
                   'cron_schedule': self.cron_schedule,
                   'next_run': self.next_run,
-                  'notes': self.notes}
+                  'notes': self.notes,
+                  'max_active_runs': self.max_active_runs,
+                  'queue_policy': self.queue_policy}
 
         if strict_json:
             result = json.loads(json.dumps(result, cls=StrictJSONEncoder))
         return result
 
-    def initialize_snapshot(self):
-        """ Copy the DAG and validate """
-        logger.debug('Initializing DAG snapshot for job {0}'.format(self.name))
-        if self.snapshot is not None:
-            logging.warn("Attempting to initialize DAG snapshot without " +
-                         "first destroying old snapshot.")
 
-        snapshot_to_validate = deepcopy(self.graph)
+    def _serialize_task(self, task_name, include_run_logs=False):
+        """ Serialize a Task with the progress of its latest run. """
+        result = self.tasks[task_name]._serialize(include_run_logs=include_run_logs)
+        run = self.last_run
+        if run and task_name in run.tasks:
+            run_task = run.tasks[task_name]
+            result.update({'started_at': run_task.started_at,
+                           'completed_at': run_task.completed_at,
+                           'success': run_task.successful})
+        return result
+
 
-        is_valid, reason = self.validate(snapshot_to_validate)
-        if not is_valid:
-            raise DagobahError(reason)
+    def add_node(self, node_name):
+        super(Job, self).add_node(node_name)
+        self._graph_changed()
 
-        self.snapshot = snapshot_to_validate
 
-    def destroy_snapshot(self):
-        """ Destroy active copy of the snapshot """
-        logger.debug('Destroying DAG snapshot for job {0}'.format(self.name))
+    def delete_node(self, node_name):
+        super(Job, self).delete_node(node_name)
+        self._graph_changed()
+
+
+    def add_edge(self, ind_node, dep_node):
+        super(Job, self).add_edge(ind_node, dep_node)
+        self._graph_changed()
+
+
+    def delete_edge(self, ind_node, dep_node):
+        super(Job, self).delete_edge(ind_node, dep_node)
+        self._graph_changed()
+
+
+    def rename_edges(self, old_task_name, new_task_name):
+        super(Job, self).rename_edges(old_task_name, new_task_name)
+        self._graph_changed()
+
+
+    def _graph_changed(self):
+        """ Mark the compiled plan of the graph as out of date. """
+        self.graph_version += 1
+
+
+    def get_plan(self, task_names=None):
+        """ Returns the ExecutionPlan of the graph, or of the part of it
+        spanned by task_names.
+
+        The plan of the whole graph is compiled once per graph version
+        and shared by every run until the graph changes.
+        """
+        plan = self.plan
+        if plan is None or plan.version != self.graph_version:
+            logger.debug('Compiling execution plan for job {0}'.format(self.name))
+            version = self.graph_version
+            try:
+                plan = ExecutionPlan(self.graph, version)
+            except ValueError as e:
+                raise DagobahError(str(e))
+            self.plan = plan
+
+        if task_names is not None:
+            plan = plan.subset(task_names)
+        return plan
+
+
+class JobRun(object):
+    """ A single run of a Job, with its own snapshot, run log and Tasks.
+
+    The run starts copies of the Job's Tasks, which hold the processes
+    and output of this run only, so runs of the same Job can be active
+    at once. The run stands in for the Job as the parent of its copies.
+
+    For each Task the run counts the dependencies that have yet to
+    succeed, and it counts the Tasks still running, so handling a
+    completed Task only costs as much as the Task's downstream edges.
+    """
+
+    def __init__(self, job, task_names=None):
+        self.job = job
+        self.parent = job.parent
+        self.backend = job.backend
+        self.event_handler = job.event_handler
+        self.job_id = job.job_id
+        self.name = job.name
+        self.completion_lock = threading.Lock()
+        self.status = 'running'
+
+        self.snapshot = job.get_plan(task_names)
+        if not self.snapshot.roots:
+            raise DagobahError('no independent nodes detected')
+        self.tasks = {}
+        self._copy_tasks(self.snapshot)
+
+        self.waiting_on = dict(self.snapshot.in_degree)
+        self.outstanding = 0
+        self.failed = 0
+
+        # kept apart from the run log, which a successful run clears
+        self.log_id = self.backend.get_new_log_id()
+        self.run_log = {'job_id': self.job_id,
+                        'name': self.name,
+                        'parent_id': self.parent.dagobah_id,
+                        'log_id': self.log_id,
+                        'start_time': datetime.utcnow(),
+                        'tasks': {}}
+        if task_names is not None:
+            self.run_log['subset'] = sorted(self.snapshot.order)
+
+        # the run's span parents its Tasks' spans, whichever thread starts them
+        self.span = self.parent.tracer.start_span('job.run', job=self.name,
+                                                  log_id=self.run_log['log_id'])
+        if self.span.trace_id:
+            self.run_log['trace_id'] = self.span.trace_id
+
+
+    def __repr__(self):
+        return '<JobRun %s of %s>' % (self.run_log.get('log_id', None),
+                                      self.name)
+
+
+    def commit(self):
+        """ Task copies belong to the run, so there is nothing to store. """
+        pass
+
+
+    def _copy_tasks(self, task_names):
+        for task_name in task_names:
+            task = self.job.tasks[task_name]
+            self.tasks[task_name] = Task(self, task.command, task.name,
+                                         soft_timeout=task.soft_timeout,
+                                         hard_timeout=task.hard_timeout,
+                                         hostname=task.hostname,
+                                         cache=task.cache)
+
+
+    def start(self, task_names=None):
+        """ Start the given Tasks, or those with no dependencies. """
+        if task_names is None:
+            task_names = self.snapshot.roots
+
+        logger.debug('Job {0} seeding run logs'.format(self.name))
+        # hold completions back until every seeded Task is in the run log
+        with self.completion_lock:
+            for task_name in task_names:
+                self._start_task(task_name)
+
+        self._commit_run_log()
+
+
+    def prepare_retry(self):
+        """ Rebuild the run so its failed Tasks can be started again.
+
+        Failed Tasks are copied from the Job anew, picking up any fixes
+        made since. Returns the names of the failed Tasks.
+        """
+        failed_task_names = []
+        for task_name, log in self.run_log.get('tasks', {}).items():
+            if log.get('success', True) == False:
+                failed_task_names.append(task_name)
+
+        if len(failed_task_names) == 0:
+            raise DagobahError('no failed tasks to retry')
+
+        self.snapshot = self.job.get_plan(self.run_log.get('subset', None))
+        self._copy_tasks(failed_task_names +
+                         [name for name in self.snapshot
+                          if name not in self.tasks])
+
+        # the graph may have changed since, so count again
+        succeeded = set([task_name for task_name, log
+                         in self.run_log['tasks'].iteritems()
+                         if log.get('success', None) == True])
+        self.waiting_on = {}
+        for task_name in self.snapshot:
+            self.waiting_on[task_name] = len([
+                node for node in self.snapshot.upstream[task_name]
+                if node not in succeeded])
+        self.failed = 0
+
+        self.status = 'running'
+        self.run_log['last_retry_time'] = datetime.utcnow()
+        self.span = self.parent.tracer.start_span('job.retry',
+                                                  trace_id=self.span.trace_id,
+                                                  job=self.name,
+                                                  retried=len(failed_task_names))
+        return failed_task_names
+
+
+    def terminate_all(self):
+        """ Terminate all currently running tasks of this run. """
+        for task in self.tasks.values():
+            if task.started_at and not task.completed_at:
+                task.terminate()
+
+
+    def kill_all(self):
+        """ Kill all currently running tasks of this run. """
+        for task in self.tasks.values():
+            if task.started_at and not task.completed_at:
+                task.kill()
+
+
+    def _complete_task(self, task_name, **kwargs):
+        """ Marks this task as completed. Kwargs are stored in the run log. """
+
+        logger.debug('Job {0} marking task {1} as completed'.format(self.name, task_name))
+        with self.parent.tracer.start_span('job.complete_task', task=task_name):
+            self._record_completion(task_name, kwargs)
+        self._on_completion()
+
+
+    def _record_completion(self, task_name, kwargs):
+        """ Log a Task's result, start what it unblocks and commit. """
+        previous = self.run_log['tasks'].get(task_name, {})
+        if 'success' not in previous:
+            self.outstanding -= 1
+        for key in ['ready_time', 'command']:
+            if key in previous:
+                kwargs.setdefault(key, previous[key])
+        self.run_log['tasks'][task_name] = kwargs
+
+        if kwargs.get('success', None) == True:
+            for node in self.snapshot.downstream[task_name]:
+                self.waiting_on[node] -= 1
+                if self.waiting_on[node] == 0:
+                    self._start_task(node)
+        else:
+            self.failed += 1
+
+        with self.backend.lock(self.job_id):
+            try:
+                self._commit_run_log()
+            except:
+                logger.exception("Error in handling events.")
+
+        if kwargs.get('success', None) == False:
+            task = self.tasks[task_name]
+            with self.backend.lock(self.job_id):
+                try:
+                    if self.event_handler:
+                        self._flush_run_log()
+                        if self.event_handler.include_run_logs:
+                            event_params = task._serialize(include_run_logs=True)
+                        else:
+                            event_params = {'name': task_name,
+                                            'log_id': self.run_log['log_id']}
+                        event_params.update({'job_id': self.job_id,
+                                             'job_name': self.name})
+                        self.event_handler.emit('task_failed', event_params)
+                except:
+                    logger.exception("Error in handling events.")
+
+
+    def _put_task_in_run_log(self, task_name):
+        """ Initializes the run log task entry for this task. """
+        logger.debug('Job {0} initializing run log entry for task {1}'.format(self.name, task_name))
+        now = datetime.utcnow()
+        data = {'start_time': now,
+                'ready_time': now,
+                'command': self.tasks[task_name].command}
+        self.run_log['tasks'][task_name] = data
+
+
+    def _is_complete(self):
+        """ Returns Boolean of whether the run has completed. """
+        return self.outstanding == 0
+
+
+    def _on_completion(self):
+        """ Checks to see if the run has completed, and cleans up if it has. """
+
+        logger.debug('Job {0} running _on_completion check'.format(self.name))
+        if self.status != 'running' or (not self._is_complete()):
+            return
+
+        metrics = self.parent.metrics
+        if metrics and self.run_log.get('start_time'):
+            metrics.run_duration.observe(seconds_since(self.run_log['start_time']),
+                                         self.name,
+                                         'failed' if self.failed else 'success')
+
+        if self.failed:
+            self.status = 'failed'
+            self.job._run_finished(self)
+            with self.backend.lock(self.job_id):
+                try:
+                    if self.event_handler:
+                        self._flush_run_log()
+                        if self.event_handler.include_run_logs:
+                            event_params = self.job._serialize(include_run_logs=True)
+                        else:
+                            event_params = {'job_id': self.job_id,
+                                            'name': self.name,
+                                            'log_id': self.run_log['log_id']}
+                        self.event_handler.emit('job_failed', event_params)
+                except:
+                    logger.exception("Error in handling events.")
+        else:
+            self.status = 'waiting'
+            self.run_log = {}
+            self.job._run_finished(self)
+            with self.backend.lock(self.job_id):
+                try:
+                    if self.event_handler:
+                        self._flush_run_log()
+                        self.event_handler.emit('job_complete',
+                                                self.job._serialize(include_run_logs=True))
+                except:
+                    logger.exception("Error in handling events.")
+
+        self.span.finish(status=self.status, failed=self.failed)
         self.snapshot = None
+        self.job._start_queued_run()
+
+
+    def _start_task(self, task_name):
+        """ Start this task, whose dependencies have all succeeded. """
+        logger.debug('Job {0} starting task {1}'.format(self.name, task_name))
+        self._put_task_in_run_log(task_name)
+        self.outstanding += 1
+        self.tasks[task_name].start()
+
+
+    def _commit_run_log(self):
+        """" Commit the current run log to the backend.
+
+        If the parent Dagobah has a RunLogWriter, the commit is queued
+        and this returns without waiting on the backend.
+        """
+        logger.debug('Committing run log for job {0}'.format(self.name))
+        if self.parent.log_writer:
+            self.parent.log_writer.commit(self.run_log)
+        else:
+            self.backend.commit_log(self.run_log)
+
+
+    def _flush_run_log(self):
+        """ Wait for queued commits of this Job's run logs to finish. """
+        if self.parent.log_writer:
+            self.parent.log_writer.flush(self.job_id)
 
 
 class Task(object):
@@ -720,7 +1371,7 @@ class Task(object):
     """
 
     def __init__(self, parent_job, command, name,
-                 soft_timeout=0, hard_timeout=0, hostname=None):
+                 soft_timeout=0, hard_timeout=0, hostname=None, cache=None):
         logger.debug('Starting Task instance constructor with name {0}'.format(name))
         self.parent_job = parent_job
         self.backend = self.parent_job.backend
@@ -730,6 +1381,8 @@ class Task(object):
         self.hostname = hostname
 
         self.remote_channel = None
+        self.remote_output = None
+        self.assignment = None
         self.process = None
         self.stdout = ""
         self.stderr = ""
@@ -741,13 +1394,19 @@ class Task(object):
         self.started_at = None
         self.completed_at = None
         self.successful = None
+        self.last_checked = None
+        self.span = None
+        self.polls = 0
+        self.resources = None
 
         self.terminate_sent = False
         self.kill_sent = False
         self.remote_failure = False
+        self.cache_key = None
 
         self.set_soft_timeout(soft_timeout)
         self.set_hard_timeout(hard_timeout)
+        self.set_cache(cache)
 
         self.parent_job.commit()
 
@@ -771,6 +1430,71 @@ class Task(object):
         self.hostname = hostname
         self.parent_job.commit()
 
+
+    def set_cache(self, cache):
+        """ Turn result caching on with a spec, or off with None.
+
+        A cached Task is skipped when a previous successful run had the
+        same cache key, which covers its command, hostname, the values of
+        the environment variables listed in the spec's 'env' and the
+        files listed in its 'inputs'. Files are compared by size and
+        modification time, or by content if 'check' is 'hash'. Input
+        files are read on the daemon's host. A spec of True caches on
+        the command and hostname alone.
+        """
+        logger.debug('Task {0} setting cache'.format(self.name))
+        if cache is None or cache is False:
+            self.cache = None
+        elif cache is True:
+            self.cache = {'inputs': [], 'env': [], 'check': 'mtime'}
+        elif isinstance(cache, dict):
+            unknown = set(cache.keys()) - set(['inputs', 'env', 'check'])
+            if unknown:
+                raise ValueError('unknown cache options: %s'
+                                 % ', '.join(sorted(unknown)))
+            result = {'inputs': cache.get('inputs', []),
+                      'env': cache.get('env', []),
+                      'check': cache.get('check', 'mtime')}
+            for key in ['inputs', 'env']:
+                if (not isinstance(result[key], list) or
+                    not all([isinstance(v, basestring) for v in result[key]])):
+                    raise ValueError('cache %s must be a list of strings' % key)
+            if result['check'] not in CACHE_CHECKS:
+                raise ValueError('cache check must be one of %s'
+                                 % ', '.join(CACHE_CHECKS))
+            self.cache = result
+        else:
+            raise ValueError('cache must be a dict, True or None')
+        self.parent_job.commit()
+
+
+    def get_cache_key(self):
+        """ Returns the cache key for the Task's command and inputs now. """
+        inputs = dict([(path, self._fingerprint(path))
+                       for path in self.cache['inputs']])
+        env = dict([(name, os.environ.get(name, None))
+                    for name in self.cache['env']])
+        key = {'command': self.command,
+               'hostname': self.hostname,
+               'inputs': inputs,
+               'env': env}
+        return hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+
+
+    def _fingerprint(self, path):
+        """ Returns what identifies this version of an input file. """
+        path = os.path.expanduser(path)
+        if not os.path.exists(path):
+            return None
+        if self.cache['check'] == 'hash':
+            digest = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), ''):
+                    digest.update(chunk)
+            return digest.hexdigest()
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime]
+
     def reset(self):
         """ Reset this Task to a clean state prior to execution. """
 
@@ -789,27 +1513,98 @@ class Task(object):
         self.terminate_sent = False
         self.kill_sent = False
         self.remote_failure = False
+        self.remote_output = None
+        self.assignment = None
+        self.cache_key = None
+        self.polls = 0
+        self.resources = None
 
     def start(self):
         """ Begin execution of this task. """
         logger.info('Starting task {0}'.format(self.name))
         self.reset()
-        if self.hostname:
-            host = self.parent_job.parent.get_host(self.hostname)
-            if host:
-                self.remote_ssh(host)
-            else:
-                self.remote_failure = True
-        else:
-            self.process = subprocess.Popen(self.command,
-                                            shell=True,
-                                            env=os.environ.copy(),
-                                            stdout=self.stdout_file,
-                                            stderr=self.stderr_file)
+        tracer = self.parent_job.parent.tracer
+        self.span = tracer.start_span('task.run', parent=self.parent_job.span,
+                                      task=self.name)
+        if self.cache and self._start_from_cache():
+            return
 
+        spawn_start = time.time()
+        with tracer.start_span('task.spawn', parent=self.span) as span:
+            workers = self.parent_job.parent.workers
+            if self.hostname and workers:
+                self.assignment = workers.assign(self)
+            if self.assignment:
+                logger.debug('Task {0} assigned to worker {1}'.format(self.name, self.assignment.worker_id))
+            elif self.hostname:
+                host = self.parent_job.parent.get_host(self.hostname)
+                if host:
+                    self.remote_ssh(host)
+                else:
+                    self.remote_failure = True
+            else:
+                self.process = subprocess.Popen(self.command,
+                                                shell=True,
+                                                env=os.environ.copy(),
+                                                stdout=self.stdout_file,
+                                                stderr=self.stderr_file)
+            span.set(kind=self._get_kind())
+
+        metrics = self.parent_job.parent.metrics
+        if metrics:
+            metrics.spawn_latency.observe(time.time() - spawn_start,
+                                          self._get_kind())
         self.started_at = datetime.utcnow()
+        self.last_checked = time.time()
+        slow_tasks = self.parent_job.parent.slow_tasks
+        if slow_tasks:
+            slow_tasks.track(self)
         self._start_check_timer()
 
+    def _start_from_cache(self):
+        """ Complete with a previous run's result if the cache key matches.
+
+        Returns Boolean of whether a cached result is being used.
+        """
+        try:
+            self.cache_key = self.get_cache_key()
+            cached = self.backend.get_cached_run(self.parent_job.job_id,
+                                                 self.name, self.cache_key)
+        except Exception:
+            logger.exception('Error looking up cached result for task {0}'.format(self.name))
+            return False
+        if not cached:
+            return False
+
+        logger.info('Task {0} reusing cached result'.format(self.name))
+        self.started_at = datetime.utcnow()
+        # completing takes the Job's completion lock, which whoever
+        # started this Task may be holding
+        self.timer = threading.Timer(0, self._complete_from_cache, [cached])
+        self.timer.daemon = True
+        self.timer.start()
+        return True
+
+    def _complete_from_cache(self, cached):
+        for temp_file in [self.stdout_file, self.stderr_file]:
+            temp_file.close()
+        self.stdout_file = None
+        self.stderr_file = None
+        self.stdout = cached.get('stdout', '')
+        self.stderr = cached.get('stderr', '')
+
+        # this Timer thread has no current span, so parent the completion
+        # to this Task's, as check_complete does
+        tracer = self.parent_job.parent.tracer
+        with tracer.start_span('task.cache_hit', parent=self.span):
+            self._task_complete(success=True,
+                                return_code=cached.get('return_code', 0),
+                                stdout=self.stdout,
+                                stderr=self.stderr,
+                                start_time=self.started_at,
+                                complete_time=datetime.utcnow(),
+                                cache_hit=True)
+
     def remote_ssh(self, host):
         """ Execute a command on SSH. Takes a paramiko host dict """
         logger.info('Starting remote execution of task {0} on host {1}'.format(self.name, host['hostname']))
@@ -826,7 +1621,9 @@ class Task(object):
 
             self.remote_channel = transport.open_session()
             self.remote_channel.get_pty()
-            self.remote_channel.exec_command(self.command)
+            self.remote_channel.exec_command(wrap_command(self.command))
+            collector = self.parent_job.parent.get_output_collector()
+            self.remote_output = collector.add(self.remote_channel)
         except Exception as e:
             logger.warn('Exception encountered in remote task execution')
             self.remote_failure = True
@@ -845,10 +1642,22 @@ class Task(object):
         logger.debug('Running check_complete for task {0}'.format(self.name))
 
         # Tasks not completed
-        if self.remote_not_complete() or self.local_not_complete():
+        checked = time.time()
+        self.polls += 1
+        if (self.worker_not_complete() or self.remote_not_complete() or
+            self.local_not_complete()):
+            self.last_checked = checked
             self._start_check_timer()
             return
 
+        self._observe_detection()
+        tracer = self.parent_job.parent.tracer
+        with tracer.start_span('task.check_complete', parent=self.span,
+                               polls=self.polls):
+            self._finish_check()
+
+    def _finish_check(self):
+        """ Collect the finished Task's output and report its result. """
         return_code = self.completed_task()
 
         # Handle task errors
@@ -868,40 +1677,92 @@ class Task(object):
                             stdout=self.stdout,
                             stderr=self.stderr,
                             start_time=self.started_at,
-                            complete_time=datetime.utcnow())
+                            complete_time=datetime.utcnow(),
+                            resources=self.resources)
+
+    def _get_kind(self):
+        """ Returns how this Task runs: on a worker, over SSH or locally. """
+        if self.assignment:
+            return 'worker'
+        return 'ssh' if self.hostname else 'local'
+
+    def _get_host(self):
+        """ Returns the worker or SSH host this Task runs on, or None. """
+        if self.assignment:
+            return self.assignment.worker_id
+        return self.hostname
+
+    def _observe_detection(self):
+        """ Report how long this Task's finish went unnoticed.
+
+        Workers and the remote output collector record when a Task
+        finished. A local exit is only polled for, so the time since the
+        last check that found it running is used as an upper bound.
+        """
+        metrics = self.parent_job.parent.metrics
+        if not metrics:
+            return
+        finished_at = None
+        if self.assignment:
+            finished_at = self.assignment.completed_at
+        elif self.remote_output:
+            finished_at = self.remote_output.completed_at
+        elif self.process:
+            finished_at = self.last_checked
+        if finished_at:
+            metrics.detection_latency.observe(time.time() - finished_at,
+                                              self._get_kind())
 
     def remote_not_complete(self):
         """
         Returns True if this task is on a remote channel, and on a remote
         machine, False if it is either not remote or not completed
         """
-        if self.remote_channel and not self.remote_channel.exit_status_ready():
+        if self.remote_output and not self.remote_output.complete:
+            self._timeout_check()
+            return True
+        return False
+
+    def worker_not_complete(self):
+        """ Returns True if task is assigned to a live worker and not completed """
+        if self.assignment and not self.assignment.is_complete():
+            if not self.parent_job.parent.workers.is_live(self.assignment.worker_id):
+                logger.warn('Lost worker {0} running task {1}'.format(self.assignment.worker_id, self.name))
+                self.assignment.lost = True
+                self.remote_failure = True
+                return False
             self._timeout_check()
-            # Get some stdout/std error
-            if self.remote_channel.recv_ready():
-                self.stdout += self.remote_channel.recv(1024)
-            if self.remote_channel.recv_stderr_ready():
-                self.stderr += self.remote_channel.recv_stderr(1024)
             return True
         return False
 
     def local_not_complete(self):
         """ Returns True if task is local and not completed"""
-        if self.process and self.process.poll() is None:
+        if not self.process or self.process.returncode is not None:
+            return False
+        # reaping it ourselves keeps its resource usage
+        resources = reap(self.process)
+        if resources is None:
             self._timeout_check()
             return True
+        self.resources = resources or None
         return False
 
     def completed_task(self):
         """ Handle wrapping up a completed task, local or remote"""
-        # If its remote and finished running
-        if self.remote_channel and self.remote_channel.exit_status_ready():
-            # Collect all remaining stdout/stderr
-            while self.remote_channel.recv_ready():
-                self.stdout += self.remote_channel.recv(1024)
-            while self.remote_channel.recv_stderr_ready():
-                self.stderr += self.remote_channel.recv_stderr(1024)
-            return self.remote_channel.recv_exit_status()
+        # If a worker ran it, its output has already been streamed back
+        if self.assignment:
+            self.stdout, self.stderr = self.assignment.get_output()
+            self.resources = self.assignment.resources
+            self.parent_job.parent.workers.finish(self.assignment)
+            return self.assignment.return_code
+        # If its remote, the collector has drained its channel, and
+        # the command's wrapper has written its usage into the output
+        if self.remote_output:
+            stdout, stderr = self.remote_output.get_output()
+            self.stdout, stdout_resources = split_resources(stdout)
+            self.stderr, stderr_resources = split_resources(stderr)
+            self.resources = stdout_resources or stderr_resources
+            return self.remote_output.exit_status
         # Otherwise check for finished local command
         elif self.process:
             self.stdout, self.stderr = (self._read_temp_file(self.stdout_file),
@@ -913,6 +1774,11 @@ class Task(object):
     def terminate(self):
         """ Send SIGTERM to the task's process. """
         logger.info('Sending SIGTERM to task {0}'.format(self.name))
+        if self.assignment:
+            self.terminate_sent = True
+            self.parent_job.parent.workers.send_signal(self.assignment,
+                                                       'terminate')
+            return
         if hasattr(self, 'remote_client') and self.remote_client is not None:
             self.terminate_sent = True
             self.remote_client.close()
@@ -926,6 +1792,10 @@ class Task(object):
     def kill(self):
         """ Send SIGKILL to the task's process. """
         logger.info('Sending SIGKILL to task {0}'.format(self.name))
+        if self.assignment:
+            self.kill_sent = True
+            self.parent_job.parent.workers.send_signal(self.assignment, 'kill')
+            return
         if hasattr(self, 'remote_client') and self.remote_client is not None:
             self.kill_sent = True
             self.remote_client.close()
@@ -1071,6 +1941,16 @@ class Task(object):
     def _task_complete(self, **kwargs):
         """ Performs cleanup tasks and notifies Job that the Task finished. """
         logger.debug('Running _task_complete for task {0}'.format(self.name))
+        if self.cache_key:
+            kwargs['cache_key'] = self.cache_key
+        kwargs['host'] = self._get_host()
+        slow_tasks = self.parent_job.parent.slow_tasks
+        if slow_tasks and self.started_at and not kwargs.get('cache_hit'):
+            slow_tasks.record(self, seconds_since(self.started_at),
+                              kwargs.get('success', None))
+        if self.span:
+            self.span.finish(success=kwargs.get('success', None),
+                             return_code=kwargs.get('return_code', None))
         with self.parent_job.completion_lock:
             self.completed_at = datetime.utcnow()
             self.successful = kwargs.get('success', None)
@@ -1087,7 +1967,8 @@ class Task(object):
                   'success': self.successful,
                   'soft_timeout': self.soft_timeout,
                   'hard_timeout': self.hard_timeout,
-                  'hostname': self.hostname}
+                  'hostname': self.hostname,
+                  'cache': self.cache}
 
         if include_run_logs:
             last_run = self.backend.get_latest_run_log(self.parent_job.job_id,
@@ -0,0 +1,273 @@
+""" In-process metrics, served in the Prometheus text exposition format. """
+
+import time
+import bisect
+import threading
+from datetime import datetime
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+DURATION_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 300.0, 900.0,
+                    1800.0, 3600.0, 7200.0, 21600.0, 86400.0)
+
+
+def seconds_since(start):
+    """ Returns the seconds from a UTC datetime until now. """
+    delta = datetime.utcnow() - start
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = unicode(value).replace('\\', '\\\\').replace('\n', '\\n')
+        pairs.append(u'%s="%s"' % (name, value.replace('"', '\\"')))
+    return u'{%s}' % u','.join(pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    """ A named metric with a fixed set of label names.
+
+    Values are kept per tuple of label values, e.g. observe(0.2, 'web')
+    for a metric with labels ('job',). Updates take a lock of their own
+    and do no formatting, which is left to render().
+    """
+
+    metric_type = None
+
+    def __init__(self, name, help_text, labels=(), function=None):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        self.function = function
+
+
+    def render(self):
+        if self.function:
+            # a function returns {label values: value}, or a bare value
+            result = self.function()
+            with self.lock:
+                self.values = (result if isinstance(result, dict)
+                               else {(): result})
+        lines = ['# HELP %s %s' % (self.name, self.help_text),
+                 '# TYPE %s %s' % (self.name, self.metric_type)]
+        with self.lock:
+            items = sorted(self.values.items())
+        for label_values, value in items:
+            lines.extend(self._render_sample(label_values, value))
+        return lines
+
+
+    def _render_sample(self, label_values, value):
+        return [u'%s%s %s' % (self.name,
+                              _format_labels(self.labels, label_values),
+                              _format_value(value))]
+
+
+class Counter(Metric):
+    """ A value that only goes up, or is read from a function that
+    returns a running total. """
+
+    metric_type = 'counter'
+
+    def inc(self, amount=1, *label_values):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    """ A value that goes up and down, or is read from a function. """
+
+    metric_type = 'gauge'
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+
+class Histogram(Metric):
+    """ Counts observations into cumulative buckets. """
+
+    metric_type = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(label_values, None)
+            if counts is None:
+                # one count per bucket, then the sum
+                counts = self.values[label_values] = [0] * len(self.buckets) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+
+    def time(self, *label_values):
+        """ Returns a context manager observing the time spent in it. """
+        return _Timer(self, label_values)
+
+
+    def get_count(self, *label_values):
+        with self.lock:
+            counts = self.values.get(label_values, None)
+            return sum(counts[:-1]) if counts else 0
+
+
+    def _render_sample(self, label_values, counts):
+        names = self.labels + ('le',)
+        lines, total = [], 0
+        for bound, count in zip(self.buckets, counts):
+            total += count
+            lines.append(u'%s_bucket%s %d'
+                         % (self.name,
+                            _format_labels(names, label_values +
+                                           (_format_value(bound),)),
+                            total))
+        labels = _format_labels(self.labels, label_values)
+        lines.append(u'%s_sum%s %s' % (self.name, labels, _format_value(counts[-1])))
+        lines.append(u'%s_count%s %d' % (self.name, labels, total))
+        return lines
+
+
+class _Timer(object):
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.started, *self.label_values)
+
+
+class MetricsRegistry(object):
+    """ A set of metrics rendered together. """
+
+    def __init__(self):
+        self.metrics = []
+
+
+    def __repr__(self):
+        return '<MetricsRegistry (metrics: %d)>' % len(self.metrics)
+
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+
+    def counter(self, name, help_text, labels=(), function=None):
+        return self.add(Counter(name, help_text, labels, function))
+
+
+    def gauge(self, name, help_text, labels=(), function=None):
+        return self.add(Gauge(name, help_text, labels, function))
+
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(name, help_text, labels, buckets))
+
+
+    def render(self):
+        """ Returns every metric in the text exposition format. """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return u'\n'.join(lines) + u'\n'
+
+
+class DagobahMetrics(MetricsRegistry):
+    """ The metrics a Dagobah and its daemon report.
+
+    Give one to a Dagobah to have its scheduler, runs and Tasks report
+    to it. Wrap the backend in an InstrumentedBackend to time its calls.
+    Gauges read from the Dagobah and its EventHandler are added by
+    watch(), so they cost nothing until scraped.
+    """
+
+    def __init__(self):
+        super(DagobahMetrics, self).__init__()
+        self.fire_lag = self.histogram(
+            'dagobah_scheduler_fire_lag_seconds',
+            'Time from a scheduled run being due to the job starting.')
+        self.run_duration = self.histogram(
+            'dagobah_job_run_duration_seconds',
+            'Duration of job runs, by job and outcome.',
+            labels=('job', 'status'), buckets=DURATION_BUCKETS)
+        self.spawn_latency = self.histogram(
+            'dagobah_task_spawn_seconds',
+            'Time to spawn a task process, open its SSH session or assign it to a worker.',
+            labels=('kind',))
+        self.detection_latency = self.histogram(
+            'dagobah_task_completion_detection_seconds',
+            'Time from a task finishing to dagobah noticing. For local '
+            'tasks this is an upper bound, since exits are polled.',
+            labels=('kind',))
+        self.backend_latency = self.histogram(
+            'dagobah_backend_call_seconds',
+            'Latency of backend calls, by method.',
+            labels=('method',))
+        self.backend_errors = self.counter(
+            'dagobah_backend_call_errors_total',
+            'Backend calls that raised, by method.',
+            labels=('method',))
+        self.api_latency = self.histogram(
+            'dagobah_api_request_seconds',
+            'Latency of HTTP requests, by endpoint and status code.',
+            labels=('endpoint', 'status'))
+
+
+    def watch(self, dagobah):
+        """ Add gauges read from a Dagobah and its EventHandler. """
+        runs = lambda: [run for job in list(dagobah.jobs) for run in list(job.runs)]
+        self.gauge('dagobah_running_tasks',
+                   'Tasks currently running.',
+                   function=lambda: sum([run.outstanding for run in runs()]))
+        self.gauge('dagobah_active_job_runs',
+                   'Job runs currently active.',
+                   function=lambda: len(runs()))
+
+        handler = dagobah.event_handler
+        if handler is None:
+            return
+        self.counter('dagobah_event_dispatch_seconds_total',
+                     'Total time from emitting events to their handlers returning.',
+                     labels=('event',),
+                     function=lambda: self._event_metrics(handler, 'total_latency'))
+        self.gauge('dagobah_event_dispatch_max_seconds',
+                   'Longest time from emitting an event to its handlers returning.',
+                   labels=('event',),
+                   function=lambda: self._event_metrics(handler, 'max_latency'))
+        self.counter('dagobah_events_dispatched_total',
+                     'Events whose handlers have run.',
+                     labels=('event',),
+                     function=lambda: self._event_metrics(handler, 'dispatched'))
+        self.counter('dagobah_events_dropped_total',
+                     'Events dropped because their queue was full.',
+                     labels=('event',),
+                     function=lambda: self._event_metrics(handler, 'dropped'))
+        self.gauge('dagobah_event_queue_depth',
+                   'Events waiting for a handler thread.',
+                   labels=('event',),
+                   function=lambda: self._event_metrics(handler, 'queue_depth'))
+
+
+    def _event_metrics(self, handler, key):
+        return dict([((event,), metrics[key])
+                     for event, metrics in handler.get_metrics().iteritems()])
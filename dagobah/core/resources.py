@@ -0,0 +1,92 @@
+""" Resource usage of finished Task processes. """
+
+import os
+import json
+import errno
+import pipes
+
+# prefixes the line a wrapped remote command writes its usage on
+RESOURCES_MARKER = '__DAGOBAH_RESOURCES__ '
+
+# runs a command in the user's shell, as SSH would, then reports its
+# usage; kept to Python 2 and 3 alike
+WRAPPER_SCRIPT = '''import os, sys, json, subprocess
+p = subprocess.Popen([os.environ.get("SHELL") or "/bin/sh", "-c", sys.argv[1]])
+pid, status, ru = os.wait4(p.pid, 0)
+sys.stdout.flush()
+sys.stderr.write(%r + json.dumps({"user_time": ru.ru_utime, "system_time": ru.ru_stime,
+    "max_rss_kb": ru.ru_maxrss, "block_input": ru.ru_inblock,
+    "block_output": ru.ru_oublock}) + "\\n")
+sys.exit(os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128 + os.WTERMSIG(status))
+''' % RESOURCES_MARKER
+
+
+def from_rusage(rusage):
+    """ Returns the parts of a struct rusage kept in run logs.
+
+    Times are in seconds, max_rss_kb in kilobytes and block I/O in
+    operations, as Linux reports them.
+    """
+    return {'user_time': rusage.ru_utime,
+            'system_time': rusage.ru_stime,
+            'max_rss_kb': rusage.ru_maxrss,
+            'block_input': rusage.ru_inblock,
+            'block_output': rusage.ru_oublock}
+
+
+def reap(process, block=False):
+    """ Reap a finished Popen with wait4, keeping its resource usage.
+
+    Returns None while the process is still running. Otherwise the
+    Popen's returncode is set and its usage is returned, which is empty
+    if something else already reaped it.
+    """
+    if process.returncode is not None:
+        return {}
+    try:
+        pid, status, rusage = os.wait4(process.pid, 0 if block else os.WNOHANG)
+    except OSError as e:
+        if e.errno != errno.ECHILD:
+            raise
+        process.poll()
+        return {}
+    if pid == 0:
+        return None
+
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return from_rusage(rusage)
+
+
+def wrap_command(command):
+    """ Returns a shell command running command and reporting its usage.
+
+    The command runs in the user's $SHELL, like any command sent over
+    SSH, and its usage is written as a marked line after its output.
+    Hosts without Python run the command as it is.
+    """
+    script = ('PY=$(command -v python3 || command -v python); '
+              'if [ -n "$PY" ]; then exec "$PY" -c %s %s; '
+              'else exec "${SHELL:-/bin/sh}" -c %s; fi' % (pipes.quote(WRAPPER_SCRIPT),
+                                          pipes.quote(command),
+                                          pipes.quote(command)))
+    return 'sh -c %s' % pipes.quote(script)
+
+
+def split_resources(output):
+    """ Returns output without a wrapped command's usage line, and the usage.
+
+    The usage is None if output has no usage line.
+    """
+    index = output.rfind(RESOURCES_MARKER)
+    if index == -1 or (index > 0 and output[index - 1] not in '\r\n'):
+        return output, None
+    end = output.find('\n', index)
+    end = len(output) if end == -1 else end + 1
+    try:
+        resources = json.loads(output[index + len(RESOURCES_MARKER):end].strip())
+    except ValueError:
+        return output, None
+    return output[:index] + output[end:], resources
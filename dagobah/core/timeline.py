@@ -0,0 +1,108 @@
+""" Where the wall-clock time of a job run went, from its run log. """
+
+from datetime import datetime
+
+
+def _seconds(start, end):
+    delta = end - start
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+def _ready_time(task_log, upstream, task_logs, run_start):
+    """ Returns when a task's dependencies had all finished.
+
+    Run logs record this as ready_time; for older ones it's taken to be
+    the latest completion among its upstream tasks in the run.
+    """
+    if isinstance(task_log.get('ready_time', None), datetime):
+        return task_log['ready_time']
+    finished = [task_logs[name]['complete_time'] for name in upstream
+                if isinstance(task_logs.get(name, {}).get('complete_time', None),
+                              datetime)]
+    return max(finished + [run_start])
+
+
+def _idle_gaps(intervals, start, end):
+    """ Returns the (start, end) spans between start and end where none
+    of the intervals were running. """
+    gaps = []
+    cursor = start
+    for interval_start, interval_end in sorted(intervals):
+        if interval_start > cursor:
+            gaps.append((cursor, interval_start))
+        cursor = max(cursor, interval_end)
+    if end > cursor:
+        gaps.append((cursor, end))
+    return gaps
+
+
+def _critical_path(bars, upstream):
+    """ Returns the names of the tasks on the realized critical path.
+
+    Starting from the task that finished last, each step goes to the
+    upstream task that finished last, as that's the one it waited on.
+    """
+    if not bars:
+        return []
+    current = max(bars.itervalues(), key=lambda bar: bar['end'])['name']
+    path = [current]
+    while True:
+        finished = [bars[name] for name in upstream.get(current, ())
+                    if name in bars]
+        if not finished:
+            break
+        current = max(finished, key=lambda bar: bar['end'])['name']
+        path.append(current)
+    path.reverse()
+    return path
+
+
+def build_timeline(run_log, upstream, now=None):
+    """ Returns a per-task timeline of a run, with its critical path and
+    the gaps where nothing ran.
+
+    upstream maps each task name to the names it depends on. Times are
+    in seconds from the start of the run; tasks still running have no
+    end and are measured up to now.
+    """
+    now = now or datetime.utcnow()
+    run_start = run_log['start_time']
+    task_logs = run_log.get('tasks', {})
+
+    bars = {}
+    for name, task_log in task_logs.iteritems():
+        start = task_log.get('start_time', None)
+        if not isinstance(start, datetime):
+            continue
+        complete = task_log.get('complete_time', None)
+        ready = _ready_time(task_log, upstream.get(name, ()), task_logs,
+                            run_start)
+        end = complete if isinstance(complete, datetime) else now
+        bars[name] = {'name': name,
+                      'host': task_log.get('host', None),
+                      'success': task_log.get('success', None),
+                      'return_code': task_log.get('return_code', None),
+                      'ready': _seconds(run_start, ready),
+                      'start': _seconds(run_start, start),
+                      'end': _seconds(run_start, end),
+                      'queued': max(_seconds(ready, start), 0.0),
+                      'duration': _seconds(start, end),
+                      'running': not isinstance(complete, datetime)}
+
+    makespan = max([bar['end'] for bar in bars.itervalues()] + [0.0])
+    gaps = _idle_gaps([(bar['start'], bar['end']) for bar in bars.itervalues()],
+                      0.0, makespan)
+    path = _critical_path(bars, upstream)
+    path_running = sum([bars[name]['duration'] for name in path])
+
+    return {'log_id': run_log.get('log_id', None),
+            'start_time': run_start,
+            'makespan': makespan,
+            'tasks': sorted(bars.values(), key=lambda bar: (bar['start'],
+                                                            bar['name'])),
+            'critical_path': path,
+            'critical_path_running': path_running,
+            'critical_path_waiting': max(makespan - path_running, 0.0),
+            'idle_gaps': [{'start': start, 'end': end,
+                           'duration': end - start} for start, end in gaps],
+            'idle_seconds': sum([end - start for start, end in gaps])}
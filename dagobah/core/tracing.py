@@ -0,0 +1,237 @@
+""" Lightweight tracing of job runs, from scheduling to event handlers. """
+
+import os
+import json
+import time
+import binascii
+import threading
+from collections import deque
+
+
+def new_id():
+    return binascii.hexlify(os.urandom(8))
+
+
+class Span(object):
+    """ A timed step of a job run, linked to the step it was part of.
+
+    Spans used in a with block become the current span of their thread
+    for its duration, and parent the spans started within it. Spans
+    that outlive the call that started them, like a Task's run, are
+    finished explicitly instead.
+    """
+
+    def __init__(self, tracer, name, trace_id, parent_id, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_id()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start = time.time()
+        self.end = None
+
+
+    def __repr__(self):
+        return '<Span %s %s of trace %s>' % (self.name, self.span_id,
+                                             self.trace_id)
+
+
+    def __enter__(self):
+        self.tracer._push(self)
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer._pop(self)
+        if exc_type:
+            self.attributes['error'] = exc_type.__name__
+        self.finish()
+
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+    def finish(self, **attributes):
+        """ End this span and hand it to the exporters. Only the first call counts. """
+        if self.end is not None:
+            return
+        self.attributes.update(attributes)
+        self.end = time.time()
+        self.tracer._export(self)
+
+
+    def _serialize(self):
+        return {'trace_id': self.trace_id,
+                'span_id': self.span_id,
+                'parent_id': self.parent_id,
+                'name': self.name,
+                'start': self.start,
+                'end': self.end,
+                'duration': self.end - self.start,
+                'attributes': self.attributes}
+
+
+class NullSpan(object):
+    """ Stands in for a Span when tracing is off. """
+
+    trace_id = None
+    span_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def set(self, **attributes):
+        pass
+
+    def finish(self, **attributes):
+        pass
+
+
+class NullTracer(object):
+    """ A Tracer that records nothing, so callers needn't check for one. """
+
+    null_span = NullSpan()
+
+    def __nonzero__(self):
+        return False
+
+    def start_span(self, name, parent=None, trace_id=None, **attributes):
+        return self.null_span
+
+    def current(self):
+        return None
+
+
+class Tracer(object):
+    """ Starts spans and passes the finished ones to its exporters.
+
+    A span's parent is the one given, or else the current span of the
+    starting thread. A span with neither starts a new trace, unless a
+    trace_id is given to continue.
+    """
+
+    def __init__(self, exporters=None):
+        self.exporters = exporters if exporters is not None else [RingExporter()]
+        self.local = threading.local()
+
+
+    def __repr__(self):
+        return '<Tracer (exporters: %s)>' % self.exporters
+
+
+    def start_span(self, name, parent=None, trace_id=None, **attributes):
+        if parent is None and trace_id is None:
+            parent = self.current()
+        if isinstance(parent, NullSpan):
+            parent = None
+        if parent is not None:
+            trace_id, parent_id = parent.trace_id, parent.span_id
+        else:
+            parent_id = None
+        return Span(self, name, trace_id or new_id(), parent_id, attributes)
+
+
+    def current(self):
+        """ Returns the innermost span this thread is in, if any. """
+        stack = getattr(self.local, 'stack', None)
+        return stack[-1] if stack else None
+
+
+    def get_trace(self, trace_id):
+        """ Returns the recorded spans of a trace, in start order. """
+        for exporter in self.exporters:
+            if hasattr(exporter, 'get_trace'):
+                return exporter.get_trace(trace_id)
+        return []
+
+
+    def get_waterfall(self, trace_id):
+        """ Returns a trace's spans with their offset from its start and depth. """
+        spans = self.get_trace(trace_id)
+        if not spans:
+            return []
+        trace_start = spans[0]['start']
+        depths = {}
+        result = []
+        for span in spans:
+            depth = depths.get(span['parent_id'], -1) + 1
+            depths[span['span_id']] = depth
+            result.append({'name': span['name'],
+                           'span_id': span['span_id'],
+                           'parent_id': span['parent_id'],
+                           'depth': depth,
+                           'offset': span['start'] - trace_start,
+                           'duration': span['duration'],
+                           'attributes': span['attributes']})
+        return result
+
+
+    def _push(self, span):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        self.local.stack.append(span)
+
+
+    def _pop(self, span):
+        stack = self.local.stack
+        if span in stack:
+            del stack[stack.index(span):]
+
+
+    def _export(self, span):
+        record = span._serialize()
+        for exporter in self.exporters:
+            exporter.export(record)
+
+
+class RingExporter(object):
+    """ Keeps the most recent spans in memory. """
+
+    def __init__(self, size=10000):
+        self.spans = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+
+    def __repr__(self):
+        return '<RingExporter (%d spans)>' % len(self.spans)
+
+
+    def export(self, record):
+        with self.lock:
+            self.spans.append(record)
+
+
+    def get_trace(self, trace_id):
+        with self.lock:
+            spans = [s for s in self.spans if s['trace_id'] == trace_id]
+        return sorted(spans, key=lambda s: s['start'])
+
+
+class JSONLinesExporter(object):
+    """ Appends each span to a file as one line of JSON. """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.lock = threading.Lock()
+        self.file = open(self.path, 'a')
+
+
+    def __repr__(self):
+        return '<JSONLinesExporter %s>' % self.path
+
+
+    def export(self, record):
+        line = json.dumps(record, default=str)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+
+    def close(self):
+        with self.lock:
+            self.file.close()
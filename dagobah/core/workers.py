@@ -0,0 +1,203 @@
+""" Registry of worker agents that run remote tasks for the daemon. """
+
+import os
+import time
+import binascii
+import logging
+import threading
+
+from .core import DagobahError
+
+logger = logging.getLogger('dagobah')
+
+
+class UnknownWorkerError(DagobahError):
+    pass
+
+
+class WorkerAssignment(object):
+    """ A Task handed to a worker agent, and the output it sent back. """
+
+    def __init__(self, assignment_id, task, worker_id):
+        self.assignment_id = assignment_id
+        self.task = task
+        self.worker_id = worker_id
+
+        self.stdout = []
+        self.stderr = []
+        self.return_code = None
+        self.resources = None
+        self.completed_at = None
+        self.delivered = False
+        self.signal = None
+        self.signal_delivered = False
+        self.lost = False
+
+
+    def __repr__(self):
+        return '<WorkerAssignment %s on %s>' % (self.assignment_id,
+                                                self.worker_id)
+
+
+    def is_complete(self):
+        return self.return_code is not None or self.lost
+
+
+    def get_output(self):
+        """ Returns (stdout, stderr) received so far. """
+        return ''.join(self.stdout), ''.join(self.stderr)
+
+
+    def _serialize(self):
+        return {'assignment_id': self.assignment_id,
+                'command': self.task.command,
+                'task_name': self.task.name,
+                'job_name': self.task.parent_job.name}
+
+
+class WorkerRegistry(object):
+    """ Tracks worker agents and the Tasks assigned to them.
+
+    Workers register the hosts they serve, then poll for assignments
+    and report output in batches. A Task whose hostname is served by a
+    live worker is assigned to it instead of being run over SSH. A
+    worker that hasn't polled or reported in worker_ttl seconds is
+    considered lost, and the Tasks assigned to it fail.
+    """
+
+    def __init__(self, worker_ttl=30):
+        self.worker_ttl = worker_ttl
+        self.workers = {}
+        self.assignments = {}
+        self.lock = threading.Lock()
+
+
+    def __repr__(self):
+        return '<WorkerRegistry (workers: %d)>' % len(self.workers)
+
+
+    def register(self, worker_id, hosts, capacity=1):
+        """ Add or refresh a worker serving the given host names. """
+        logger.info('Registering worker {0} for hosts {1}'.format(worker_id, ', '.join(hosts)))
+        with self.lock:
+            self.workers[worker_id] = {'worker_id': worker_id,
+                                       'hosts': list(hosts),
+                                       'capacity': capacity,
+                                       'last_seen': time.time()}
+        return {'worker_id': worker_id, 'worker_ttl': self.worker_ttl}
+
+
+    def unregister(self, worker_id):
+        with self.lock:
+            self.workers.pop(worker_id, None)
+
+
+    def is_live(self, worker_id):
+        worker = self.workers.get(worker_id, None)
+        return bool(worker and
+                    time.time() - worker['last_seen'] < self.worker_ttl)
+
+
+    def get_workers(self):
+        """ Returns a description of every registered worker. """
+        with self.lock:
+            results = []
+            for worker_id, worker in self.workers.iteritems():
+                result = dict(worker)
+                result['live'] = self.is_live(worker_id)
+                result['active'] = self._active_count(worker_id)
+                results.append(result)
+            return results
+
+
+    def _live_workers(self, hostname):
+        return [worker_id for worker_id, worker in self.workers.items()
+                if hostname in worker['hosts'] and self.is_live(worker_id)]
+
+
+    def _active_count(self, worker_id):
+        return len([a for a in self.assignments.itervalues()
+                    if a.worker_id == worker_id])
+
+
+    def assign(self, task):
+        """ Assign a Task to the least loaded live worker serving its host.
+
+        Returns the WorkerAssignment, or None if no worker serves the host.
+        """
+        with self.lock:
+            candidates = self._live_workers(task.hostname)
+            if not candidates:
+                return None
+            worker_id = min(candidates,
+                            key=lambda w: (self._active_count(w) /
+                                           float(self.workers[w]['capacity'] or 1),
+                                           w))
+            assignment = WorkerAssignment(binascii.hexlify(os.urandom(8)),
+                                          task, worker_id)
+            self.assignments[assignment.assignment_id] = assignment
+
+        logger.info('Assigned task {0} to worker {1}'.format(task.name, worker_id))
+        return assignment
+
+
+    def _get_worker(self, worker_id):
+        worker = self.workers.get(worker_id, None)
+        if not worker:
+            raise UnknownWorkerError('worker %s is not registered' % worker_id)
+        worker['last_seen'] = time.time()
+        return worker
+
+
+    def poll(self, worker_id, max_tasks=None):
+        """ Hand a worker its new assignments and pending signals. """
+        with self.lock:
+            self._get_worker(worker_id)
+            assignments, signals = [], {}
+            for assignment in self.assignments.itervalues():
+                if assignment.worker_id != worker_id:
+                    continue
+                if (not assignment.delivered and
+                    (max_tasks is None or len(assignments) < max_tasks)):
+                    assignment.delivered = True
+                    assignments.append(assignment._serialize())
+                if assignment.signal and not assignment.signal_delivered:
+                    assignment.signal_delivered = True
+                    signals[assignment.assignment_id] = assignment.signal
+            return {'assignments': assignments, 'signals': signals}
+
+
+    def report(self, worker_id, assignment_id, stdout='', stderr='',
+               return_code=None, resources=None):
+        """ Record a batch of output, and the exit status and resource
+        usage once finished.
+
+        Returns Boolean of whether the assignment is still known.
+        """
+        with self.lock:
+            self._get_worker(worker_id)
+            assignment = self.assignments.get(assignment_id, None)
+            if not assignment or assignment.worker_id != worker_id:
+                return False
+            if stdout:
+                assignment.stdout.append(stdout)
+            if stderr:
+                assignment.stderr.append(stderr)
+            if return_code is not None:
+                assignment.resources = resources
+                assignment.return_code = return_code
+                assignment.completed_at = time.time()
+            return True
+
+
+    def send_signal(self, assignment, signal):
+        """ Ask the worker to 'terminate' or 'kill' an assigned Task. """
+        with self.lock:
+            assignment.signal = signal
+            assignment.signal_delivered = False
+
+
+    def finish(self, assignment):
+        """ Forget an assignment once its Task has completed. """
+        with self.lock:
+            self.assignments.pop(assignment.assignment_id, None)
@@ -2,8 +2,9 @@
 
 import StringIO
 import json
+import time
 
-from flask import request, abort, send_file
+from flask import request, abort, send_file, g, Response
 from flask_login import login_required
 
 from .daemon import app
@@ -11,6 +12,41 @@ from .util import validate_dict, api_call, allowed_file
 
 dagobah = app.config['dagobah']
 
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.time()
+
+
+@app.after_request
+def observe_request(response):
+    started = getattr(g, 'request_started', None)
+    if dagobah.metrics and started is not None:
+        dagobah.metrics.api_latency.observe(time.time() - started,
+                                            request.endpoint or 'unmatched',
+                                            response.status_code)
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not dagobah.metrics:
+        abort(404)
+
+    # scrapers can't log in, so they may present the token instead
+    token = app.config.get('METRICS_TOKEN', None)
+    if token:
+        if request.headers.get('Authorization', '') != 'Bearer ' + token:
+            abort(401)
+        return render_metrics()
+    return login_required(render_metrics)()
+
+
+def render_metrics():
+    return Response(dagobah.metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/api/jobs', methods=['GET'])
 @login_required
 @api_call
@@ -53,6 +89,182 @@ def get_run_log_history():
     return task.get_run_log_history()
 
 
+@app.route('/api/log_summary', methods=['GET'])
+@login_required
+@api_call
+def get_run_log_summary():
+    args = dict(request.args)
+    if not validate_dict(args,
+                         required=['job_name'],
+                         job_name=str):
+        abort(400)
+
+    job = dagobah.get_job(args['job_name'])
+    if not job:
+        abort(400)
+    return job.get_run_log_summary()
+
+
+@app.route('/api/analytics', methods=['GET'])
+@login_required
+@api_call
+def get_analytics():
+    args = dict(request.args)
+    if not validate_dict(args,
+                         required=['job_name'],
+                         job_name=str,
+                         task_name=str,
+                         days=float,
+                         buckets=int):
+        abort(400)
+
+    job = dagobah.get_job(args['job_name'])
+    if not job:
+        abort(400)
+
+    try:
+        analytics = job.get_analytics(args.get('days', 7),
+                                      args.get('buckets', 7))
+    except ValueError:
+        abort(400)
+
+    task_name = args.get('task_name', None)
+    if task_name is not None:
+        if task_name not in job.tasks:
+            abort(400)
+        analytics = dict(analytics)
+        analytics['tasks'] = dict([(name, stats) for name, stats
+                                   in analytics['tasks'].iteritems()
+                                   if name == task_name])
+    return analytics
+
+
+@app.route('/api/timeline', methods=['GET'])
+@login_required
+@api_call
+def get_timeline():
+    args = dict(request.args)
+    if not validate_dict(args,
+                         required=['job_name'],
+                         job_name=str,
+                         log_id=str):
+        abort(400)
+
+    job = dagobah.get_job(args['job_name'])
+    if not job:
+        abort(400)
+
+    timeline = job.get_timeline(args.get('log_id', None))
+    if timeline is None:
+        abort(400)
+    return timeline
+
+
+@app.route('/api/lock_metrics', methods=['GET'])
+@login_required
+@api_call
+def get_lock_metrics():
+    return dagobah.backend.get_lock_metrics()
+
+
+@app.route('/api/trace', methods=['GET'])
+@login_required
+@api_call
+def get_trace():
+    args = dict(request.args)
+    if not validate_dict(args,
+                         required=['job_name'],
+                         job_name=str,
+                         trace_id=str):
+        abort(400)
+
+    job = dagobah.get_job(args['job_name'])
+    if not job or not dagobah.tracer:
+        abort(400)
+
+    trace_id = args.get('trace_id', None)
+    if trace_id is None:
+        if not job.last_run:
+            abort(400)
+        trace_id = job.last_run.span.trace_id
+
+    return {'trace_id': trace_id,
+            'spans': dagobah.tracer.get_waterfall(trace_id)}
+
+
+@app.route('/api/workers', methods=['GET'])
+@login_required
+@api_call
+def get_workers():
+    if not dagobah.workers:
+        abort(404)
+    return dagobah.workers.get_workers()
+
+
+@app.route('/api/worker/register', methods=['POST'])
+@login_required
+@api_call
+def register_worker():
+    if not dagobah.workers:
+        abort(404)
+    args = dict(request.form)
+    if not validate_dict(args,
+                         required=['worker_id', 'hosts'],
+                         worker_id=str,
+                         hosts=str,
+                         capacity=int):
+        abort(400)
+
+    hosts = [host.strip() for host in args['hosts'].split(',') if host.strip()]
+    return dagobah.workers.register(args['worker_id'], hosts,
+                                    args.get('capacity', 1))
+
+
+@app.route('/api/worker/poll', methods=['POST'])
+@login_required
+@api_call
+def poll_worker():
+    if not dagobah.workers:
+        abort(404)
+    args = dict(request.form)
+    if not validate_dict(args,
+                         required=['worker_id'],
+                         worker_id=str,
+                         max_tasks=int):
+        abort(400)
+
+    return dagobah.workers.poll(args['worker_id'], args.get('max_tasks', None))
+
+
+@app.route('/api/worker/report', methods=['POST'])
+@login_required
+@api_call
+def report_worker():
+    if not dagobah.workers:
+        abort(404)
+    args = dict(request.form)
+    if not validate_dict(args,
+                         required=['worker_id', 'assignment_id'],
+                         worker_id=str,
+                         assignment_id=str,
+                         stdout=unicode,
+                         stderr=unicode,
+                         return_code=int,
+                         resources=str):
+        abort(400)
+
+    try:
+        resources = json.loads(args.get('resources', 'null'))
+    except ValueError:
+        abort(400)
+
+    return dagobah.workers.report(args['worker_id'], args['assignment_id'],
+                                  args.get('stdout', u'').encode('utf-8'),
+                                  args.get('stderr', u'').encode('utf-8'),
+                                  args.get('return_code', None),
+                                  resources)
+
+
 @app.route('/api/log', methods=['GET'])
 @login_required
 @api_call
@@ -86,7 +298,7 @@ def head_task():
         abort(400)
 
     job = dagobah.get_job(args['job_name'])
-    task = job.tasks.get(args['task_name'], None)
+    task = job.get_active_task(args['task_name'])
     if not task:
         abort(400)
 
@@ -111,7 +323,7 @@ def tail_task():
         abort(400)
 
     job = dagobah.get_job(args['job_name'])
-    task = job.tasks.get(args['task_name'], None)
+    task = job.get_active_task(args['task_name'])
     if not task:
         abort(400)
 
@@ -162,6 +374,39 @@ def start_job():
     job.start()
 
 
+@app.route('/api/start_job_from', methods=['POST'])
+@login_required
+@api_call
+def start_job_from():
+    args = dict(request.form)
+    if not validate_dict(args,
+                         required=['job_name', 'task_name'],
+                         job_name=str,
+                         task_name=str):
+        abort(400)
+
+    job = dagobah.get_job(args['job_name'])
+    run = job.start_from(args['task_name'])
+    return {'log_id': str(run.log_id)}
+
+
+@app.route('/api/start_job_subset', methods=['POST'])
+@login_required
+@api_call
+def start_job_subset():
+    args = dict(request.form)
+    if not validate_dict(args,
+                         required=['job_name', 'task_names'],
+                         job_name=str,
+                         task_names=list):
+        abort(400)
+
+    # task_names may be repeated to select several tasks
+    job = dagobah.get_job(args['job_name'])
+    run = job.start_subset([str(name) for name in args['task_names']])
+    return {'log_id': str(run.log_id)}
+
+
 @app.route('/api/retry_job', methods=['POST'])
 @login_required
 @api_call
@@ -263,6 +508,28 @@ def schedule_job():
     job.schedule(args['cron_schedule'])
 
 
+@app.route('/api/set_job_concurrency', methods=['POST'])
+@login_required
+@api_call
+def set_job_concurrency():
+    args = dict(request.form)
+    if not validate_dict(args,
+                         required=['job_name'],
+                         job_name=str,
+                         max_active_runs=int,
+                         queue_policy=str):
+        abort(400)
+
+    job = dagobah.get_job(args['job_name'])
+    try:
+        if 'max_active_runs' in args:
+            job.set_max_active_runs(args['max_active_runs'])
+        if 'queue_policy' in args:
+            job.set_queue_policy(args['queue_policy'])
+    except ValueError:
+        abort(400)
+
+
 @app.route('/api/stop_scheduler', methods=['POST'])
 @login_required
 @api_call
@@ -317,7 +584,7 @@ def terminate_task():
         abort(400)
 
     job = dagobah.get_job(args['job_name'])
-    task = job.tasks.get(args['task_name'], None)
+    task = job.get_active_task(args['task_name'])
     if not task:
         abort(400)
     task.terminate()
@@ -335,7 +602,7 @@ def kill_task():
         abort(400)
 
     job = dagobah.get_job(args['job_name'])
-    task = job.tasks.get(args['task_name'], None)
+    task = job.get_active_task(args['task_name'])
     if not task:
         abort(400)
     task.kill()
@@ -446,6 +713,30 @@ def set_hard_timeout():
     task.set_hard_timeout(args['hard_timeout'])
 
 
+@app.route('/api/set_task_cache', methods=['POST'])
+@login_required
+@api_call
+def set_task_cache():
+    args = dict(request.form)
+    if not validate_dict(args,
+                         required=['job_name', 'task_name', 'cache'],
+                         job_name=str,
+                         task_name=str,
+                         cache=str):
+        abort(400)
+
+    job = dagobah.get_job(args['job_name'])
+    task = job.tasks.get(args['task_name'], None)
+    if not task:
+        abort(400)
+
+    # cache is a JSON spec, e.g. {"inputs": ["data.csv"]}, or null to disable
+    try:
+        task.set_cache(json.loads(args['cache']))
+    except ValueError:
+        abort(400)
+
+
 @app.route('/api/export_job', methods=['GET'])
 @login_required
 def export_job():
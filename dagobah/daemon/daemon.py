@@ -2,6 +2,8 @@
 
 import os
 import sys
+import time
+import atexit
 import logging
 
 from flask import Flask, send_from_directory
@@ -9,8 +11,11 @@ from flask_login import LoginManager
 import yaml
 
 from .. import return_standard_conf
-from ..core import Dagobah, EventHandler
+from ..core import (Dagobah, EventHandler, RunLogWriter, ClusterMembership,
+                    WorkerRegistry, DagobahMetrics, Tracer, RingExporter,
+                    JSONLinesExporter, SlowTaskDetector)
 from ..email import get_email_handler
+from ..email.digest import FailureDigest
 
 app = Flask(__name__)
 
@@ -116,6 +121,8 @@ def configure_app():
                                             False)
     app.config['APP_PASSWORD'] = get_conf(config,
                                           'Dagobahd.password', 'dagobah')
+    app.config['METRICS_TOKEN'] = get_conf(config,
+                                           'Dagobahd.metrics_token', None)
 
     app.config['AUTH_RATE_LIMIT'] = 30
     app.config['AUTH_ATTEMPTS'] = []
@@ -143,28 +150,160 @@ def init_dagobah(testing=False):
 
     init_core_logger(location, config)
 
+    metrics = DagobahMetrics() if get_conf(config, 'Dagobahd.metrics', False) else None
+    tracer = configure_tracer(config)
     backend = get_backend(config)
-    event_handler = configure_event_hooks(config)
+    if metrics or tracer:
+        from ..backend.instrumented import InstrumentedBackend
+        backend = InstrumentedBackend(backend, metrics, tracer)
+    cluster = configure_cluster(config, backend)
+    configure_retention(config, backend, cluster)
+    event_handler = configure_event_hooks(config, tracer, backend)
     ssh_config = get_conf(config, 'Dagobahd.ssh_config', '~/.ssh/config')
 
     if not os.path.isfile(os.path.expanduser(ssh_config)):
         logging.warn("SSH config doesn't exist, no remote hosts will be listed")
 
-    dagobah = Dagobah(backend, event_handler, ssh_config)
-    known_ids = [id for id in backend.get_known_dagobah_ids()
-                 if id != dagobah.dagobah_id]
-    if len(known_ids) > 1:
-        # need a way to handle this intelligently through config
-        raise ValueError('could not infer dagobah ID, ' +
-                         'multiple available in backend')
-
-    if known_ids:
-        dagobah.from_backend(known_ids[0])
+    log_writer = configure_log_writer(config, backend)
+    workers = WorkerRegistry(worker_ttl=float(get_conf(config,
+                                                       'Dagobahd.worker_ttl',
+                                                       30)))
+
+    # clustered nodes share one Dagobah, so only one of them may create it
+    if cluster:
+        while not backend.acquire_lease('init', cluster.node_id,
+                                        cluster.lease_ttl):
+            time.sleep(0.5)
+
+    try:
+        known_ids = backend.get_known_dagobah_ids()
+        if len(known_ids) > 1:
+            # need a way to handle this intelligently through config
+            raise ValueError('could not infer dagobah ID, ' +
+                             'multiple available in backend')
+
+        # an existing Dagobah is loaded without writing anything back
+        dagobah = Dagobah(backend, event_handler, ssh_config, log_writer,
+                          dagobah_id=known_ids[0] if known_ids else None,
+                          scheduler_options=get_scheduler_options(config),
+                          cluster=cluster, workers=workers, metrics=metrics,
+                          tracer=tracer,
+                          slow_tasks=configure_slow_tasks(config))
+    finally:
+        if cluster:
+            backend.release_lease('init', cluster.node_id)
 
     return dagobah
 
 
-def configure_event_hooks(config):
+def configure_tracer(config):
+    """ Returns a Tracer with the configured exporters, or None if disabled. """
+
+    if not get_conf(config, 'Tracing.enabled', False):
+        return None
+
+    exporters = [RingExporter(int(get_conf(config, 'Tracing.ring_size', 10000)))]
+    logfile = get_conf(config, 'Tracing.logfile', None)
+    if logfile:
+        exporter = JSONLinesExporter(logfile)
+        atexit.register(exporter.close)
+        exporters.append(exporter)
+    return Tracer(exporters)
+
+
+def configure_slow_tasks(config):
+    """ Returns a SlowTaskDetector, or None if disabled. """
+
+    if not get_conf(config, 'SlowTasks.enabled', False):
+        return None
+
+    detector = SlowTaskDetector(percentile=float(get_conf(config,
+                                                          'SlowTasks.percentile',
+                                                          95)),
+                                min_runs=int(get_conf(config,
+                                                      'SlowTasks.min_runs', 5)),
+                                window=int(get_conf(config,
+                                                    'SlowTasks.window', 100)),
+                                history_days=float(get_conf(config,
+                                                            'SlowTasks.history_days',
+                                                            30)))
+    atexit.register(detector.stop)
+    return detector
+
+
+def configure_cluster(config, backend):
+    """ Returns a started ClusterMembership, or None if not clustered. """
+
+    if not get_conf(config, 'Cluster.enabled', False):
+        return None
+
+    cluster = ClusterMembership(backend,
+                                node_id=get_conf(config, 'Cluster.node_id', None),
+                                heartbeat_interval=float(get_conf(config,
+                                                                  'Cluster.heartbeat_interval',
+                                                                  5)),
+                                lease_ttl=float(get_conf(config,
+                                                         'Cluster.lease_ttl',
+                                                         15)))
+    cluster.start()
+    atexit.register(cluster.stop)
+    return cluster
+
+
+def get_scheduler_options(config):
+    """ Returns the configured catch-up policy and checkpoint interval. """
+
+    return {'catchup_policy': get_conf(config, 'Dagobahd.catchup_policy',
+                                       'skip'),
+            'checkpoint_interval': int(get_conf(config,
+                                                'Dagobahd.scheduler_checkpoint_interval',
+                                                60))}
+
+
+def configure_log_writer(config, backend):
+    """ Returns a started RunLogWriter, or None if commits are synchronous. """
+
+    if not get_conf(config, 'Dagobahd.async_log_commits', True):
+        return None
+
+    log_writer = RunLogWriter(backend,
+                              int(get_conf(config, 'Dagobahd.log_queue_size',
+                                           1000)))
+    log_writer.start()
+    atexit.register(log_writer.stop)
+    return log_writer
+
+
+def configure_retention(config, backend, cluster=None):
+    """ Apply the configured RetentionPolicy and start its compactor.
+
+    In a cluster, only the leader runs compaction passes.
+    """
+
+    from ..backend.retention import RetentionPolicy, LogCompactor
+
+    policy = RetentionPolicy(keep_runs=get_conf(config, 'Retention.keep_runs', None),
+                             keep_days=get_conf(config, 'Retention.keep_days', None),
+                             keep_failed_days=get_conf(config,
+                                                       'Retention.keep_failed_days',
+                                                       None),
+                             compact_interval=get_conf(config,
+                                                       'Retention.compact_interval',
+                                                       3600))
+    if not policy.is_enabled():
+        return None
+
+    backend.set_retention_policy(policy)
+    if not policy.compact_interval:
+        return None
+
+    compactor = LogCompactor(backend,
+                             is_active=(lambda: cluster.is_leader) if cluster else None)
+    compactor.start()
+    return compactor
+
+
+def configure_event_hooks(config, tracer=None, backend=None):
     """ Returns an EventHandler instance with registered hooks. """
 
     def print_event_info(**kwargs):
@@ -179,7 +318,15 @@ def configure_event_hooks(config):
     def task_failed_email(email_handler, **kwargs):
         email_handler.send_task_failed(kwargs['event_params'])
 
-    handler = EventHandler()
+    handler = EventHandler(workers=int(get_conf(config, 'Dagobahd.event_workers', 0)),
+                           queue_size=int(get_conf(config,
+                                                   'Dagobahd.event_queue_size',
+                                                   100)),
+                           overflow=get_conf(config, 'Dagobahd.event_overflow',
+                                             'block'),
+                           tracer=tracer)
+    if handler.workers:
+        atexit.register(handler.stop)
 
     email_handler = get_email_handler(get_conf(config, 'Dagobahd.email', None),
                                       get_conf(config, 'Email', {}))
@@ -188,10 +335,19 @@ def configure_event_hooks(config):
         get_conf(config, 'Email.send_on_success', False) == True):
         handler.register('job_complete', job_complete_email, email_handler)
 
+    digest_window = get_conf(config, 'Email.digest_window', 0)
     if (email_handler and
         get_conf(config, 'Email.send_on_failure', False) == True):
-        handler.register('job_failed', job_failed_email, email_handler)
-        handler.register('task_failed', task_failed_email, email_handler)
+        if digest_window:
+            # the digest loads run logs itself, once per window
+            handler.include_run_logs = False
+            digest = FailureDigest(email_handler, digest_window, backend)
+            handler.register('job_failed', digest.add, 'job_failed')
+            handler.register('task_failed', digest.add, 'task_failed')
+            atexit.register(digest.flush)
+        else:
+            handler.register('job_failed', job_failed_email, email_handler)
+            handler.register('task_failed', task_failed_email, email_handler)
 
     return handler
 
@@ -252,6 +408,13 @@ def get_backend(config):
             backend_kwargs[conf_kwarg] = get_conf(config,
                                                   'MongoBackend.%s' % conf_kwarg)
         backend_kwargs['port'] = int(backend_kwargs['port'])
+        for conf_kwarg, default in [('summary_collection', 'dagobah_log_summary'),
+                                    ('scheduler_collection', 'dagobah_scheduler'),
+                                    ('lease_collection', 'dagobah_lease'),
+                                    ('node_collection', 'dagobah_node')]:
+            backend_kwargs[conf_kwarg] = get_conf(config,
+                                                  'MongoBackend.%s' % conf_kwarg,
+                                                  default)
 
         try:
             from ..backend.mongo import MongoBackend
@@ -261,6 +424,11 @@ def get_backend(config):
                               '"pip install pymongo" to install them.')
         return MongoBackend(**backend_kwargs)
 
+    elif backend_string.lower() == 'sqlite':
+        from ..backend.sqlite import SQLiteBackend
+        return SQLiteBackend(get_conf(config, 'SQLiteBackend.filepath',
+                                      '~/.dagobah.db'))
+
     raise ValueError('unknown backend type specified in conf')
 
 
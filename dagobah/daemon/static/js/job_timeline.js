@@ -0,0 +1,136 @@
+// Gantt chart of the latest run: one row per task, with the time it
+// spent queued after its dependencies finished, the critical path
+// outlined and the gaps where nothing ran shaded.
+var timelineWidth = 940,
+    timelineLabelWidth = 150,
+    timelineRowHeight = 20,
+    timelineMargin = 20;
+
+function formatSeconds(seconds) {
+    if (seconds < 60) {
+        return seconds.toFixed(1) + 's';
+    }
+    return moment.duration(seconds, 'seconds').humanize();
+}
+
+function drawTimeline(timeline) {
+
+    var holder = d3.select('.job-timeline');
+    holder.selectAll('svg').remove();
+
+    if (!timeline || timeline['tasks'].length === 0) {
+        $('#timeline-summary').text('No runs yet.');
+        return;
+    }
+
+    var tasks = timeline['tasks'];
+    var critical = d3.set(timeline['critical_path']);
+    var makespan = Math.max(timeline['makespan'], 0.001);
+
+    $('#timeline-summary').text(
+        'Makespan ' + formatSeconds(timeline['makespan']) +
+        '; critical path ' + timeline['critical_path'].join(' -> ') +
+        ' (' + formatSeconds(timeline['critical_path_running']) + ' running, ' +
+        formatSeconds(timeline['critical_path_waiting']) + ' waiting)' +
+        '; idle ' + formatSeconds(timeline['idle_seconds']) + '.'
+    );
+
+    var height = tasks.length * timelineRowHeight + timelineMargin * 2;
+    var x = d3.scale.linear()
+        .domain([0, makespan])
+        .range([timelineLabelWidth, timelineWidth - timelineMargin]);
+
+    var svg = holder.append('svg')
+        .attr('width', timelineWidth)
+        .attr('height', height)
+        .append('g')
+        .attr('transform', 'translate(0,' + timelineMargin + ')');
+
+    svg.selectAll('rect.idle-gap')
+        .data(timeline['idle_gaps'])
+        .enter()
+        .append('rect')
+        .attr('class', 'idle-gap')
+        .attr('x', function(d) { return x(d.start); })
+        .attr('width', function(d) { return Math.max(x(d.end) - x(d.start), 1); })
+        .attr('y', 0)
+        .attr('height', tasks.length * timelineRowHeight);
+
+    var rows = svg.selectAll('g.timeline-task')
+        .data(tasks)
+        .enter()
+        .append('g')
+        .attr('class', 'timeline-task')
+        .attr('transform', function(d, i) {
+            return 'translate(0,' + (i * timelineRowHeight) + ')';
+        });
+
+    rows.append('text')
+        .attr('x', timelineLabelWidth - 5)
+        .attr('y', timelineRowHeight / 2)
+        .attr('dy', '.35em')
+        .attr('text-anchor', 'end')
+        .text(function(d) { return d.name; });
+
+    rows.append('rect')
+        .attr('class', 'queued')
+        .attr('x', function(d) { return x(d.ready); })
+        .attr('width', function(d) { return Math.max(x(d.start) - x(d.ready), 0); })
+        .attr('y', timelineRowHeight / 2 - 1)
+        .attr('height', 2);
+
+    rows.append('rect')
+        .attr('class', function(d) {
+            var classes = ['run'];
+            if (d.running) {
+                classes.push('running');
+            } else if (d.success === false) {
+                classes.push('failed');
+            }
+            if (critical.has(d.name)) {
+                classes.push('critical');
+            }
+            return classes.join(' ');
+        })
+        .attr('x', function(d) { return x(d.start); })
+        .attr('width', function(d) { return Math.max(x(d.end) - x(d.start), 1); })
+        .attr('y', 3)
+        .attr('height', timelineRowHeight - 6)
+        .append('title')
+        .text(function(d) {
+            return d.name + (d.host ? ' on ' + d.host : '') +
+                ': ran ' + formatSeconds(d.duration) +
+                ', queued ' + formatSeconds(d.queued);
+        });
+
+    svg.append('g')
+        .attr('class', 'axis')
+        .attr('transform', 'translate(0,' + (tasks.length * timelineRowHeight) + ')')
+        .call(d3.svg.axis().scale(x).orient('bottom').ticks(8)
+              .tickFormat(function(d) { return formatSeconds(d); }));
+
+}
+
+function updateTimeline() {
+
+    if ($('#fallback-modal').hasClass('in')) {
+        return;
+    }
+
+    $.ajax({
+        type: 'GET',
+        url: $SCRIPT_ROOT + '/api/timeline',
+        data: {job_name: jobName},
+        dataType: 'json',
+        success: function(data) {
+            drawTimeline(data['result']);
+        },
+        error: function() {
+            drawTimeline(null);
+        }
+    });
+
+}
+
+updateTimeline();
+setInterval(updateTimeline, 5000);
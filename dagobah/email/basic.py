@@ -4,6 +4,7 @@ from datetime import datetime
 from email.MIMEMultipart import MIMEMultipart
 from email.mime.text import MIMEText
 
+import jinja2
 import premailer
 
 from .common import EmailTemplate
@@ -16,12 +17,10 @@ class BasicEmail(EmailTemplate):
         for task in data.get('tasks', []):
             self._format_task_dict(task)
 
-        template = self._get_template('basic', 'job_completed.html')\
+        content = self._get_inlined_template('basic', 'job_completed')\
             .render(job=data)
-        css = self._get_template('basic', 'job_completed.css').render()
-
-        self.message = self._merge_templates(template, css)
-        self._construct_and_send('Job Completed: %s' % data.get('name', None))
+        self._construct_and_send(self._to_message(content),
+                                 'Job Completed: %s' % data.get('name', None))
 
 
     def send_job_failed(self, data):
@@ -30,24 +29,53 @@ class BasicEmail(EmailTemplate):
         for task in data.get('tasks', []):
             self._format_task_dict(task)
 
-        template = self._get_template('basic', 'job_failed.html')\
+        content = self._get_inlined_template('basic', 'job_failed')\
             .render(job=data)
-        css = self._get_template('basic', 'job_failed.css').render()
-
-        self.message = self._merge_templates(template, css)
-        self._construct_and_send('Job Failed: %s' % data.get('name', None))
+        self._construct_and_send(self._to_message(content),
+                                 'Job Failed: %s' % data.get('name', None))
 
 
     def send_task_failed(self, data):
 
         self._format_task_dict(data)
 
-        template = self._get_template('basic', 'task_failed.html')\
+        content = self._get_inlined_template('basic', 'task_failed')\
             .render(task=data)
-        css = self._get_template('basic', 'task_failed.css').render()
+        self._construct_and_send(self._to_message(content),
+                                 'Task Failed: %s' % data.get('name', None))
+
+
+    def send_failure_digest(self, data):
+
+        data['window_start'] = self._format_date(data.get('window_start', None))
+        data['window_end'] = self._format_date(data.get('window_end', None))
+        for task in data.get('failed_tasks', []):
+            self._format_task_dict(task)
 
-        self.message = self._merge_templates(template, css)
-        self._construct_and_send('Task Failed: %s' % data.get('name', None))
+        content = self._get_inlined_template('basic', 'failure_digest')\
+            .render(digest=data)
+        self._construct_and_send(self._to_message(content),
+                                 'Failure Digest: %s (%d failed tasks)'
+                                 % (data['job'].get('name', None),
+                                    len(data.get('failed_tasks', []))))
+
+
+    def _get_inlined_template(self, template_name, base_name):
+        """ Returns a Jinja2 template with its stylesheet already inlined.
+
+        The CSS is inlined into the template source rather than into each
+        rendered message, so premailer only runs once per template. Since
+        premailer no longer sees the values, they're escaped on render.
+        """
+        html_path = self._template_path(template_name, base_name + '.html')
+
+        def build():
+            css = self._get_template(template_name, base_name + '.css').render()
+            with open(html_path) as html_source:
+                source = html_source.read()
+            return jinja2.Template(self._merge_templates(source, css),
+                                   autoescape=True)
+        return self._cached(('inlined', html_path), build)
 
 
     def _format_job_dict(self, job):
@@ -63,9 +91,12 @@ class BasicEmail(EmailTemplate):
 
 
     def _merge_templates(self, html, css):
+        return premailer.transform(''.join(['<html><style>', css, '</style>',
+                                            html, '</html>']))
+
+
+    def _to_message(self, content):
         message = MIMEMultipart()
-        content = premailer.transform(''.join(['<html><style>', css, '</style>',
-                                               html, '</html>']))
         message.attach(MIMEText(content, 'html'))
         return message
 
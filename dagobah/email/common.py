@@ -1,14 +1,119 @@
 """ Common email class to base specific templates off of. """
 
 import os
+import time
 import smtplib
 import socket
+import logging
+import threading
 import email.utils
 
 import jinja2
 
+logger = logging.getLogger('dagobah')
+
+
+class SMTPConnectionPool(object):
+    """ Keeps authenticated SMTP connections open between messages.
+
+    Connections idle for longer than max_idle seconds are closed rather
+    than reused, since most servers drop them on their end. A send that
+    fails because the server went away is retried once on a fresh
+    connection.
+    """
+
+    def __init__(self, host, port, use_tls=False, auth_required=True,
+                 user=None, password=None, max_size=2, max_idle=60):
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
+        self.auth_required = auth_required
+        self.user = user
+        self.password = password
+        self.max_size = max_size
+        self.max_idle = max_idle
+
+        self.idle = []
+        self.lock = threading.Lock()
+
+
+    def __repr__(self):
+        return '<SMTPConnectionPool (host: %s, port: %s)>' % (self.host,
+                                                              self.port)
+
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        connection = self._acquire()
+        try:
+            connection.sendmail(from_addr, to_addrs, msg)
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            logger.info('SMTP connection lost, reconnecting to %s' % self.host)
+            self._close(connection)
+            connection = self._connect()
+            try:
+                connection.sendmail(from_addr, to_addrs, msg)
+            except:
+                self._close(connection)
+                raise
+        except:
+            self._close(connection)
+            raise
+        self._release(connection)
+
+
+    def close(self):
+        """ Close every idle connection. """
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for last_used, connection in idle:
+            self._close(connection)
+
+
+    def _connect(self):
+        connection = smtplib.SMTP(self.host, self.port)
+        if self.use_tls:
+            connection.ehlo()
+            connection.starttls()
+            connection.ehlo()
+
+        if self.auth_required:
+            connection.login(self.user, self.password)
+        return connection
+
+
+    def _acquire(self):
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                last_used, connection = self.idle.pop()
+            if time.time() - last_used < self.max_idle:
+                return connection
+            self._close(connection)
+        return self._connect()
+
+
+    def _release(self, connection):
+        with self.lock:
+            if len(self.idle) < self.max_size:
+                self.idle.append((time.time(), connection))
+                return
+        self._close(connection)
+
+
+    def _close(self, connection):
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, socket.error):
+            connection.close()
+
+
 class EmailTemplate(object):
 
+    # compiled templates shared by every instance, keyed by file path
+    template_cache = {}
+    template_cache_lock = threading.RLock()
+
     def __init__(self, **kwargs):
 
         self.location = os.path.realpath(os.path.join(os.getcwd(),
@@ -18,7 +123,15 @@ class EmailTemplate(object):
         for kwarg, value in kwargs.iteritems():
             setattr(self, kwarg, value)
         self.from_address = self._apply_formatters(self.from_address)
-        self.message = None
+
+        self.smtp_pool = SMTPConnectionPool(self.host, self.port,
+                                            use_tls=self.use_tls,
+                                            # Preserve backward compatibility
+                                            auth_required=getattr(self, 'auth_required', True),
+                                            user=self.user,
+                                            password=self.password,
+                                            max_size=getattr(self, 'smtp_pool_size', 2),
+                                            max_idle=getattr(self, 'smtp_max_idle', 60))
 
 
     def send_job_completed(self, data):
@@ -33,10 +146,14 @@ class EmailTemplate(object):
         raise NotImplementedError()
 
 
-    def _construct_and_send(self, subject):
-        self._address_message()
-        self._set_subject(subject)
-        self._send_message()
+    def send_failure_digest(self, data):
+        raise NotImplementedError()
+
+
+    def _construct_and_send(self, message, subject):
+        self._address_message(message)
+        self._set_subject(message, subject)
+        self._send_message(message)
 
 
     def _apply_formatters(self, value):
@@ -46,34 +163,48 @@ class EmailTemplate(object):
         return new_value
 
 
-    def _address_message(self):
+    def _address_message(self, message):
         email_addr = self.from_address if self.user is None else self.user
 
-        self.message['From'] = email.utils.formataddr((self.from_address, email_addr))
-        self.message['To'] = ','.join(self.recipients)
+        message['From'] = email.utils.formataddr((self.from_address, email_addr))
+        message['To'] = ','.join(self.recipients)
 
 
-    def _set_subject(self, subject):
-        self.message['Subject'] = subject
+    def _set_subject(self, message, subject):
+        message['Subject'] = subject
 
 
-    def _send_message(self):
-        s = smtplib.SMTP(self.host, self.port)
-        if self.use_tls:
-            s.ehlo()
-            s.starttls()
-            s.ehlo
+    def _send_message(self, message):
+        self.smtp_pool.sendmail(message['From'],
+                                self.recipients,
+                                message.as_string())
+
+
+    def _template_path(self, template_name, template_file):
+        return os.path.join(self.location, 'templates',
+                            template_name, template_file)
 
-        if getattr(self, 'auth_required', True):  #Preserve backward compatibility
-            s.login(self.user, self.password)
 
-        s.sendmail(self.message['From'],
-                   self.recipients,
-                   self.message.as_string())
+    def _cached(self, key, build):
+        """ Returns the cached value for key, building it on first use. """
+        template = EmailTemplate.template_cache.get(key, None)
+        if template is None:
+            with EmailTemplate.template_cache_lock:
+                template = EmailTemplate.template_cache.get(key, None)
+                if template is None:
+                    template = build()
+                    EmailTemplate.template_cache[key] = template
+        return template
 
 
     def _get_template(self, template_name, template_file):
-        """ Returns a Jinja2 template of the specified file. """
-        template = os.path.join(self.location, 'templates',
-                                template_name, template_file)
-        return jinja2.Template(open(template).read())
+        """ Returns a Jinja2 template of the specified file.
+
+        Templates are compiled once and cached for later sends.
+        """
+        path = self._template_path(template_name, template_file)
+
+        def build():
+            with open(path) as template_source:
+                return jinja2.Template(template_source.read())
+        return self._cached(path, build)
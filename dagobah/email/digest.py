@@ -0,0 +1,143 @@
+""" Coalesces failure notifications into periodic per-job digests. """
+
+import logging
+import threading
+from datetime import datetime
+
+logger = logging.getLogger('dagobah')
+
+
+class FailureDigest(object):
+    """ Collects failure events and sends one email per job and window.
+
+    Register add() for the task_failed and job_failed events. The first
+    event after a quiet period opens a window of window seconds. When it
+    closes, each job that failed during the window gets a single digest
+    email. Repeated failures of the same task keep only the latest run,
+    and a job_failed event supplies the job details for the digest.
+
+    Events may carry just a log_id in place of serialized run logs; given
+    a backend, each of those run logs is then loaded once per flush.
+    """
+
+    def __init__(self, email_handler, window=60, backend=None):
+        self.email_handler = email_handler
+        self.window = window
+        self.backend = backend
+
+        self.pending = {}
+        self.window_start = None
+        self.timer = None
+        self.lock = threading.Lock()
+
+
+    def __repr__(self):
+        return '<FailureDigest (window: %ss)>' % self.window
+
+
+    def add(self, event, event_params):
+        """ Buffer an event until the current window closes. """
+        if event == 'task_failed':
+            job_key = event_params.get('job_id', None)
+            job = {'job_id': job_key,
+                   'name': event_params.get('job_name', None)}
+        else:
+            job_key = event_params.get('job_id', None)
+            job = event_params
+
+        with self.lock:
+            if job_key not in self.pending:
+                self.pending[job_key] = {'job': job,
+                                         'job_failed': False,
+                                         'failed_tasks': {}}
+            entry = self.pending[job_key]
+
+            if event == 'task_failed':
+                entry['failed_tasks'][event_params.get('name')] = event_params
+            else:
+                entry['job'] = job
+                entry['job_failed'] = True
+
+            if self.timer is None:
+                self.window_start = datetime.utcnow()
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+
+    def flush(self):
+        """ Send a digest for every job with buffered events. """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            window_start, self.window_start = self.window_start, None
+            if self.timer:
+                self.timer.cancel()
+            self.timer = None
+
+        window_end = datetime.utcnow()
+        run_logs = {}
+        for entry in pending.itervalues():
+            failed_tasks = {}
+            for name, task in entry['failed_tasks'].iteritems():
+                failed_tasks[name] = self._serialize_task(task, run_logs)
+
+            # the job's run log has the latest run of every task
+            job = entry['job']
+            if 'log_id' in job:
+                run_log = self._get_run_log(job['job_id'], job['log_id'],
+                                            run_logs)
+                for name, task_log in run_log.get('tasks', {}).iteritems():
+                    if task_log.get('success', None) == False:
+                        failed_tasks[name] = self._task_from_log(name,
+                                                                 task_log)
+            for task in job.get('tasks', []):
+                if task.get('success', None) == False:
+                    failed_tasks[task['name']] = task
+
+            digest = {'job': entry['job'],
+                      'job_failed': entry['job_failed'],
+                      'failed_tasks': sorted(failed_tasks.values(),
+                                             key=lambda t: t.get('name')),
+                      'window_start': window_start,
+                      'window_end': window_end}
+            try:
+                self.email_handler.send_failure_digest(digest)
+            except Exception:
+                logger.exception('Error sending failure digest for job %s'
+                                 % entry['job'].get('name', None))
+
+
+    def _get_run_log(self, job_id, log_id, run_logs):
+        """ Returns a run log, loading it on first use in this flush. """
+        key = (job_id, log_id)
+        if key not in run_logs:
+            run_logs[key] = {}
+            if self.backend:
+                try:
+                    run_logs[key] = self.backend.get_job_run_log(job_id,
+                                                                 log_id)
+                except Exception:
+                    logger.exception('Error loading run log %s' % log_id)
+        return run_logs[key]
+
+
+    def _serialize_task(self, task, run_logs):
+        """ Returns a task_failed event's task with its run log. """
+        if 'run_log' in task or 'log_id' not in task:
+            return task
+        run_log = self._get_run_log(task.get('job_id', None), task['log_id'],
+                                    run_logs)
+        task_log = run_log.get('tasks', {}).get(task['name'], None)
+        if not task_log:
+            return task
+        return self._task_from_log(task['name'], task_log)
+
+
+    def _task_from_log(self, name, task_log):
+        """ Returns a task serialization built from its run log entry. """
+        return {'name': name,
+                'command': task_log.get('command', None),
+                'success': task_log.get('success', None),
+                'started_at': task_log.get('start_time', None),
+                'completed_at': task_log.get('complete_time', None),
+                'run_log': task_log}
@@ -8,18 +8,36 @@ from .common import EmailTemplate
 class TextEmail(EmailTemplate):
 
     def send_job_completed(self, data):
-        self.message = MIMEText(self._job_to_text(data))
-        self._construct_and_send('Job Completed: %s' % data.get('name', None))
+        self._construct_and_send(MIMEText(self._job_to_text(data)),
+                                 'Job Completed: %s' % data.get('name', None))
 
 
     def send_job_failed(self, data):
-        self.message = MIMEText(self._job_to_text(data))
-        self._construct_and_send('Job Failed: %s' % data.get('name', None))
+        self._construct_and_send(MIMEText(self._job_to_text(data)),
+                                 'Job Failed: %s' % data.get('name', None))
 
 
     def send_task_failed(self, data):
-        self.message = MIMEText(self._task_to_text(data))
-        self._construct_and_send('Task Failed: %s' % data.get('name', None))
+        self._construct_and_send(MIMEText(self._task_to_text(data)),
+                                 'Task Failed: %s' % data.get('name', None))
+
+
+    def send_failure_digest(self, data):
+        failed_tasks = data.get('failed_tasks', [])
+        text = '\n'.join(['Job name: %s' % data['job'].get('name', None),
+                          'Job ID: %s' % data['job'].get('job_id', None),
+                          'Job failed: %s' % data.get('job_failed', None),
+                          'From: %s' % self._format_date(data.get('window_start', None)),
+                          'To: %s' % self._format_date(data.get('window_end', None)),
+                          '',
+                          'Failed Tasks',
+                          '',
+                          '\n\n'.join([self._task_to_text(task)
+                                        for task in failed_tasks])])
+        self._construct_and_send(MIMEText(text),
+                                 'Failure Digest: %s (%d failed tasks)'
+                                 % (data['job'].get('name', None),
+                                    len(failed_tasks)))
 
 
     def _task_to_text(self, task):
@@ -0,0 +1,2 @@
+from .agent import WorkerAgent, TaskRunner
+from .transport import LocalTransport, HTTPTransport
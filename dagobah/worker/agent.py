@@ -0,0 +1,272 @@
+""" Worker agent that runs Tasks handed out by a Dagobah daemon. """
+
+import os
+import sys
+import signal
+import socket
+import logging
+import threading
+import subprocess
+from optparse import OptionParser
+
+from ..core.workers import UnknownWorkerError
+from ..core.resources import reap
+from .transport import HTTPTransport
+
+logger = logging.getLogger('dagobah')
+
+READ_SIZE = 65536
+
+
+class TaskRunner(threading.Thread):
+    """ Runs one assigned command and streams its output back in batches.
+
+    Output is read off the pipes as it arrives and reported every
+    batch_interval seconds. A batch that fails to send is kept and sent
+    with the next one, so nothing is lost while the daemon is briefly
+    unreachable.
+    """
+
+    def __init__(self, agent, assignment):
+        super(TaskRunner, self).__init__()
+        self.agent = agent
+        self.assignment_id = assignment['assignment_id']
+        self.command = assignment['command']
+        self.daemon = True
+
+        self.process = None
+        self.return_code = None
+        self.resources = None
+        self.buffers = {'stdout': [], 'stderr': []}
+        self.buffer_lock = threading.Lock()
+        self.abandoned = False
+
+
+    def __repr__(self):
+        return '<TaskRunner %s>' % self.assignment_id
+
+
+    def run(self):
+        try:
+            self.process = subprocess.Popen(self.command,
+                                            shell=True,
+                                            env=os.environ.copy(),
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.PIPE,
+                                            preexec_fn=os.setsid)
+        except OSError as e:
+            self.buffers['stderr'].append('Worker could not start task: %s\n' % e)
+            self.return_code = -1
+            self._report_until_sent()
+            return
+
+        readers = [threading.Thread(target=self._read_stream,
+                                    args=(self.process.stdout, 'stdout')),
+                   threading.Thread(target=self._read_stream,
+                                    args=(self.process.stderr, 'stderr'))]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+
+        # reaped with wait4 rather than polled, to keep its resource usage
+        while self.resources is None:
+            self.agent.stop_event.wait(self.agent.batch_interval)
+            if self.agent.stop_event.is_set():
+                self._send(signal.SIGKILL)
+                break
+            self.flush()
+            if self.abandoned:
+                self._send(signal.SIGTERM)
+            self.resources = reap(self.process)
+
+        for reader in readers:
+            reader.join()
+        if self.resources is None:
+            self.resources = reap(self.process, block=True)
+        self.return_code = self.process.returncode
+        if not self.abandoned:
+            self._report_until_sent()
+
+
+    def _read_stream(self, stream, name):
+        fd = stream.fileno()
+        while True:
+            data = os.read(fd, READ_SIZE)
+            if not data:
+                break
+            with self.buffer_lock:
+                self.buffers[name].append(data)
+        stream.close()
+
+
+    def _take_buffers(self):
+        with self.buffer_lock:
+            stdout = ''.join(self.buffers['stdout'])
+            stderr = ''.join(self.buffers['stderr'])
+            self.buffers = {'stdout': [], 'stderr': []}
+        return stdout, stderr
+
+
+    def _restore_buffers(self, stdout, stderr):
+        with self.buffer_lock:
+            self.buffers['stdout'].insert(0, stdout)
+            self.buffers['stderr'].insert(0, stderr)
+
+
+    def flush(self, return_code=None):
+        """ Report buffered output. Returns Boolean of whether it was sent. """
+        stdout, stderr = self._take_buffers()
+        if not (stdout or stderr or return_code is not None):
+            return True
+        resources = self.resources if return_code is not None else None
+        try:
+            known = self.agent.transport.report(self.agent.worker_id,
+                                                self.assignment_id,
+                                                stdout, stderr, return_code,
+                                                resources)
+        except Exception:
+            logger.exception('Error reporting output of {0}'.format(self.assignment_id))
+            self._restore_buffers(stdout, stderr)
+            return False
+
+        if not known:
+            logger.warn('Daemon no longer knows assignment {0}'.format(self.assignment_id))
+            self.abandoned = True
+        return True
+
+
+    def _report_until_sent(self):
+        while not self.flush(self.return_code):
+            self.agent.stop_event.wait(self.agent.batch_interval)
+            if self.agent.stop_event.is_set():
+                return
+
+
+    def signal(self, name):
+        """ Apply a 'terminate' or 'kill' sent by the daemon. """
+        if not self.process or self.process.poll() is not None:
+            return
+        logger.info('Sending {0} to assignment {1}'.format(name, self.assignment_id))
+        self._send(signal.SIGKILL if name == 'kill' else signal.SIGTERM)
+
+
+    def _send(self, signum):
+        """ Signal the command's whole process group, so children of the
+        shell don't outlive it and hold its pipes open. """
+        try:
+            os.killpg(self.process.pid, signum)
+        except OSError:
+            pass
+
+
+class WorkerAgent(threading.Thread):
+    """ Runs Tasks for a daemon on the hosts this worker serves.
+
+    The agent registers itself, then polls every poll_interval seconds
+    for new assignments, up to capacity at a time, and for signals to
+    running ones. Polling also keeps the worker alive in the daemon's
+    registry. If the daemon has forgotten the worker, e.g. after a
+    restart, the agent registers again.
+    """
+
+    def __init__(self, transport, worker_id=None, hosts=None, capacity=4,
+                 poll_interval=1.0, batch_interval=1.0):
+        super(WorkerAgent, self).__init__()
+        self.transport = transport
+        self.worker_id = worker_id or '%s:%d' % (socket.gethostname(),
+                                                 os.getpid())
+        self.hosts = hosts or [socket.gethostname()]
+        self.capacity = capacity
+        self.poll_interval = poll_interval
+        self.batch_interval = batch_interval
+        self.daemon = True
+
+        self.runners = {}
+        self.registered = False
+        self.stop_event = threading.Event()
+
+
+    def __repr__(self):
+        return '<WorkerAgent %s>' % self.worker_id
+
+
+    def stop(self):
+        """ Stop polling and kill any running Tasks. """
+        self.stop_event.set()
+        if self.is_alive():
+            self.join()
+        for runner in self.runners.values():
+            runner.join()
+
+
+    def register(self):
+        result = self.transport.register(self.worker_id, self.hosts,
+                                         self.capacity)
+        # poll often enough that the daemon never thinks we are lost
+        self.poll_interval = min(self.poll_interval,
+                                 result['worker_ttl'] / 3.0)
+        self.registered = True
+        logger.info('Registered worker {0}'.format(self.worker_id))
+
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('Error polling for assignments')
+            self.stop_event.wait(self.poll_interval)
+
+
+    def poll(self):
+        """ Start new assignments and apply signals to running ones. """
+        if not self.registered:
+            self.register()
+
+        for assignment_id, runner in self.runners.items():
+            if not runner.is_alive():
+                del self.runners[assignment_id]
+
+        try:
+            result = self.transport.poll(self.worker_id,
+                                         self.capacity - len(self.runners))
+        except UnknownWorkerError:
+            self.registered = False
+            raise
+
+        for assignment in result['assignments']:
+            runner = TaskRunner(self, assignment)
+            self.runners[runner.assignment_id] = runner
+            runner.start()
+
+        for assignment_id, signal in result['signals'].iteritems():
+            if assignment_id in self.runners:
+                self.runners[assignment_id].signal(signal)
+
+
+def worker_entrypoint():
+    parser = OptionParser(usage='%prog --url URL [options]')
+    parser.add_option('--url', help='URL of the dagobahd to work for')
+    parser.add_option('--password', default=None,
+                      help='password for the dagobahd')
+    parser.add_option('--id', dest='worker_id', default=None,
+                      help='worker ID, defaults to hostname:pid')
+    parser.add_option('--hosts', default=socket.gethostname(),
+                      help='comma separated task hostnames this worker serves')
+    parser.add_option('--capacity', type='int', default=4,
+                      help='maximum number of tasks to run at once')
+    options, args = parser.parse_args()
+    if not options.url:
+        parser.error('--url is required')
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    agent = WorkerAgent(HTTPTransport(options.url, options.password),
+                        worker_id=options.worker_id,
+                        hosts=options.hosts.split(','),
+                        capacity=options.capacity)
+    print 'Starting worker %s for %s' % (agent.worker_id, options.url)
+    agent.run()
+
+
+if __name__ == '__main__':
+    worker_entrypoint()
@@ -0,0 +1,110 @@
+""" Ways for a worker agent to reach the daemon's WorkerRegistry. """
+
+import json
+import urllib
+import urllib2
+import urlparse
+import cookielib
+
+from ..core.core import DagobahError
+from ..core.workers import UnknownWorkerError
+
+
+class LocalTransport(object):
+    """ Talks to a WorkerRegistry in the same process. """
+
+    def __init__(self, registry):
+        self.registry = registry
+
+
+    def register(self, worker_id, hosts, capacity):
+        return self.registry.register(worker_id, hosts, capacity)
+
+
+    def poll(self, worker_id, max_tasks):
+        return self.registry.poll(worker_id, max_tasks)
+
+
+    def report(self, worker_id, assignment_id, stdout='', stderr='',
+               return_code=None, resources=None):
+        return self.registry.report(worker_id, assignment_id,
+                                    stdout, stderr, return_code, resources)
+
+
+class HTTPTransport(object):
+    """ Talks to a daemon's worker API over HTTP.
+
+    Logs in with the daemon's password and keeps the session cookie,
+    logging in again whenever the session has expired.
+    """
+
+    def __init__(self, url, password=None, timeout=30):
+        self.url = url.rstrip('/')
+        self.password = password
+        self.timeout = timeout
+        self.opener = urllib2.build_opener(
+            urllib2.HTTPCookieProcessor(cookielib.CookieJar()))
+        self.logged_in = False
+
+
+    def login(self):
+        self.opener.open(self.url + '/do-login',
+                         urllib.urlencode({'password': self.password or ''}),
+                         self.timeout).read()
+        self.logged_in = True
+
+
+    def _post(self, path, data):
+        """ POST form data to an API endpoint and return its result. """
+        if not self.logged_in:
+            self.login()
+        body = urllib.urlencode(dict([(key, value)
+                                      for key, value in data.iteritems()
+                                      if value is not None]))
+
+        for attempt in range(2):
+            try:
+                response = self.opener.open(self.url + path, body, self.timeout)
+            except urllib2.HTTPError as e:
+                self._raise_api_error(e)
+            if urlparse.urlparse(response.geturl()).path != '/login':
+                return json.loads(response.read())['result']
+            # session expired and we were sent to the login page
+            self.login()
+
+        raise DagobahError('could not log in to %s' % self.url)
+
+
+    def _raise_api_error(self, error):
+        try:
+            content = json.loads(error.read())
+        except ValueError:
+            raise error
+        if content.get('error_type') == 'UnknownWorkerError':
+            raise UnknownWorkerError(content.get('message'))
+        raise DagobahError(content.get('message') or str(error))
+
+
+    def register(self, worker_id, hosts, capacity):
+        return self._post('/api/worker/register',
+                          {'worker_id': worker_id,
+                           'hosts': ','.join(hosts),
+                           'capacity': capacity})
+
+
+    def poll(self, worker_id, max_tasks):
+        return self._post('/api/worker/poll',
+                          {'worker_id': worker_id,
+                           'max_tasks': max_tasks})
+
+
+    def report(self, worker_id, assignment_id, stdout='', stderr='',
+               return_code=None, resources=None):
+        return self._post('/api/worker/report',
+                          {'worker_id': worker_id,
+                           'assignment_id': assignment_id,
+                           'stdout': stdout,
+                           'stderr': stderr,
+                           'return_code': return_code,
+                           'resources': (json.dumps(resources)
+                                         if resources else None)})
@@ -11,7 +11,8 @@ setup(name='dagobah',
                 'dagobah.backend',
                 'dagobah.core',
                 'dagobah.daemon',
-                'dagobah.email'],
+                'dagobah.email',
+                'dagobah.worker'],
       package_data={'dagobah': ['email/templates/basic/*',
                                 'daemon/static/css/*',
                                 'daemon/static/js/*',
@@ -50,6 +51,7 @@ setup(name='dagobah',
       tests_require=['nose', 'pymongo'],
       entry_points={'console_scripts':
                     ['dagobahd = dagobah.daemon.app:daemon_entrypoint',
+                     'dagobah-worker = dagobah.worker.agent:worker_entrypoint',
                      'echo_dagobah_conf = dagobah:print_standard_conf']
                     },
       zip_safe=False)
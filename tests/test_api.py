@@ -1,13 +1,15 @@
 """ Tests on API methods. """
 
 import json
+import time
 import StringIO
 
 from flask import Flask, json
 import requests
 from nose.tools import nottest
 
-from dagobah.core import Dagobah
+from dagobah.core import Dagobah, Tracer, DagobahMetrics
+from dagobah.core.tracing import NullTracer
 from dagobah.daemon.app import app
 from dagobah.backend.base import BaseBackend
 
@@ -156,6 +158,105 @@ class TestAPI(object):
         assert self.dagobah.get_job('Test Job').tasks['grep'].hard_timeout == 0
 
 
+    def test_set_job_concurrency(self):
+        self.reset_dagobah()
+        p_args = {'job_name': 'Test Job',
+                  'max_active_runs': 3,
+                  'queue_policy': 'queue'}
+        r = self.app.post('/api/set_job_concurrency', data=p_args)
+        self.validate_api_call(r)
+        job = self.dagobah.get_job('Test Job')
+        assert job.max_active_runs == 3
+        assert job.queue_policy == 'queue'
+
+        r = self.app.post('/api/set_job_concurrency',
+                          data={'job_name': 'Test Job', 'max_active_runs': 0})
+        assert r.status_code == 400
+
+
+    def test_metrics(self):
+        self.reset_dagobah()
+        assert self.app.get('/metrics').status_code == 404
+
+        self.dagobah.metrics = DagobahMetrics()
+        self.dagobah.metrics.watch(self.dagobah)
+        try:
+            self.app.get('/api/jobs')
+            r = self.app.get('/metrics')
+            assert r.status_code == 200
+            assert r.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+            assert 'dagobah_api_request_seconds_count{endpoint="get_jobs",status="200"}' in r.data
+            assert '# TYPE dagobah_scheduler_fire_lag_seconds histogram' in r.data
+            assert '# TYPE dagobah_events_dispatched_total counter' in r.data
+
+            anonymous = app.test_client()
+            assert anonymous.get('/metrics').status_code != 200
+
+            app.config['METRICS_TOKEN'] = 'scrape'
+            assert anonymous.get('/metrics').status_code == 401
+            r = anonymous.get('/metrics',
+                              headers={'Authorization': 'Bearer scrape'})
+            assert r.status_code == 200
+        finally:
+            app.config['METRICS_TOKEN'] = None
+            self.dagobah.metrics = None
+
+
+    def test_trace(self):
+        self.reset_dagobah()
+        r = self.app.get('/api/trace?job_name=Test Job')
+        assert r.status_code == 400
+
+        self.dagobah.tracer = Tracer()
+        try:
+            job = self.dagobah.get_job('Test Job')
+            job.start()
+            job.kill_all()
+            while job.state.status == 'running':
+                time.sleep(0.1)
+            r = self.app.get('/api/trace?job_name=Test Job')
+            d = self.validate_api_call(r)
+        finally:
+            self.dagobah.tracer = NullTracer()
+        assert d['result']['trace_id'] == job.last_run.span.trace_id
+        names = [span['name'] for span in d['result']['spans']]
+        assert names[:2] == ['job.start', 'job.run']
+        assert d['result']['spans'][1]['depth'] == 1
+
+
+    def test_analytics(self):
+        self.reset_dagobah()
+        r = self.app.get('/api/analytics?job_name=Test Job&days=3&buckets=3')
+        d = self.validate_api_call(r)
+        assert d['result']['job']['runs'] == 0
+        assert len(d['result']['job']['trend']) == 3
+
+        for query in ['days=0', 'days=1e12', 'days=nan', 'buckets=0',
+                      'buckets=100000000']:
+            r = self.app.get('/api/analytics?job_name=Test Job&' + query)
+            assert r.status_code == 400, query
+        r = self.app.get('/api/analytics?job_name=Test Job&task_name=nope')
+        assert r.status_code == 400
+
+
+    def test_timeline(self):
+        self.reset_dagobah()
+        r = self.app.get('/api/timeline?job_name=Test Job')
+        assert r.status_code == 400
+
+        job = self.dagobah.get_job('Test Job')
+        job.start()
+        job.kill_all()
+        while job.state.status == 'running':
+            time.sleep(0.1)
+        r = self.app.get('/api/timeline?job_name=Test Job')
+        d = self.validate_api_call(r)
+        assert d['result']['log_id'] == str(job.run_log['log_id'])
+        assert d['result']['critical_path']
+        assert set(['ready', 'start', 'end', 'queued', 'host']) <= \
+            set(d['result']['tasks'][0].keys())
+
+
     def test_import_export(self):
         self.reset_dagobah()
         req = self.app.get('/api/export_job?job_name=%s' % 'Test Job')
@@ -173,3 +274,79 @@ class TestAPI(object):
         j = self.dagobah.jobs[0]
         assert j.name == 'Test Job'
         assert len(j.tasks) == 2
+
+
+    def test_worker_register_poll_report(self):
+        self.reset_dagobah()
+        r = self.app.post('/api/worker/register',
+                          data={'worker_id': 'api_worker',
+                                'hosts': 'host_a, host_b',
+                                'capacity': 2})
+        d = self.validate_api_call(r)
+        assert d['result']['worker_id'] == 'api_worker'
+
+        task = self.dagobah.get_job('Test Job').tasks['grep']
+        task.hostname = 'host_b'
+        assignment = self.dagobah.workers.assign(task)
+
+        r = self.app.post('/api/worker/poll',
+                          data={'worker_id': 'api_worker', 'max_tasks': 2})
+        d = self.validate_api_call(r)
+        assert [a['assignment_id'] for a in d['result']['assignments']] == [assignment.assignment_id]
+
+        r = self.app.post('/api/worker/report',
+                          data={'worker_id': 'api_worker',
+                                'assignment_id': assignment.assignment_id,
+                                'stdout': 'grep\n',
+                                'return_code': 0})
+        d = self.validate_api_call(r)
+        assert d['result'] == True
+        assert assignment.get_output() == ('grep\n', '')
+        assert assignment.return_code == 0
+        self.dagobah.workers.finish(assignment)
+
+        r = self.app.post('/api/worker/poll', data={'worker_id': 'nobody'})
+        assert r.status_code == 400
+        assert json.loads(r.data)['error_type'] == 'UnknownWorkerError'
+
+        r = self.app.get('/api/workers')
+        d = self.validate_api_call(r)
+        assert [w['worker_id'] for w in d['result']] == ['api_worker']
+
+
+    def test_workers_without_registry(self):
+        self.reset_dagobah()
+        workers, self.dagobah.workers = self.dagobah.workers, None
+        try:
+            assert self.app.get('/api/workers').status_code == 404
+            for route in ['register', 'poll', 'report']:
+                r = self.app.post('/api/worker/' + route,
+                                  data={'worker_id': 'api_worker'})
+                assert r.status_code == 404
+        finally:
+            self.dagobah.workers = workers
+
+
+    def test_start_job_from(self):
+        self.reset_dagobah()
+        r = self.app.post('/api/start_job_from',
+                          data={'job_name': 'Test Job', 'task_name': 'list'})
+        d = self.validate_api_call(r)
+
+        job = self.dagobah.get_job('Test Job')
+        assert job.state.status == 'running'
+        assert sorted(job.snapshot.keys()) == ['list']
+        assert d['result']['log_id'] == str(job.runs[0].log_id)
+        job.kill_all()
+
+
+    def test_start_job_subset(self):
+        self.reset_dagobah()
+        r = self.app.post('/api/start_job_subset',
+                          data={'job_name': 'Test Job', 'task_names': ['list']})
+        d = self.validate_api_call(r)
+
+        job = self.dagobah.get_job('Test Job')
+        assert sorted(job.snapshot.keys()) == ['grep', 'list']
+        assert d['result']['log_id'] == str(job.runs[0].log_id)
+        job.kill_all()
@@ -0,0 +1,154 @@
+""" Tests on backend-independent functionality """
+
+import threading
+from datetime import datetime, timedelta
+from time import sleep
+
+from nose.tools import raises
+
+from dagobah.backend.base import BaseBackend
+from dagobah.backend.retention import RetentionPolicy, summarize_run_logs
+
+
+def run_log(save_date, success=True, duration=10):
+    start = save_date - timedelta(seconds=duration)
+    return {'save_date': save_date,
+            'start_time': start,
+            'tasks': {'a': {'success': True,
+                            'return_code': 0,
+                            'start_time': start,
+                            'complete_time': save_date},
+                      'b': {'success': success,
+                            'return_code': 0 if success else 2,
+                            'start_time': start,
+                            'complete_time': save_date}}}
+
+
+def test_retention_keep_runs():
+    now = datetime(2014, 1, 10)
+    policy = RetentionPolicy(keep_runs=2)
+    old = run_log(now - timedelta(days=300))
+    assert not policy.is_expired(old, 0, now)
+    assert not policy.is_expired(old, 1, now)
+    assert policy.is_expired(old, 2, now)
+
+
+def test_retention_keep_days_and_failed_days():
+    now = datetime(2014, 1, 10)
+    policy = RetentionPolicy(keep_runs=1, keep_days=2, keep_failed_days=5)
+    succeeded = run_log(now - timedelta(days=3))
+    failed = run_log(now - timedelta(days=3), success=False)
+    assert policy.is_expired(succeeded, 1, now)
+    assert not policy.is_expired(failed, 1, now)
+    assert not policy.is_expired(succeeded, 0, now)
+    assert policy.is_expired(run_log(now - timedelta(days=6), False), 1, now)
+
+
+def test_retention_ttl():
+    policy = RetentionPolicy(keep_days=1, compact_interval=60)
+    assert policy.ttl(run_log(datetime.utcnow())) == timedelta(days=1,
+                                                              seconds=120)
+    assert RetentionPolicy(keep_runs=5, keep_days=1).ttl(run_log(datetime.utcnow())) is None
+
+
+@raises(ValueError)
+def test_retention_invalid_policy():
+    RetentionPolicy(keep_runs=-1)
+
+
+def test_summarize_run_logs():
+    now = datetime(2014, 1, 10)
+    logs = [run_log(now, duration=10),
+            run_log(now - timedelta(days=1), success=False, duration=30)]
+    summary = summarize_run_logs('job', logs)
+    assert summary['runs'] == 2
+    assert summary['failures'] == 1
+    assert summary['success_rate'] == 0.5
+    assert summary['min_duration'] == 10
+    assert summary['max_duration'] == 30
+
+    tasks = dict([(task['name'], task) for task in summary['tasks']])
+    assert tasks['b']['return_codes'] == {'0': 1, '2': 1}
+    assert tasks['a']['success_rate'] == 1.0
+
+    summary = summarize_run_logs('job', [run_log(now)], summary)
+    assert summary['runs'] == 3
+    tasks = dict([(task['name'], task) for task in summary['tasks']])
+    assert tasks['b']['return_codes'] == {'0': 2, '2': 1}
+
+
+def test_locks_keyed_per_job():
+    backend = BaseBackend()
+    backend.acquire_lock('job_a')
+    done = []
+
+    def lock_other_job():
+        with backend.lock('job_b'):
+            done.append(True)
+
+    thread = threading.Thread(target=lock_other_job)
+    thread.start()
+    thread.join(5)
+    backend.release_lock('job_a')
+
+    assert done == [True]
+    metrics = backend.get_lock_metrics()
+    assert metrics['job_a']['contended'] == 0
+    assert metrics['job_b']['contended'] == 0
+
+
+def test_lock_contention_metrics():
+    backend = BaseBackend()
+    backend.acquire_lock('job_a')
+    done = []
+
+    def lock_same_job():
+        with backend.lock('job_a'):
+            done.append(True)
+
+    thread = threading.Thread(target=lock_same_job)
+    thread.start()
+    sleep(0.1)
+    assert done == []
+    backend.release_lock('job_a')
+    thread.join(5)
+
+    assert done == [True]
+    metrics = backend.get_lock_metrics()['job_a']
+    assert metrics['acquisitions'] == 2
+    assert metrics['contended'] == 1
+    assert metrics['max_wait'] >= 0.1
+
+
+def test_distributed_lock_excludes_other_owners():
+    backend = BaseBackend()
+    backend.distributed_locks = True
+    backend.acquire_lock('job_a')
+    assert not backend.acquire_lease('lock:job_a', 'other process', 60)
+    backend.release_lock('job_a')
+    assert backend.acquire_lease('lock:job_a', 'other process', 60)
+
+
+def test_locks_stay_local_by_default():
+    backend = BaseBackend()
+    with backend.lock('job_a'):
+        assert backend.leases == {}
+
+
+def test_distributed_lock_renewal():
+    backend = BaseBackend()
+    backend.distributed_locks = True
+    backend.lock_ttl = 0.05
+    backend.acquire_lock('job_a')
+    sleep(0.1)
+    assert backend.renew_locks() == []
+    assert not backend.acquire_lease('lock:job_a', 'other process', 60)
+    backend.release_lock('job_a')
+    assert backend.renew_locks() == []
+
+    backend.acquire_lock('job_b')
+    sleep(0.1)
+    assert backend.acquire_lease('lock:job_b', 'other process', 60)
+    assert backend.renew_locks() == ['job_b']
+    backend.release_lock('job_b')
+    assert not backend.acquire_lease('lock:job_b', backend.lock_owner, 60)
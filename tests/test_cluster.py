@@ -0,0 +1,178 @@
+""" Tests on clustered daemons sharing one backend """
+
+from datetime import datetime, timedelta
+from time import sleep
+
+from nose.tools import nottest, raises
+
+from dagobah.core.core import Dagobah
+from dagobah.core.cluster import ClusterMembership, HashRing
+from dagobah.backend.base import BaseBackend
+
+HEARTBEAT = 0.05
+LEASE_TTL = 0.3
+
+
+@nottest
+def start_nodes(backend, count):
+    nodes = [ClusterMembership(backend, 'node_%d' % i,
+                               heartbeat_interval=HEARTBEAT,
+                               lease_ttl=LEASE_TTL)
+             for i in range(count)]
+    for node in nodes:
+        node.start()
+    wait_for_ring(nodes, count)
+    return nodes
+
+
+@nottest
+def wait_for_ring(nodes, size):
+    for i in range(100):
+        if all([len(node.ring.nodes) == size for node in nodes]):
+            return
+        sleep(HEARTBEAT)
+    raise AssertionError('nodes did not agree on a ring of %d' % size)
+
+
+@nottest
+def leaders(nodes):
+    return [node for node in nodes if node.is_leader]
+
+
+@nottest
+def node_dagobah(backend, node, num_jobs):
+    """ Returns a Dagobah with the same jobs as every other node. """
+    dagobah = Dagobah(backend, cluster=node)
+    dagobah.scheduler.stop()
+    for i in range(num_jobs):
+        dagobah.add_job('job_%d' % i, 'job_%d' % i)
+        job = dagobah.get_job('job_%d' % i)
+        job.add_task('true', 'a')
+        job.schedule('* * * * *', datetime.utcnow() - timedelta(minutes=1))
+    dagobah.scheduler.last_check = datetime.utcnow() - timedelta(minutes=2)
+    return dagobah
+
+
+def test_hash_ring_balance():
+    ring = HashRing(['node_%d' % i for i in range(3)])
+    counts = {}
+    for i in range(3000):
+        owner = ring.get_node('job_%d' % i)
+        counts[owner] = counts.get(owner, 0) + 1
+    assert len(counts) == 3
+    assert min(counts.values()) > 600
+
+
+def test_hash_ring_minimal_movement():
+    before = HashRing(['node_0', 'node_1', 'node_2'])
+    after = HashRing(['node_0', 'node_1'])
+    for i in range(500):
+        key = 'job_%d' % i
+        if before.get_node(key) != 'node_2':
+            assert after.get_node(key) == before.get_node(key)
+
+
+def test_empty_hash_ring():
+    assert HashRing().get_node('job') is None
+
+
+@raises(ValueError)
+def test_lease_shorter_than_heartbeat():
+    ClusterMembership(BaseBackend(), heartbeat_interval=10, lease_ttl=5)
+
+
+def test_lease_exclusive():
+    backend = BaseBackend()
+    assert backend.acquire_lease('lock', 'a', 60)
+    assert not backend.acquire_lease('lock', 'b', 60)
+    assert backend.acquire_lease('lock', 'a', 60)
+    backend.release_lease('lock', 'b')
+    assert not backend.acquire_lease('lock', 'b', 60)
+    backend.release_lease('lock', 'a')
+    assert backend.acquire_lease('lock', 'b', 60)
+
+
+def test_lease_expiry():
+    backend = BaseBackend()
+    assert backend.acquire_lease('lock', 'a', 0.05)
+    sleep(0.1)
+    assert backend.acquire_lease('lock', 'b', 60)
+
+
+def test_single_leader():
+    backend = BaseBackend()
+    nodes = start_nodes(backend, 3)
+    assert len(leaders(nodes)) == 1
+    for node in nodes:
+        node.stop()
+
+
+def test_leader_failover():
+    backend = BaseBackend()
+    nodes = start_nodes(backend, 3)
+    leader = leaders(nodes)[0]
+    leader.stop(leave=False)
+    others = [node for node in nodes if node is not leader]
+
+    sleep(LEASE_TTL + 4 * HEARTBEAT)
+    assert len(leaders(others)) == 1
+    wait_for_ring(others, 2)
+    for node in others:
+        node.stop()
+
+
+def test_locks_renewed_by_heartbeat():
+    backend = BaseBackend()
+    nodes = start_nodes(backend, 1)
+    assert backend.distributed_locks
+    with backend.lock('job_a'):
+        sleep(LEASE_TTL * 2)
+        assert not backend.acquire_lease('lock:job_a', 'other node', 60)
+    assert backend.acquire_lease('lock:job_a', 'other node', 60)
+    nodes[0].stop()
+
+
+def test_jobs_sharded_across_nodes():
+    backend = BaseBackend()
+    nodes = start_nodes(backend, 3)
+    dagobahs = [node_dagobah(backend, node, 30) for node in nodes]
+
+    started = {}
+
+    def record_start(job, node_id):
+        started.setdefault(job.name, []).append(node_id)
+        job.next_run = job.cron_iter.get_next(datetime)
+
+    for dagobah in dagobahs:
+        for job in dagobah.jobs:
+            job.start = (lambda job=job, node_id=dagobah.cluster.node_id:
+                         record_start(job, node_id))
+
+    now = datetime.utcnow()
+    for dagobah in dagobahs:
+        dagobah.scheduler.check(now)
+
+    assert sorted(started.keys()) == sorted(['job_%d' % i for i in range(30)])
+    assert all([len(owners) == 1 for owners in started.values()])
+    assert len(set([owners[0] for owners in started.values()])) == 3
+    for dagobah in dagobahs:
+        for job in dagobah.jobs:
+            assert job.next_run > now
+    for node in nodes:
+        node.stop()
+
+
+def test_jobs_fail_over():
+    backend = BaseBackend()
+    nodes = start_nodes(backend, 2)
+    dead, survivor = nodes
+    survivor_dagobah = node_dagobah(backend, survivor, 20)
+    orphaned = [job.name for job in survivor_dagobah.jobs
+                if dead.owns(job)]
+    assert orphaned
+
+    dead.stop(leave=False)
+    sleep(LEASE_TTL + 4 * HEARTBEAT)
+    wait_for_ring([survivor], 1)
+    assert all([survivor.owns(job) for job in survivor_dagobah.jobs])
+    survivor.stop()
@@ -1,17 +1,30 @@
 """ Tests on the core class implementations (Dagobah, Job, Task) """
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from time import sleep
 import signal
+import threading
 from functools import wraps
 
+from croniter import croniter
 from nose import with_setup
-from nose.tools import nottest, raises, assert_equal
+from nose.tools import nottest, raises, assert_equal, assert_raises
 
 from dagobah.core.core import Dagobah, Job, Task, DagobahError
+from dagobah.core.components import (RunLogWriter, EventHandler,
+                                     RemoteOutputCollector, ExecutionPlan,
+                                     SlowTaskDetector)
+from dagobah.core.metrics import MetricsRegistry, DagobahMetrics
+from dagobah.core.tracing import Tracer, JSONLinesExporter
+from dagobah.core.resources import wrap_command, split_resources
+from dagobah.core.timeline import build_timeline
 from dagobah.backend.base import BaseBackend
+from dagobah.backend.instrumented import InstrumentedBackend
+from dagobah.backend.analytics import DurationSeries, percentile
 
 import os
+import shutil
+import tempfile
 
 dagobah = None
 
@@ -128,6 +141,7 @@ def test_job_states_invalid():
 
 @with_setup(blank_dagobah)
 def test_job_schedule():
+    dagobah.scheduler.stop()
     dagobah.add_job('test_job')
     job = dagobah.get_job('test_job')
 
@@ -197,6 +211,7 @@ def test_start_running_job():
 
 @with_setup(blank_dagobah)
 def test_serialize_dagobah():
+    dagobah.scheduler.stop()
     dagobah.add_job('test_job')
     job = dagobah.get_job('test_job')
     job.add_task('ls', 'list')
@@ -218,7 +233,8 @@ def test_serialize_dagobah():
                                         'success': None,
                                         'soft_timeout': 0,
                                         'hard_timeout': 0,
-                                        'hostname': None},
+                                        'hostname': None,
+                                        'cache': None},
                                        {'command': 'grep',
                                         'name': 'grep',
                                         'completed_at': None,
@@ -226,13 +242,16 @@ def test_serialize_dagobah():
                                         'success': None,
                                         'soft_timeout': 0,
                                         'hard_timeout': 0,
-                                        'hostname': None},],
+                                        'hostname': None,
+                                        'cache': None},],
                              'dependencies': {'list': ['grep'],
                                               'grep': []},
                              'status': 'waiting',
                              'cron_schedule': '*/5 * * * *',
                              'next_run': datetime(2012, 1, 1, 1, 5, 0),
-                             'notes': 'Here are some notes'}]}
+                             'notes': 'Here are some notes',
+                             'max_active_runs': 1,
+                             'queue_policy': 'skip'}]}
     print dagobah._serialize()
     print test_result
     assert_equal(dagobah._serialize(), test_result)
@@ -309,3 +328,942 @@ def test_retry_from_failure():
 
     wait_until_stopped(job)
     assert job.state.status != 'failed'
+
+
+class StateBackend(BaseBackend):
+    """ Backend that only keeps scheduler checkpoints, in memory. """
+
+    def __init__(self):
+        super(StateBackend, self).__init__()
+        self.states = {}
+
+    def commit_scheduler_state(self, dagobah_id, state):
+        self.states[dagobah_id] = state
+
+    def get_scheduler_state(self, dagobah_id):
+        return self.states.get(dagobah_id, None)
+
+
+@nottest
+def missed_run_dagobah(catchup_policy, minutes_missed):
+    """ Returns a Dagobah restored from a checkpoint taken minutes ago. """
+    test_dagobah = Dagobah(StateBackend())
+    test_dagobah.scheduler.stop()
+    test_dagobah.add_job('test_job')
+    job = test_dagobah.get_job('test_job')
+    job.add_task('true', 'a')
+
+    job.schedule('* * * * *',
+                 datetime.utcnow() - timedelta(minutes=minutes_missed))
+    test_dagobah.scheduler.checkpoint()
+    state = test_dagobah.backend.get_scheduler_state(test_dagobah.dagobah_id)
+
+    job.schedule('* * * * *')
+    test_dagobah.scheduler.set_catchup_policy(catchup_policy)
+    test_dagobah.scheduler.restore(state)
+    return test_dagobah
+
+
+def test_scheduler_restore():
+    test_dagobah = missed_run_dagobah('skip', 10)
+    job = test_dagobah.get_job('test_job')
+    assert job.next_run < datetime.utcnow() - timedelta(minutes=8)
+
+    state = test_dagobah.backend.get_scheduler_state(test_dagobah.dagobah_id)
+    assert state['jobs'][0]['job_id'] == job.job_id
+    assert state['jobs'][0]['next_run'] == job.next_run
+
+
+@raises(ValueError)
+def test_scheduler_unknown_catchup_policy():
+    Dagobah().scheduler.set_catchup_policy('sometimes')
+
+
+def test_scheduler_catchup_skip():
+    test_dagobah = missed_run_dagobah('skip', 10)
+    job = test_dagobah.get_job('test_job')
+    now = datetime.utcnow()
+    test_dagobah.scheduler.check(now)
+    assert job.state.status == 'waiting'
+    assert job.next_run > now
+
+    state = test_dagobah.backend.get_scheduler_state(test_dagobah.dagobah_id)
+    assert state['last_check'] == now
+    assert state['jobs'][0]['next_run'] == job.next_run
+
+
+@supports_timeouts
+def test_scheduler_catchup_once():
+    test_dagobah = missed_run_dagobah('once', 10)
+    job = test_dagobah.get_job('test_job')
+    now = datetime.utcnow()
+    signal.alarm(10)
+    test_dagobah.scheduler.check(now)
+    assert job.run_log is not None
+    wait_until_stopped(job)
+    assert job.next_run > now
+
+
+@supports_timeouts
+def test_scheduler_catchup_all():
+    test_dagobah = missed_run_dagobah('all', 3)
+    job = test_dagobah.get_job('test_job')
+    start = job.start
+    starts = []
+
+    def start_and_wait():
+        start()
+        starts.append(job.run_log['log_id'])
+        wait_until_stopped(job)
+    job.start = start_and_wait
+
+    signal.alarm(10)
+    now = datetime.utcnow()
+    missed = croniter('* * * * *', job.next_run - timedelta(seconds=1))
+    expected = 0
+    while missed.get_next(datetime) <= now:
+        expected += 1
+
+    for i in range(expected + 1):
+        test_dagobah.scheduler.check(now)
+    assert len(starts) == expected
+    assert job.next_run > now
+
+
+class StoredBackend(BaseBackend):
+    """ Backend serving a single stored Dagobah and counting writes. """
+
+    def __init__(self, rec):
+        super(StoredBackend, self).__init__()
+        self.rec = rec
+        self.writes = 0
+
+    def get_dagobah_json(self, dagobah_id):
+        return self.rec if dagobah_id == self.rec['dagobah_id'] else None
+
+    def commit_dagobah(self, dagobah_json):
+        self.writes += 1
+
+    def commit_job(self, job_json):
+        self.writes += 1
+
+    def delete_dagobah(self, dagobah_id):
+        self.writes += 1
+
+
+@with_setup(blank_dagobah)
+def test_load_from_backend_without_writes():
+    dagobah.add_job('test_job')
+    dagobah.add_task_to_job('test_job', 'ls', 'a')
+    dagobah.add_task_to_job('test_job', 'pwd', 'b')
+    dagobah.add_task_to_job('test_job', 'true', 'c')
+    job = dagobah.get_job('test_job')
+    job.add_dependency('a', 'b')
+    job.add_dependency('a', 'c')
+    job.schedule('*/5 * * * *')
+    job.update_job_notes('some notes')
+
+    backend = StoredBackend(dagobah._serialize())
+    test_dagobah = Dagobah(backend, dagobah_id=dagobah.dagobah_id)
+    assert backend.writes == 0
+    assert_equal(test_dagobah._serialize(), dagobah._serialize())
+
+
+@raises(DagobahError)
+def test_load_from_backend_invalid_graph():
+    rec = {'dagobah_id': 'test', 'created_jobs': 1,
+           'jobs': [{'job_id': 'job', 'name': 'test_job',
+                     'tasks': [{'name': 'a', 'command': 'ls'}],
+                     'dependencies': {'a': ['missing']}}]}
+    Dagobah(StoredBackend(rec), dagobah_id='test')
+
+
+class RecordingBackend(BaseBackend):
+    """ Backend that remembers committed run logs, optionally slowly. """
+
+    def __init__(self, delay=0):
+        super(RecordingBackend, self).__init__()
+        self.delay = delay
+        self.logs = []
+
+    def commit_log(self, log_json):
+        sleep(self.delay)
+        self.logs.append(log_json)
+
+
+def test_run_log_writer_ordering():
+    backend = RecordingBackend(delay=0.01)
+    writer = RunLogWriter(backend, max_size=2)
+    writer.start()
+
+    run_log = {'job_id': 'job', 'log_id': 'first', 'tasks': {}}
+    for i in range(5):
+        run_log['tasks']['task_%d' % i] = {'success': True}
+        writer.commit(run_log)
+    writer.commit({'job_id': 'job', 'log_id': 'second', 'tasks': {}})
+    writer.flush('job')
+
+    committed = [(log['log_id'], len(log['tasks'])) for log in backend.logs]
+    assert committed[-2:] == [('first', 5), ('second', 0)]
+    assert [count for log_id, count in committed[:-1]] == sorted(
+        [count for log_id, count in committed[:-1]])
+    writer.stop()
+    assert not writer.is_alive()
+
+
+@supports_timeouts
+def test_run_job_with_log_writer():
+    backend = RecordingBackend(delay=0.2)
+    writer = RunLogWriter(backend)
+    writer.start()
+    test_dagobah = Dagobah(backend, log_writer=writer)
+    test_dagobah.add_job('test_job')
+    test_dagobah.add_task_to_job('test_job', 'true', 'a')
+    test_dagobah.add_task_to_job('test_job', 'true', 'b')
+    job = test_dagobah.get_job('test_job')
+    job.add_dependency('a', 'b')
+
+    signal.alarm(15)
+    job.start()
+    wait_until_stopped(job)
+    writer.flush(job.job_id)
+
+    assert job.state.status == 'waiting'
+    final = backend.logs[-1]
+    assert final['tasks']['b']['success'] == True
+    writer.stop()
+
+
+def test_event_handler_async_dispatch():
+    received = []
+    release = threading.Event()
+
+    def slow_handler(event_params):
+        release.wait(5)
+        received.append(event_params)
+
+    handler = EventHandler(workers=1, queue_size=10)
+    handler.register('job_complete', slow_handler)
+    handler.emit('job_complete', {'name': 'a'})
+    handler.emit('job_complete', {'name': 'b'})
+    assert received == []
+
+    release.set()
+    handler.flush()
+    assert received == [{'name': 'a'}, {'name': 'b'}]
+
+    metrics = handler.get_metrics()['job_complete']
+    assert metrics['emitted'] == 2
+    assert metrics['dispatched'] == 2
+    assert metrics['queue_depth'] == 0
+    handler.stop()
+
+
+def test_event_handler_metrics_under_contention():
+    handler = EventHandler(workers=4, queue_size=1000)
+    handler.register('task_failed', lambda: None)
+
+    def emit_many():
+        for i in range(2000):
+            handler.emit('task_failed')
+
+    emitters = [threading.Thread(target=emit_many) for i in range(4)]
+    for emitter in emitters:
+        emitter.start()
+    for emitter in emitters:
+        emitter.join()
+    handler.flush()
+
+    metrics = handler.get_metrics()['task_failed']
+    assert metrics['emitted'] == 8000
+    assert metrics['dispatched'] == 8000
+    handler.stop()
+
+
+def test_event_handler_drop_policy():
+    release = threading.Event()
+    handler = EventHandler(workers=1, queue_size=1, overflow='drop')
+    handler.register('task_failed', lambda: release.wait(5))
+    for i in range(5):
+        handler.emit('task_failed')
+    assert handler.get_metrics()['task_failed']['dropped'] >= 3
+
+    release.set()
+    handler.stop()
+
+
+def test_event_handler_signatures():
+    calls = []
+
+    def without_params(tag):
+        calls.append((tag, None))
+
+    def with_params(tag, event_params):
+        calls.append((tag, event_params))
+
+    handler = EventHandler()
+    handler.register('job_failed', without_params, 'without')
+    handler.register('job_failed', with_params, 'with')
+    handler.emit('job_failed', {'name': 'job'})
+    assert calls == [('without', None), ('with', {'name': 'job'})]
+
+    handler.deregister('job_failed', without_params)
+    handler.emit('job_failed', {'name': 'job'})
+    assert calls[-1] == ('with', {'name': 'job'})
+    assert len(calls) == 3
+
+
+class FakeChannel(object):
+    """ In-memory stand-in for a paramiko Channel that select can poll. """
+
+    def __init__(self):
+        self.stdout = ''
+        self.stderr = ''
+        self.exit_status = None
+        self.reads = []
+        self.lock = threading.Lock()
+        self.read_fd, self.write_fd = os.pipe()
+        self.signalled = False
+
+    def _signal(self):
+        if not self.signalled:
+            os.write(self.write_fd, 'x')
+            self.signalled = True
+
+    def send(self, stdout='', stderr=''):
+        with self.lock:
+            self.stdout += stdout
+            self.stderr += stderr
+            self._signal()
+
+    def exit(self, status):
+        with self.lock:
+            self.exit_status = status
+            self._signal()
+
+    def fileno(self):
+        return self.read_fd
+
+    def recv_ready(self):
+        return bool(self.stdout)
+
+    def recv_stderr_ready(self):
+        return bool(self.stderr)
+
+    def _recv(self, name, size):
+        with self.lock:
+            data = getattr(self, name)[:size]
+            setattr(self, name, getattr(self, name)[size:])
+            self.reads.append(len(data))
+            if self.signalled and not (self.stdout or self.stderr):
+                os.read(self.read_fd, 1)
+                self.signalled = False
+            return data
+
+    def recv(self, size):
+        return self._recv('stdout', size)
+
+    def recv_stderr(self, size):
+        return self._recv('stderr', size)
+
+    def exit_status_ready(self):
+        return self.exit_status is not None
+
+    def recv_exit_status(self):
+        return self.exit_status
+
+
+def test_remote_output_collector():
+    collector = RemoteOutputCollector(read_size=1024, timeout=5)
+    collector.start()
+    channel = FakeChannel()
+    output = collector.add(channel)
+
+    channel.send(stdout='x' * 10000, stderr='oops')
+    channel.send(stdout='y' * 100)
+    channel.exit(2)
+    for i in range(50):
+        if output.complete:
+            break
+        sleep(0.1)
+    collector.stop()
+
+    assert output.complete
+    assert output.exit_status == 2
+    assert output.get_output() == ('x' * 10000 + 'y' * 100, 'oops')
+    assert max(channel.reads) == 1024
+    assert collector.outputs == []
+
+
+@supports_timeouts
+def test_remote_task_output():
+    test_dagobah = Dagobah(RecordingBackend())
+    test_dagobah.add_job('test_job')
+    test_dagobah.add_task_to_job('test_job', 'remote command', 'remote',
+                                 hostname='remote_host')
+    job = test_dagobah.get_job('test_job')
+    channel = FakeChannel()
+
+    def fake_ssh(task, host):
+        task.remote_channel = channel
+        task.remote_output = test_dagobah.get_output_collector().add(channel)
+
+    test_dagobah.get_host = lambda hostname: {'hostname': hostname}
+    remote_ssh = Task.remote_ssh
+    Task.remote_ssh = fake_ssh
+
+    signal.alarm(15)
+    try:
+        job.start()
+    finally:
+        Task.remote_ssh = remote_ssh
+    channel.send(stdout='line\n' * 20000)
+    channel.exit(0)
+    wait_until_stopped(job)
+
+    log = test_dagobah.backend.logs[-1]['tasks']['remote']
+    assert log['success'] == True
+    assert log['stdout'] == 'line\n' * 20000
+
+
+@with_setup(blank_dagobah)
+def test_task_cache_key():
+    dagobah.add_job('test_job')
+    job = dagobah.get_job('test_job')
+    job.add_task('ls', 'list', cache={'env': ['DAGOBAH_TEST_VAR']})
+    task = job.tasks['list']
+    assert task.cache == {'inputs': [], 'env': ['DAGOBAH_TEST_VAR'],
+                          'check': 'mtime'}
+
+    os.environ['DAGOBAH_TEST_VAR'] = 'a'
+    key = task.get_cache_key()
+    assert task.get_cache_key() == key
+    os.environ['DAGOBAH_TEST_VAR'] = 'b'
+    assert task.get_cache_key() != key
+    del os.environ['DAGOBAH_TEST_VAR']
+
+    task.set_cache(None)
+    assert task.cache is None
+    assert job._serialize()['tasks'][0]['cache'] is None
+
+
+@with_setup(blank_dagobah)
+@raises(ValueError)
+def test_task_cache_invalid():
+    dagobah.add_job('test_job')
+    job = dagobah.get_job('test_job')
+    job.add_task('ls', 'list', cache={'inputs': 'not a list'})
+
+
+@nottest
+def partial_run_job(backend=None):
+    """ Returns a Job with a -> b -> c, x -> c and an unrelated d. """
+    test_dagobah = Dagobah(backend or RecordingBackend())
+    test_dagobah.scheduler.stop()
+    test_dagobah.add_job('test_job')
+    job = test_dagobah.get_job('test_job')
+    for name in ['a', 'b', 'c', 'x', 'd']:
+        job.add_task('true', name)
+    job.add_dependency('a', 'b')
+    job.add_dependency('b', 'c')
+    job.add_dependency('x', 'c')
+    return job
+
+
+def test_task_closures():
+    job = partial_run_job()
+    assert job.downstream_closure(['b']) == set(['b', 'c'])
+    assert job.downstream_closure(['a', 'd']) == set(['a', 'b', 'c', 'd'])
+    assert job.upstream_closure(['b']) == set(['a', 'b'])
+    assert job.upstream_closure(['c']) == set(['a', 'b', 'c', 'x'])
+
+
+def test_execution_plan():
+    plan = partial_run_job().get_plan()
+    order = list(plan.order)
+    assert sorted(order) == ['a', 'b', 'c', 'd', 'x']
+    assert order.index('a') < order.index('b') < order.index('c')
+    assert order.index('x') < order.index('c')
+    assert sorted(plan.roots) == ['a', 'd', 'x']
+    assert plan.in_degree == {'a': 0, 'b': 1, 'c': 2, 'x': 0, 'd': 0}
+    assert sorted(plan.upstream['c']) == ['b', 'x']
+    assert plan.downstream['a'] == ('b',)
+
+    subset = plan.subset(['b', 'c'])
+    assert subset.roots == ('b',)
+    assert subset.upstream['c'] == ('b',)
+
+
+@raises(ValueError)
+def test_execution_plan_cycle():
+    ExecutionPlan({'a': set(['b']), 'b': set(['a'])})
+
+
+def test_plan_cached_per_graph_version():
+    job = partial_run_job()
+    plan = job.get_plan()
+    assert job.get_plan() is plan
+
+    job.add_task('true', 'e')
+    job.add_dependency('d', 'e')
+    new_plan = job.get_plan()
+    assert new_plan is not plan
+    assert new_plan.version == job.graph_version
+    assert 'e' not in plan
+    assert new_plan.upstream['e'] == ('d',)
+
+
+@raises(DagobahError)
+def test_start_from_unknown_task():
+    partial_run_job().start_from('missing')
+
+
+@supports_timeouts
+def test_start_from_task():
+    job = partial_run_job()
+    signal.alarm(15)
+    run = job.start_from('b')
+    wait_until_stopped(job)
+
+    log = job.backend.logs[-1]
+    assert log['log_id'] == run.log_id
+    assert sorted(log['tasks'].keys()) == ['b', 'c']
+    assert log['subset'] == ['b', 'c']
+    assert job._serialize_task('a')['started_at'] is None
+    assert job._serialize_task('b')['started_at'] is not None
+
+
+@supports_timeouts
+def test_start_subset():
+    job = partial_run_job()
+    signal.alarm(15)
+    run = job.start_subset(['b'])
+    wait_until_stopped(job)
+
+    log = job.backend.logs[-1]
+    assert log['log_id'] == run.log_id
+    assert sorted(log['tasks'].keys()) == ['a', 'b']
+    assert all([task['success'] for task in log['tasks'].values()])
+    assert job.state.status == 'waiting'
+
+
+@nottest
+def concurrent_job(max_active_runs, queue_policy='skip'):
+    test_dagobah = Dagobah(RecordingBackend())
+    test_dagobah.scheduler.stop()
+    test_dagobah.add_job('test_job')
+    job = test_dagobah.get_job('test_job')
+    job.add_task('sleep 1', 'sleep')
+    job.set_max_active_runs(max_active_runs)
+    job.set_queue_policy(queue_policy)
+    return job
+
+
+@supports_timeouts
+def test_concurrent_runs():
+    job = concurrent_job(2)
+    signal.alarm(15)
+    first = job.start()
+    second = job.start()
+    assert job.runs == [first, second]
+    assert job.state.status == 'running'
+    assert not job.state.allow_start
+    assert first.tasks['sleep'].process is not second.tasks['sleep'].process
+    wait_until_stopped(job)
+
+    logs = dict([(log['log_id'], log) for log in job.backend.logs])
+    assert len(logs) == 2
+    assert all([log['tasks']['sleep']['success'] for log in logs.values()])
+    assert job.state.status == 'waiting'
+
+
+@raises(DagobahError)
+def test_start_over_max_active_runs():
+    job = concurrent_job(1)
+    job.start()
+    try:
+        job.start()
+    finally:
+        job.kill_all()
+
+
+@supports_timeouts
+def test_queue_policy_queue():
+    job = concurrent_job(1, 'queue')
+    signal.alarm(20)
+    job.start()
+    job.queue_run()
+    job.queue_run()
+    assert job.queued_runs == 2
+    while job.queued_runs or job.state.status == 'running':
+        sleep(0.1)
+
+    assert len(set([log['log_id'] for log in job.backend.logs])) == 3
+
+
+def test_queue_policy_latest_and_skip():
+    job = concurrent_job(1, 'latest')
+    job.start()
+    job.queue_run()
+    job.queue_run()
+    assert job.queued_runs == 1
+
+    job.set_queue_policy('skip')
+    assert job.queued_runs == 0
+    job.queue_run()
+    assert job.queued_runs == 0
+    job.kill_all()
+
+
+@raises(ValueError)
+def test_invalid_max_active_runs():
+    concurrent_job(0)
+
+
+@supports_timeouts
+def test_failed_dependency_blocks_downstream():
+    job = partial_run_job()
+    job.edit_task('x', command='false')
+    signal.alarm(30)
+    run = job.start()
+    wait_until_stopped(job)
+
+    log = job.backend.logs[-1]
+    assert 'c' not in log['tasks']
+    assert log['tasks']['x']['success'] == False
+    assert job.state.status == 'failed'
+    assert run.outstanding == 0
+    assert run.waiting_on['c'] == 1
+
+    job.edit_task('x', command='true')
+    job.retry()
+    wait_until_stopped(job)
+
+    log = job.backend.logs[-1]
+    assert all([task['success'] for task in log['tasks'].values()])
+    assert sorted(log['tasks'].keys()) == ['a', 'b', 'c', 'd', 'x']
+    assert job.state.status == 'waiting'
+
+
+def test_metrics_render():
+    registry = MetricsRegistry()
+    counter = registry.counter('test_total', 'A counter.', labels=('name',))
+    histogram = registry.histogram('test_seconds', 'A histogram.',
+                                   buckets=(0.1, 1.0))
+    registry.gauge('test_depth', 'A gauge.', function=lambda: 3)
+
+    counter.inc(2, 'say "hi"')
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+    assert histogram.get_count() == 3
+
+    lines = registry.render().splitlines()
+    assert '# TYPE test_total counter' in lines
+    assert 'test_total{name="say \\"hi\\""} 2.0' in lines
+    assert 'test_seconds_bucket{le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{le="1.0"} 2' in lines
+    assert 'test_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'test_seconds_sum 5.55' in lines
+    assert 'test_seconds_count 3' in lines
+    assert 'test_depth 3.0' in lines
+
+
+@supports_timeouts
+def test_run_reports_metrics():
+    metrics = DagobahMetrics()
+    backend = InstrumentedBackend(RecordingBackend(), metrics)
+    test_dagobah = Dagobah(backend, metrics=metrics)
+    test_dagobah.scheduler.stop()
+    test_dagobah.add_job('test_job')
+    job = test_dagobah.get_job('test_job')
+    job.add_task('true', 'a')
+    signal.alarm(15)
+    job.start()
+    assert 'dagobah_active_job_runs 1.0' in metrics.render().splitlines()
+    wait_until_stopped(job)
+
+    assert backend.logs[-1]['tasks']['a']['success']
+    assert metrics.spawn_latency.get_count('local') == 1
+    assert metrics.detection_latency.get_count('local') == 1
+    assert metrics.run_duration.get_count('test_job', 'success') == 1
+    assert metrics.backend_latency.get_count('commit_log') >= 1
+    assert metrics.backend_latency.get_count('lock') == 0
+    assert 'dagobah_running_tasks 0.0' in metrics.render().splitlines()
+
+
+def test_duration_series_stats():
+    series = DurationSeries()
+    for i, duration in enumerate([4, 1, 3, 2]):
+        series.append(1000 + 10 * i, duration, i != 1)
+
+    stats = series.stats()
+    assert stats['runs'] == 4
+    assert stats['failures'] == 1
+    assert stats['success_rate'] == 0.75
+    assert stats['min_duration'] == 1 and stats['max_duration'] == 4
+    assert stats['p50'] == 2.5
+    assert abs(stats['p90'] - 3.7) < 1e-9
+    assert percentile([], 50) is None
+
+    trend = series.trend(1000, 1040, 2)
+    assert [b['runs'] for b in trend] == [2, 2]
+    assert trend[0]['p50'] == 2.5 and trend[1]['p50'] == 2.5
+
+
+@with_setup(blank_dagobah)
+def test_job_analytics():
+    dagobah.add_job('test_job')
+    job = dagobah.get_job('test_job')
+    job.add_task('true', 'a')
+    assert job.get_analytics()['job']['runs'] == 0
+    assert_raises(ValueError, job.get_analytics, 0)
+    assert_raises(ValueError, job.get_analytics, 7, 1.5)
+
+    job.get_analytics(days=7, buckets=7)
+    assert (7, 7) in job.analytics_cache
+    job._run_finished(None)
+    assert job.analytics_cache == {}
+
+
+def test_tracer_parents():
+    tracer = Tracer()
+    with tracer.start_span('outer') as outer:
+        inner = tracer.start_span('inner')
+        assert tracer.current() is outer
+    inner.finish()
+    assert tracer.current() is None
+    other = tracer.start_span('other')
+    continued = tracer.start_span('continued', trace_id=outer.trace_id)
+    other.finish()
+    continued.finish()
+
+    assert inner.trace_id == outer.trace_id
+    assert inner.parent_id == outer.span_id
+    assert other.trace_id != outer.trace_id
+    assert continued.parent_id is None
+    waterfall = tracer.get_waterfall(outer.trace_id)
+    assert [(s['name'], s['depth']) for s in waterfall] == [('outer', 0),
+                                                           ('inner', 1),
+                                                           ('continued', 0)]
+
+
+@supports_timeouts
+def test_run_is_traced():
+    tracer = Tracer()
+    backend = InstrumentedBackend(RecordingBackend(), tracer=tracer)
+    handler = EventHandler(tracer=tracer)
+    handler.register('job_complete', lambda: None)
+    test_dagobah = Dagobah(backend, handler, tracer=tracer)
+    test_dagobah.scheduler.stop()
+    test_dagobah.add_job('test_job')
+    job = test_dagobah.get_job('test_job')
+    job.add_task('true', 'a')
+    job.add_task('true', 'b')
+    job.add_dependency('a', 'b')
+    signal.alarm(15)
+    run = job.start()
+    wait_until_stopped(job)
+
+    assert backend.logs[-1]['trace_id'] == run.span.trace_id
+    spans = tracer.get_trace(run.span.trace_id)
+    by_id = dict([(span['span_id'], span) for span in spans])
+    names = [span['name'] for span in spans]
+    for name, count in [('job.start', 1), ('job.run', 1), ('task.run', 2),
+                        ('task.spawn', 2), ('task.check_complete', 2),
+                        ('job.complete_task', 2), ('event.emit', 1)]:
+        assert names.count(name) == count, name
+    assert 'backend.commit_log' in names
+    for span in spans:
+        if span['name'] == 'task.run':
+            assert by_id[span['parent_id']]['name'] == 'job.run'
+        if span['name'] == 'job.complete_task':
+            assert by_id[span['parent_id']]['name'] == 'task.check_complete'
+    assert by_id[run.span.span_id]['attributes']['status'] == 'waiting'
+
+
+class CachingBackend(RecordingBackend):
+    """ Backend with a cached successful result for every Task. """
+
+    def get_cached_run(self, job_id, task_name, cache_key):
+        return {'return_code': 0, 'stdout': 'cached', 'stderr': ''}
+
+
+@supports_timeouts
+def test_cache_hit_is_traced():
+    tracer = Tracer()
+    test_dagobah = Dagobah(CachingBackend(), tracer=tracer)
+    test_dagobah.scheduler.stop()
+    test_dagobah.add_job('test_job')
+    job = test_dagobah.get_job('test_job')
+    job.add_task('true', 'a', cache=True)
+    signal.alarm(15)
+    run = job.start()
+    wait_until_stopped(job)
+
+    spans = tracer.get_trace(run.span.trace_id)
+    by_id = dict([(span['span_id'], span) for span in spans])
+    complete = [span for span in spans if span['name'] == 'job.complete_task']
+    assert len(complete) == 1
+    assert by_id[complete[0]['parent_id']]['name'] == 'task.cache_hit'
+    assert run.tasks['a'].stdout == 'cached'
+
+
+def test_json_lines_exporter():
+    path = os.path.join(os.path.dirname(__file__), 'test_spans.jsonl')
+    exporter = JSONLinesExporter(path)
+    try:
+        tracer = Tracer([exporter])
+        with tracer.start_span('step', job='test_job'):
+            pass
+        exporter.close()
+        lines = open(path).read().splitlines()
+        assert len(lines) == 1
+        assert '"name": "step"' in lines[0]
+    finally:
+        os.remove(path)
+
+
+@supports_timeouts
+def test_task_resources_in_run_log():
+    job = concurrent_job(1)
+    job.edit_task('sleep', command='python -c "x = \' \' * 50000000"')
+    signal.alarm(15)
+    job.start()
+    wait_until_stopped(job)
+
+    resources = job.backend.logs[-1]['tasks']['sleep']['resources']
+    assert resources['max_rss_kb'] > 40000
+    assert resources['user_time'] + resources['system_time'] > 0
+    assert 'block_input' in resources and 'block_output' in resources
+
+
+def test_build_timeline():
+    start = datetime(2014, 1, 1)
+    at = lambda seconds: start + timedelta(seconds=seconds)
+    run_log = {'log_id': 'run', 'start_time': start,
+               'tasks': {'a': {'start_time': at(1), 'complete_time': at(3),
+                               'success': True, 'host': 'w1'},
+                         'b': {'start_time': at(3), 'complete_time': at(4),
+                               'success': True},
+                         'c': {'start_time': at(4), 'complete_time': at(5),
+                               'success': True},
+                         'd': {'start_time': at(6), 'complete_time': at(9),
+                               'ready_time': at(5), 'success': False}}}
+    upstream = {'a': (), 'b': (), 'c': ('a', 'b'), 'd': ('c',)}
+
+    timeline = build_timeline(run_log, upstream)
+    assert timeline['makespan'] == 9
+    assert [task['name'] for task in timeline['tasks']] == ['a', 'b', 'c', 'd']
+    by_name = dict([(task['name'], task) for task in timeline['tasks']])
+    assert by_name['a']['host'] == 'w1' and by_name['a']['queued'] == 1
+    assert by_name['c']['ready'] == 4 and by_name['c']['queued'] == 0
+    assert by_name['d']['queued'] == 1 and by_name['d']['duration'] == 3
+
+    assert timeline['critical_path'] == ['b', 'c', 'd']
+    assert timeline['critical_path_running'] == 5
+    assert timeline['critical_path_waiting'] == 4
+    assert [(gap['start'], gap['end']) for gap in timeline['idle_gaps']] == \
+        [(0, 1), (5, 6)]
+    assert timeline['idle_seconds'] == 2
+
+
+@supports_timeouts
+def test_job_timeline():
+    test_dagobah = Dagobah(RecordingBackend())
+    test_dagobah.scheduler.stop()
+    test_dagobah.add_job('test_job')
+    job = test_dagobah.get_job('test_job')
+    job.add_task('true', 'a')
+    job.add_task('false', 'b')
+    job.add_dependency('a', 'b')
+    assert job.get_timeline() is None
+
+    signal.alarm(15)
+    job.start()
+    wait_until_stopped(job)
+
+    task_log = job.backend.logs[-1]['tasks']['b']
+    assert task_log['ready_time'] <= task_log['start_time']
+    assert task_log['host'] is None
+
+    timeline = job.get_timeline()
+    assert timeline['log_id'] == job.run_log['log_id']
+    assert timeline['critical_path'] == ['a', 'b']
+    assert timeline['makespan'] > 0
+
+
+class HistoryBackend(BaseBackend):
+    """ Backend whose task "slow" has always taken 0.1 to 0.19 seconds. """
+
+    def get_duration_series(self, job_id, since):
+        series = DurationSeries()
+        for i in range(10):
+            series.append(1000 + i, 0.1 + i * 0.01, True)
+        return DurationSeries(), {'slow': series}
+
+
+@supports_timeouts
+def test_slow_task_detection():
+    events = []
+    handler = EventHandler()
+    handler.register('task_slow',
+                     lambda **kwargs: events.append(kwargs['event_params']))
+    detector = SlowTaskDetector(percentile=90, min_runs=5, interval=0.05)
+    test_dagobah = Dagobah(HistoryBackend(), event_handler=handler,
+                           slow_tasks=detector)
+    test_dagobah.scheduler.stop()
+    test_dagobah.add_job('test_job')
+    job = test_dagobah.get_job('test_job')
+    job.add_task('sleep 1', 'slow')
+    job.add_task('sleep 1', 'new')
+
+    signal.alarm(15)
+    job.start()
+    wait_until_stopped(job)
+    sleep(0.2)
+    detector.stop()
+
+    assert [event['name'] for event in events] == ['slow']
+    assert abs(events[0]['threshold'] - 0.181) < 1e-9
+    assert events[0]['elapsed'] >= events[0]['threshold']
+    assert events[0]['job_name'] == 'test_job'
+    assert detector.get_threshold(job.job_id, 'slow') > 0.181
+    assert detector.get_threshold(job.job_id, 'new') is None
+
+
+def test_wrapped_command_resources():
+    import subprocess
+    process = subprocess.Popen(wrap_command('echo hello; exit 3'), shell=True,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    assert process.returncode == 3
+
+    output, resources = split_resources(output)
+    assert output == 'hello\n'
+    assert resources['max_rss_kb'] > 0
+    assert split_resources('no usage here\n') == ('no usage here\n', None)
+
+
+def test_wrapped_command_uses_login_shell():
+    import subprocess
+    bash = [path for path in ['/bin/bash', '/usr/bin/bash']
+            if os.path.exists(path)]
+    if not bash:
+        return
+    command = 'arr=(a b); [[ ${arr[1]} == b ]] && echo bash'
+    env = dict(os.environ, SHELL=bash[0])
+    # a PATH with sh alone leaves the wrapper without Python
+    no_python = tempfile.mkdtemp()
+    os.symlink('/bin/sh', os.path.join(no_python, 'sh'))
+    try:
+        for path in [env.get('PATH', ''), no_python]:
+            process = subprocess.Popen(wrap_command(command), shell=True,
+                                       env=dict(env, PATH=path),
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+            output = process.communicate()[0]
+            assert process.returncode == 0
+            assert split_resources(output)[0] == 'bash\n'
+    finally:
+        shutil.rmtree(no_python)
@@ -0,0 +1,154 @@
+""" Tests on email templates and delivery """
+
+import asyncore
+import smtpd
+import threading
+
+import jinja2
+import lxml.html
+import premailer
+from nose.tools import nottest
+
+from dagobah.email.basic import BasicEmail
+from dagobah.email.text import TextEmail
+from dagobah.email.digest import FailureDigest
+
+
+class RecordingSMTPServer(smtpd.SMTPServer):
+
+    def __init__(self, *args, **kwargs):
+        smtpd.SMTPServer.__init__(self, *args, **kwargs)
+        self.connections = 0
+        self.messages = []
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append(data)
+
+
+class TestEmail(object):
+
+    @classmethod
+    def setup_class(self):
+        self.server = RecordingSMTPServer(('127.0.0.1', 0), None)
+        self.port = self.server.socket.getsockname()[1]
+        self.thread = threading.Thread(target=asyncore.loop,
+                                       kwargs={'timeout': 0.1})
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    @classmethod
+    def teardown_class(self):
+        self.server.close()
+
+
+    @nottest
+    def email_options(self):
+        return {'host': '127.0.0.1',
+                'port': self.port,
+                'auth_required': False,
+                'user': None,
+                'password': None,
+                'use_tls': False,
+                'from_address': 'dagobah@{HOSTNAME}',
+                'recipients': ['test@example.com']}
+
+
+    @nottest
+    def failed_task(self, name):
+        return {'name': name,
+                'command': 'false',
+                'success': False,
+                'started_at': None,
+                'completed_at': None,
+                'run_log': {'return_code': 1,
+                            'stdout': 'out',
+                            'stderr': 'err'}}
+
+
+    def test_basic_email_reuses_connection(self):
+        handler = BasicEmail(**self.email_options())
+        self.server.connections = 0
+        self.server.messages = []
+
+        for i in range(5):
+            handler.send_task_failed(self.failed_task('task %d' % i))
+
+        assert len(self.server.messages) == 5
+        assert self.server.connections == 1
+        assert 'task 4' in self.server.messages[-1]
+        assert 'style=' in self.server.messages[-1]
+        handler.smtp_pool.close()
+
+
+    def test_reconnect_after_disconnect(self):
+        handler = TextEmail(**self.email_options())
+        self.server.connections = 0
+        self.server.messages = []
+
+        handler.send_task_failed(self.failed_task('first'))
+        for last_used, connection in handler.smtp_pool.idle:
+            connection.close()
+        handler.send_task_failed(self.failed_task('second'))
+
+        assert len(self.server.messages) == 2
+        assert self.server.connections == 2
+        handler.smtp_pool.close()
+
+
+    def test_inlined_template_cached(self):
+        handler = BasicEmail(**self.email_options())
+        first = handler._get_inlined_template('basic', 'task_failed')
+        second = handler._get_inlined_template('basic', 'task_failed')
+        assert first is second
+        assert '{{ task.name }}' not in first.render(task=self.failed_task('x'))
+
+
+    def test_inlined_template_escapes_values(self):
+        handler = BasicEmail(**self.email_options())
+        task = self.failed_task('a < b & "c"')
+        task['command'] = 'test $x -gt 1 && echo "done" > out'
+        task['run_log']['stdout'] = '<script>alert(1)</script>'
+
+        # as rendered before the template was inlined
+        with open(handler._template_path('basic', 'task_failed.html')) as f:
+            html = jinja2.Template(f.read()).render(task=task)
+        css = handler._get_template('basic', 'task_failed.css').render()
+        old = lxml.html.fromstring(premailer.transform(
+            ''.join(['<html><style>', css, '</style>', html, '</html>'])))
+        new_content = handler._get_inlined_template('basic', 'task_failed')\
+            .render(task=task)
+        new = lxml.html.fromstring(new_content)
+
+        cells = lambda doc: [td.text_content() for td in doc.iter('td')]
+        assert cells(new)[:2] == cells(old)[:2] == [task['name'],
+                                                    task['command']]
+        assert '<script>' not in new_content
+        assert task['run_log']['stdout'] in cells(new)
+
+
+    def test_failure_digest_coalesces_by_job(self):
+        handler = BasicEmail(**self.email_options())
+        self.server.connections = 0
+        self.server.messages = []
+
+        digest = FailureDigest(handler, window=60)
+        for job_id in ['job_a', 'job_b']:
+            for i in range(50):
+                task = self.failed_task('task %d' % (i % 10))
+                task.update({'job_id': job_id, 'job_name': job_id})
+                digest.add('task_failed', task)
+        digest.add('job_failed', {'job_id': 'job_a',
+                                  'name': 'job_a',
+                                  'tasks': [self.failed_task('task 0')]})
+        digest.flush()
+
+        assert len(self.server.messages) == 2
+        assert digest.timer is None
+        assert digest.pending == {}
+        assert 'task 9' in self.server.messages[0]
+        handler.smtp_pool.close()
@@ -87,7 +87,7 @@ class TestMongo(object):
              'save_date': {'$exists': True},
              'dagobah_id': self.dagobah.dagobah_id,
              'created_jobs': 0,
-             'jobs': []}
+             'jobs': {'$exists': False}}
         assert self.dagobah_coll.find(q).count() == 1
 
 
@@ -116,23 +116,9 @@ class TestMongo(object):
         assert rec == {'_id': self.dagobah.dagobah_id,
                        'save_date': rec['save_date'],
                        'dagobah_id': self.dagobah.dagobah_id,
-                       'created_jobs': 1,
-                       'jobs': [{'job_id': job.job_id,
-                                 'name': 'test_job',
-                                 'parent_id': self.dagobah.dagobah_id,
-                                 'tasks': [{'command': 'grep dragons',
-                                            'name': 'do some grepping',
-                                            'started_at': None,
-                                            'completed_at': None,
-                                            'success': None,
-                                            'soft_timeout': 0,
-                                            'hard_timeout': 0,
-                                            'hostname': None}],
-                                 'dependencies': {'do some grepping': []},
-                                 'status': 'waiting',
-                                 'cron_schedule': None,
-                                 'next_run': None,
-                                 'notes': None}]}
+                       'created_jobs': 1}
+        jobs = self.dagobah.backend.get_jobs_json(self.dagobah.dagobah_id)
+        assert [rec['_id'] for rec in jobs] == [job.job_id]
 
 
     def test_commit_job(self):
@@ -160,13 +146,16 @@ class TestMongo(object):
                                   'success': None,
                                   'soft_timeout': 0,
                                   'hard_timeout': 0,
-                                  'hostname': None}],
+                                  'hostname': None,
+                                  'cache': None}],
                        'dependencies': {'do some grepping': []},
                        'status': 'waiting',
                        'cron_schedule': None,
                        'next_run': None,
                        'save_date': rec['save_date'],
-                       'notes': None}
+                       'notes': None,
+                       'max_active_runs': 1,
+                       'queue_policy': 'skip'}
 
 
     def test_construct_from_backend(self):
@@ -191,6 +180,60 @@ class TestMongo(object):
         assert self.dagobah._serialize() == test_dagobah._serialize()
 
 
+    def test_duration_series(self):
+        """ Needs MongoDB 3.6 or later. """
+        self.new_dagobah()
+        self.dagobah.add_job('test_job')
+        job = self.dagobah.get_job('test_job')
+        job.add_task('ls', 'list')
+        job.add_task('ls', 'find')
+
+        now = datetime.datetime.utcnow()
+        for start, task_names, success in [
+                (now - datetime.timedelta(days=10), ['list', 'find'], True),
+                (now - datetime.timedelta(hours=1), ['list', 'find'], True),
+                (now, ['list'], False)]:
+            log = {'job_id': job.job_id,
+                   'name': job.name,
+                   'parent_id': self.dagobah.dagobah_id,
+                   'log_id': self.dagobah.backend.get_new_log_id(),
+                   'start_time': start,
+                   'tasks': {}}
+            for task_name in task_names:
+                log['tasks'][task_name] = {
+                    'success': success, 'return_code': 0 if success else 1,
+                    'start_time': start,
+                    'complete_time': start + datetime.timedelta(seconds=5)}
+            self.dagobah.backend.commit_log(log)
+
+        job_series, task_series = self.dagobah.backend.get_duration_series(
+            job.job_id, now - datetime.timedelta(days=1))
+        assert len(job_series) == 2
+        assert list(job_series.successes) == [1, 0]
+        assert abs(job_series.durations[0] - 5) < 0.01
+        assert sorted(task_series.keys()) == ['find', 'list']
+        assert len(task_series['list']) == 2
+        assert len(task_series['find']) == 1
+
+
+    def test_aggregate_batches(self):
+        """ Needs MongoDB 3.6 or later. """
+        self.new_dagobah()
+        backend = self.dagobah.backend
+        for i in range(5):
+            backend.commit_log({'job_id': 'batched',
+                                'log_id': backend.get_new_log_id(),
+                                'parent_id': self.dagobah.dagobah_id,
+                                'index': i,
+                                'tasks': {}})
+        pipeline = [{'$match': {'job_id': 'batched'}},
+                    {'$sort': {'index': 1}},
+                    {'$project': {'index': 1}}]
+        for batch_size in [None, 2]:
+            results = backend._aggregate(pipeline, batch_size=batch_size)
+            assert [rec['index'] for rec in results] == range(5)
+
+
     def test_decode_json(self):
         self.new_dagobah()
         now = datetime.datetime.now()
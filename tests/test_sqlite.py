@@ -0,0 +1,433 @@
+""" Tests on the SQLite backend """
+
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from time import sleep
+
+from nose.tools import nottest
+
+from dagobah.core.core import Dagobah
+from dagobah.core.components import EventHandler
+from dagobah.core.cluster import ClusterMembership
+from dagobah.email.digest import FailureDigest
+from dagobah.backend.sqlite import SQLiteBackend
+from dagobah.backend.retention import RetentionPolicy
+
+
+class TestSQLite(object):
+
+    @classmethod
+    def setup_class(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tempdir, 'dagobah_test.db')
+        self.dagobah = None
+
+
+    @classmethod
+    def teardown_class(self):
+        shutil.rmtree(self.tempdir)
+
+
+    @nottest
+    def new_dagobah(self, return_instance=False):
+        instance = Dagobah(SQLiteBackend(self.filepath))
+        if return_instance:
+            return instance
+        self.dagobah = instance
+        self.backend = instance.backend
+
+
+    @nottest
+    def run_log(self, job, task_names, save_date=None, success=True):
+        now = save_date or datetime.utcnow()
+        log = {'job_id': job.job_id,
+               'name': job.name,
+               'parent_id': self.dagobah.dagobah_id,
+               'log_id': self.backend.get_new_log_id(),
+               'start_time': now,
+               'tasks': {}}
+        for task_name in task_names:
+            log['tasks'][task_name] = {'success': success,
+                                       'return_code': 0 if success else 1,
+                                       'stdout': 'out', 'stderr': '',
+                                       'start_time': now,
+                                       'complete_time': now + timedelta(seconds=5)}
+        return log
+
+
+    def test_wal_mode(self):
+        self.new_dagobah()
+        mode = self.backend.conn.execute('PRAGMA journal_mode').fetchone()[0]
+        assert mode == 'wal'
+
+
+    def test_commit_fresh_dagobah(self):
+        self.new_dagobah()
+        rec = self.backend.get_dagobah_json(self.dagobah.dagobah_id)
+        assert rec == {'dagobah_id': self.dagobah.dagobah_id,
+                       'created_jobs': 0}
+        assert self.backend.get_jobs_json(self.dagobah.dagobah_id) == []
+        assert self.dagobah.dagobah_id in self.backend.get_known_dagobah_ids()
+
+
+    def test_delete_fresh_dagobah(self):
+        self.new_dagobah()
+        self.dagobah.delete()
+        assert self.backend.get_dagobah_json(self.dagobah.dagobah_id) is None
+
+
+    def test_construct_from_backend(self):
+        self.new_dagobah()
+        self.dagobah.scheduler.stop()
+        self.dagobah.add_job('test_job')
+        self.dagobah.add_task_to_job('test_job', 'grep dragons',
+                                     'do some grepping')
+        self.dagobah.add_task_to_job('test_job', 'ls | grep steve',
+                                     'find steve')
+        job = self.dagobah.get_job('test_job')
+        job.add_dependency('do some grepping', 'find steve')
+        job.schedule('0 0 1 1 *', datetime(2012, 6, 1))
+
+        test_dagobah = self.new_dagobah(return_instance=True)
+        test_dagobah.scheduler.stop()
+        test_dagobah.from_backend(self.dagobah.dagobah_id)
+
+        assert self.dagobah._serialize() == test_dagobah._serialize()
+
+
+    def test_run_log_history(self):
+        self.new_dagobah()
+        self.dagobah.add_job('test_job')
+        job = self.dagobah.get_job('test_job')
+        job.add_task('ls', 'list')
+
+        first = self.run_log(job, ['list'])
+        self.backend.commit_log(first)
+        sleep(0.01)
+        second = self.run_log(job, ['list'], success=False)
+        self.backend.commit_log(second)
+
+        latest = self.backend.get_latest_run_log(job.job_id, 'list')
+        assert latest['log_id'] == second['log_id']
+        assert latest['tasks']['list']['success'] == False
+        assert isinstance(latest['tasks']['list']['start_time'], datetime)
+
+        history = self.backend.get_run_log_history(job.job_id, 'list')
+        assert [log['log_id'] for log in history] == [second['log_id'],
+                                                      first['log_id']]
+
+        task_log = self.backend.get_run_log(job.job_id, 'list',
+                                            first['log_id'])
+        assert task_log['stdout'] == 'out'
+        assert self.backend.get_latest_run_log(job.job_id, 'missing') == {}
+
+
+    def test_duration_series(self):
+        self.new_dagobah()
+        self.dagobah.add_job('test_job')
+        job = self.dagobah.get_job('test_job')
+        job.add_task('ls', 'list')
+        job.add_task('ls', 'find')
+
+        now = datetime.utcnow()
+        self.backend.commit_log(self.run_log(job, ['list', 'find'],
+                                             now - timedelta(days=10)))
+        self.backend.commit_log(self.run_log(job, ['list', 'find'],
+                                             now - timedelta(hours=1)))
+        self.backend.commit_log(self.run_log(job, ['list'], now,
+                                             success=False))
+
+        job_series, task_series = self.backend.get_duration_series(
+            job.job_id, now - timedelta(days=1))
+        assert len(job_series) == 2
+        assert list(job_series.successes) == [1, 0]
+        assert abs(job_series.durations[0] - 5) < 0.01
+        assert sorted(task_series.keys()) == ['find', 'list']
+        assert len(task_series['list']) == 2
+        assert len(task_series['find']) == 1
+
+        analytics = job.get_analytics(days=1, buckets=2)
+        assert analytics['job']['runs'] == 2
+        assert analytics['job']['success_rate'] == 0.5
+        assert analytics['tasks']['find']['failures'] == 0
+
+
+    def test_job_run_log(self):
+        self.new_dagobah()
+        self.dagobah.add_job('test_job')
+        job = self.dagobah.get_job('test_job')
+        job.add_task('ls', 'list')
+        assert self.backend.get_job_run_log(job.job_id) == {}
+
+        first = self.run_log(job, ['list'])
+        self.backend.commit_log(first)
+        sleep(0.01)
+        second = self.run_log(job, ['list'])
+        self.backend.commit_log(second)
+
+        latest = self.backend.get_job_run_log(job.job_id)
+        assert latest['log_id'] == second['log_id']
+        assert isinstance(latest['tasks']['list']['complete_time'], datetime)
+        rec = self.backend.get_job_run_log(job.job_id, first['log_id'])
+        assert rec['log_id'] == first['log_id']
+
+        timeline = job.get_timeline(first['log_id'])
+        assert timeline['critical_path'] == ['list']
+        assert timeline['makespan'] == 5
+
+
+    def test_grouped_transaction(self):
+        self.new_dagobah()
+        with self.backend.transaction():
+            self.dagobah.add_job('test_job')
+            assert self.backend.transaction_depth == 1
+        assert self.backend.transaction_depth == 0
+        jobs = self.backend.get_jobs_json(self.dagobah.dagobah_id)
+        assert jobs[0]['name'] == 'test_job'
+
+
+    def test_compact_run_logs(self):
+        self.new_dagobah()
+        self.dagobah.add_job('test_job')
+        job = self.dagobah.get_job('test_job')
+        job.add_task('ls', 'list')
+
+        for i in range(5):
+            self.backend.commit_log(self.run_log(job, ['list']))
+            sleep(0.01)
+
+        self.backend.set_retention_policy(RetentionPolicy(keep_runs=2))
+        assert self.backend.compact_run_logs() == 3
+        assert len(self.backend.get_run_log_history(job.job_id, 'list')) == 2
+
+        summary = self.backend.get_run_log_summary(job.job_id)
+        assert summary['runs'] == 3
+        assert summary['tasks'][0]['return_codes'] == {'0': 3}
+        assert self.backend.compact_run_logs() == 0
+
+
+    def test_scheduler_checkpoint(self):
+        self.new_dagobah()
+        self.dagobah.scheduler.stop()
+        self.dagobah.add_job('test_job')
+        job = self.dagobah.get_job('test_job')
+        job.schedule('*/5 * * * *', datetime(2013, 1, 1))
+        self.dagobah.scheduler.checkpoint()
+
+        test_dagobah = self.new_dagobah(return_instance=True)
+        test_dagobah.scheduler.stop()
+        test_dagobah.from_backend(self.dagobah.dagobah_id)
+        test_job = test_dagobah.get_job('test_job')
+        assert test_job.next_run == datetime(2013, 1, 1, 0, 5)
+        assert test_job.cron_iter.get_next(datetime) == datetime(2013, 1, 1, 0, 10)
+
+        self.dagobah.delete()
+        assert self.backend.get_scheduler_state(self.dagobah.dagobah_id) is None
+
+
+    def test_cluster_nodes_share_jobs(self):
+        self.new_dagobah()
+        self.dagobah.scheduler.stop()
+        nodes = []
+        for node_id in ['node_a', 'node_b']:
+            backend = SQLiteBackend(self.filepath)
+            node = ClusterMembership(backend, node_id, heartbeat_interval=60,
+                                     lease_ttl=120)
+            node.start()
+            nodes.append(node)
+        for node in nodes:
+            node.beat()
+        dagobahs = [Dagobah(node.backend, dagobah_id=self.dagobah.dagobah_id,
+                            cluster=node) for node in nodes]
+        first, second = dagobahs
+        for dagobah in dagobahs:
+            dagobah.scheduler.stop()
+
+        # edits made on each node reach the backend and the other node
+        first.add_job('job_a')
+        second.add_job('job_b')
+        first.add_task_to_job('job_a', 'true', 'a')
+        second.add_task_to_job('job_b', 'true', 'b')
+        now = datetime.utcnow() + timedelta(minutes=2)
+        for dagobah in dagobahs:
+            dagobah.scheduler.check(now)
+        first.get_job('job_b').edit_task('b', command='echo edited')
+        now += timedelta(minutes=2)
+        second.scheduler.check(now)
+        for dagobah in dagobahs:
+            assert sorted([job.name for job in dagobah.jobs]) == ['job_a',
+                                                                 'job_b']
+        assert second.get_job('job_b').tasks['b'].command == 'echo edited'
+        assert second.get_job('job_a').tasks['a'].command == 'true'
+
+        # a job added on one node is run by the node that owns it
+        for i in range(100):
+            first.add_job('owned_%d' % i)
+            job = first.get_job('owned_%d' % i)
+            if nodes[1].owns(job):
+                break
+            first.delete_job(job.name)
+        job.add_task('true', 'a')
+        job.schedule('0 0 1 1 *')
+        fire = job.next_run + timedelta(seconds=1)
+        for dagobah in dagobahs:
+            dagobah.scheduler.check(fire)
+        assert first.get_job(job.name).last_run is None
+        assert second.get_job(job.name).last_run is not None
+        for i in range(100):
+            if second.get_job(job.name).state.status != 'running':
+                break
+            sleep(0.1)
+
+        # only the owner checkpoints the job, under its own ID
+        state = self.backend.get_scheduler_state(job.job_id)
+        assert state['jobs'][0]['next_run'] == second.get_job(job.name).next_run
+        first.scheduler.checkpoint(fire)
+        assert self.backend.get_scheduler_state(job.job_id) == state
+
+        for node in nodes:
+            node.stop()
+        self.dagobah.delete()
+        assert self.backend.get_scheduler_state(job.job_id) is None
+
+
+    def test_load_without_writes(self):
+        self.new_dagobah()
+        self.dagobah.add_job('test_job')
+        self.dagobah.add_task_to_job('test_job', 'ls', 'list')
+        before = self.backend.conn.total_changes
+
+        test_dagobah = Dagobah(SQLiteBackend(self.filepath),
+                               dagobah_id=self.dagobah.dagobah_id)
+        assert test_dagobah.backend.conn.total_changes == 0
+        assert self.backend.conn.total_changes == before
+        assert test_dagobah.get_job('test_job').tasks['list'].command == 'ls'
+        assert self.dagobah.dagobah_id in self.backend.get_known_dagobah_ids()
+
+
+    def test_leases_and_heartbeats(self):
+        self.new_dagobah()
+        other = SQLiteBackend(self.filepath)
+        assert self.backend.acquire_lease('leader', 'a', 60)
+        assert not other.acquire_lease('leader', 'b', 60)
+        self.backend.release_lease('leader', 'a')
+        assert other.acquire_lease('leader', 'b', 60)
+        other.release_lease('leader', 'b')
+
+        self.backend.heartbeat('a', 60)
+        other.heartbeat('b', -1)
+        assert self.backend.get_live_nodes() == ['a']
+        self.backend.unregister_node('a')
+        assert other.get_live_nodes() == []
+
+
+    def test_run_job(self):
+        self.new_dagobah()
+        self.dagobah.add_job('test_job')
+        job = self.dagobah.get_job('test_job')
+        job.add_task('echo hello', 'echo')
+        job.start()
+        for i in range(100):
+            if job.state.status != 'running':
+                break
+            sleep(0.1)
+
+        assert job.state.status == 'waiting'
+        log = self.backend.get_latest_run_log(job.job_id, 'echo')
+        assert log['tasks']['echo']['stdout'] == 'hello\n'
+
+
+    @nottest
+    def run_job(self, job):
+        job.start()
+        for i in range(100):
+            if job.state.status != 'running':
+                break
+            sleep(0.1)
+        return self.backend.get_latest_run_log(job.job_id, job.tasks.keys()[0])
+
+
+    def test_cached_task(self):
+        self.new_dagobah()
+        input_path = os.path.join(self.tempdir, 'input.txt')
+        count_path = os.path.join(self.tempdir, 'count.txt')
+        with open(input_path, 'w') as f:
+            f.write('first')
+
+        self.dagobah.add_job('test_job')
+        job = self.dagobah.get_job('test_job')
+        job.add_task('echo run >> %s; cat %s' % (count_path, input_path),
+                     'cached', cache={'inputs': [input_path], 'check': 'hash'})
+        job.add_task('true', 'downstream')
+        job.add_dependency('cached', 'downstream')
+
+        first = self.run_job(job)['tasks']
+        assert 'cache_hit' not in first['cached']
+        assert first['cached']['stdout'] == 'first'
+
+        second = self.run_job(job)['tasks']
+        assert second['cached']['cache_hit'] == True
+        assert second['cached']['stdout'] == 'first'
+        assert second['cached']['cache_key'] == first['cached']['cache_key']
+        assert second['downstream']['success'] == True
+        assert open(count_path).read() == 'run\n'
+
+        with open(input_path, 'w') as f:
+            f.write('second')
+        third = self.run_job(job)['tasks']
+        assert 'cache_hit' not in third['cached']
+        assert third['cached']['stdout'] == 'second'
+        assert open(count_path).read() == 'run\nrun\n'
+        self.dagobah.delete()
+
+
+    def test_failure_digest_loads_run_log_once(self):
+        digests = []
+
+        class RecordingEmail(object):
+            def send_failure_digest(self, data):
+                digests.append(data)
+
+        handler = EventHandler(include_run_logs=False)
+        self.dagobah = Dagobah(SQLiteBackend(self.filepath), handler)
+        self.backend = self.dagobah.backend
+        digest = FailureDigest(RecordingEmail(), window=60,
+                               backend=self.backend)
+        handler.register('task_failed', digest.add, 'task_failed')
+        handler.register('job_failed', digest.add, 'job_failed')
+
+        self.dagobah.add_job('test_job')
+        job = self.dagobah.get_job('test_job')
+        for i in range(3):
+            job.add_task('echo oops %d >&2; false' % i, 'failing_%d' % i)
+        self.run_job(job)
+
+        loads = []
+        get_job_run_log = self.backend.get_job_run_log
+        self.backend.get_job_run_log = lambda *args: (loads.append(args) or
+                                                      get_job_run_log(*args))
+        digest.flush()
+
+        assert len(loads) == 1
+        assert len(digests) == 1 and digests[0]['job_failed']
+        failed = digests[0]['failed_tasks']
+        assert [task['name'] for task in failed] == ['failing_0', 'failing_1',
+                                                     'failing_2']
+        assert failed[1]['command'] == 'echo oops 1 >&2; false'
+        assert failed[1]['run_log']['stderr'] == 'oops 1\n'
+        self.dagobah.delete()
+
+
+    def test_failed_run_not_cached(self):
+        self.new_dagobah()
+        self.dagobah.add_job('test_job')
+        job = self.dagobah.get_job('test_job')
+        job.add_task('false', 'failing', cache=True)
+
+        self.run_job(job)
+        assert self.backend.get_cached_run(job.job_id, 'failing',
+                                           job.tasks['failing'].get_cache_key()) is None
+        assert 'cache_hit' not in self.run_job(job)['tasks']['failing']
+        self.dagobah.delete()
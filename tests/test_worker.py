@@ -0,0 +1,168 @@
+""" Tests on worker agents running Tasks for a Dagobah """
+
+from time import sleep
+
+from nose.tools import nottest, raises
+
+from dagobah.core.core import Dagobah
+from dagobah.core.workers import WorkerRegistry, UnknownWorkerError
+from dagobah.backend.base import BaseBackend
+from dagobah.worker import WorkerAgent, LocalTransport
+
+HOST = 'worker_host'
+
+
+class LoggingBackend(BaseBackend):
+    """ Keeps every committed run log. """
+
+    def __init__(self):
+        super(LoggingBackend, self).__init__()
+        self.logs = []
+
+    def commit_log(self, log_json):
+        self.logs.append(log_json)
+
+
+class FlakyTransport(LocalTransport):
+    """ Fails the first few reports, as if the daemon were unreachable. """
+
+    def __init__(self, registry, failures):
+        super(FlakyTransport, self).__init__(registry)
+        self.failures = failures
+
+    def report(self, *args, **kwargs):
+        if self.failures > 0:
+            self.failures -= 1
+            raise IOError('daemon unreachable')
+        return super(FlakyTransport, self).report(*args, **kwargs)
+
+
+@nottest
+def worker_dagobah(worker_ttl=30):
+    registry = WorkerRegistry(worker_ttl=worker_ttl)
+    dagobah = Dagobah(LoggingBackend(), workers=registry)
+    dagobah.scheduler.stop()
+    return dagobah
+
+
+@nottest
+def start_agent(transport):
+    agent = WorkerAgent(transport, worker_id='test_worker', hosts=[HOST],
+                        poll_interval=0.05, batch_interval=0.05)
+    agent.start()
+    for i in range(50):
+        if agent.registered:
+            return agent
+        sleep(0.1)
+    raise AssertionError('agent did not register')
+
+
+@nottest
+def run_job(dagobah, command):
+    dagobah.add_job('test_job')
+    job = dagobah.get_job('test_job')
+    job.add_task(command, 'remote', hostname=HOST)
+    job.start()
+    wait_until_stopped(job)
+    return dagobah.backend.logs[-1]['tasks']['remote']
+
+
+@nottest
+def wait_until_stopped(job):
+    for i in range(200):
+        if job.state.status != 'running':
+            return
+        sleep(0.1)
+    raise AssertionError('job did not finish')
+
+
+def test_task_runs_on_worker():
+    dagobah = worker_dagobah()
+    agent = start_agent(LocalTransport(dagobah.workers))
+    log = run_job(dagobah, 'echo hello; echo oops 1>&2')
+    agent.stop()
+
+    assert log['success'] == True
+    assert log['return_code'] == 0
+    assert log['stdout'] == 'hello\n'
+    assert log['stderr'] == 'oops\n'
+    assert log['resources']['max_rss_kb'] > 0
+    assert dagobah.workers.assignments == {}
+
+
+def test_failing_task_on_worker():
+    dagobah = worker_dagobah()
+    agent = start_agent(LocalTransport(dagobah.workers))
+    log = run_job(dagobah, 'exit 3')
+    agent.stop()
+
+    assert log['success'] == False
+    assert log['return_code'] == 3
+
+
+def test_output_kept_when_reports_fail():
+    dagobah = worker_dagobah()
+    agent = start_agent(FlakyTransport(dagobah.workers, 3))
+    log = run_job(dagobah, 'echo one; sleep 0.2; echo two')
+    agent.stop()
+
+    assert log['success'] == True
+    assert log['stdout'] == 'one\ntwo\n'
+
+
+def test_lost_worker_fails_task():
+    dagobah = worker_dagobah(worker_ttl=0.5)
+    dagobah.workers.register('silent_worker', [HOST])
+    log = run_job(dagobah, 'echo never')
+
+    assert log['success'] == False
+    assert log['return_code'] == -1
+    assert 'remote machine' in log['stderr']
+
+
+def test_terminate_task_on_worker():
+    dagobah = worker_dagobah()
+    agent = start_agent(LocalTransport(dagobah.workers))
+    dagobah.add_job('test_job')
+    job = dagobah.get_job('test_job')
+    job.add_task('sleep 30', 'remote', hostname=HOST)
+    job.start()
+    for i in range(50):
+        if agent.runners:
+            break
+        sleep(0.1)
+
+    job.get_active_task('remote').terminate()
+    wait_until_stopped(job)
+    agent.stop()
+
+    log = dagobah.backend.logs[-1]['tasks']['remote']
+    assert log['success'] == False
+    assert 'SIGTERM' in log['stderr']
+
+
+def test_task_without_worker_is_not_assigned():
+    dagobah = worker_dagobah()
+    dagobah.add_job('test_job')
+    job = dagobah.get_job('test_job')
+    job.add_task('ls', 'remote', hostname='other_host')
+    dagobah.workers.register('test_worker', [HOST])
+    assert dagobah.workers.assign(job.tasks['remote']) is None
+
+
+def test_assign_least_loaded_worker():
+    dagobah = worker_dagobah()
+    dagobah.add_job('test_job')
+    job = dagobah.get_job('test_job')
+    job.add_task('ls', 'remote', hostname=HOST)
+    dagobah.workers.register('small', [HOST], capacity=1)
+    dagobah.workers.register('large', [HOST], capacity=4)
+
+    workers = [dagobah.workers.assign(job.tasks['remote']).worker_id
+               for i in range(3)]
+    assert workers == ['large', 'small', 'large']
+
+
+@raises(UnknownWorkerError)
+def test_poll_unknown_worker():
+    WorkerRegistry().poll('nobody')